@@ -3,10 +3,27 @@
 Anonymise MEG fiff-files.
 
 ==========================================
-Anonymise MEG fiff-files using fiff_anonymise.
+Anonymise MEG fiff-files.
 Search sub-directories of root_paths for fiff-files.
 Anonymise those that contain realistic date of birth.
-Existing files will be replaced.
+Only the subject information is read from each file to decide this.
+Hard-linked duplicates are considered only once. Split files (e.g.
+raw.fif, raw-1.fif, raw-2.fif) are treated as one recording if each part
+refers to the next one in its header. Only the first part of a recording
+is probed, and its parts are anonymised together if it contains a realistic
+date of birth.
+By default, subject information is scrubbed in place (--Engine native):
+only the bytes of the subject tags are overwritten, and the original bytes
+are kept in a journal until the result has been checked. An interrupted
+run is rolled back the next time the file is considered.
+With --Engine command, an anonymised copy is written with fiff_anonymise
+(--Command), and replaces the existing file.
+Several files are processed in parallel (--NJobs), since this is mostly
+waiting for file access.
+The result for every file is kept in a manifest (--Manifest), which is
+updated while files are processed. In later runs, only new or modified
+files are opened; --DryRun only reports how many files would be opened
+or skipped.
 For example:
 Anonymise_Fiff.py --SearchPaths /imaging/calvin/meg /imaging/hobbes/meg
 
@@ -16,120 +33,542 @@ Type Anonymise_Fiff.py --help for options.
 OH June 2017, June 2020
 """
 
-print(__doc__)
-
 import os
+import re
+import json
+import shlex
+import sqlite3
+import subprocess
 from sys import argv, exit
-
-# only display help message when no args are passed.
-if len(argv) == 1:
-    exit(1)
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import argparse
 
-from mne.io import read_info
+import Fiff_Tags
 
-# Parse input arguments
+bytes_thresh = 35  # threshold for difference in file sizes (bytes)
 
-parser = argparse.ArgumentParser(description='Anonymise Fiff data.')
+# original bytes of files being anonymised in place
+journal_suffix = '.anon-journal.json'
 
-parser.add_argument('--SearchPaths', type=str, nargs='+',
-                    help='Paths to search for fiff-files.')
+# number of files whose results are written to the manifest at once
+manifest_batch = 100
 
-parser.add_argument('--MinYear', help='Minimum possible year of birth '
-                    '(default 1930).', type=float, default=1900)
+# entries of subject info that must be gone after anonymisation
+ident_keys = ['id', 'his_id', 'first_name', 'middle_name', 'last_name',
+              'birthday']
 
-args = parser.parse_args()
 
-# list of paths to search for fiff-files
-root_paths = args.SearchPaths
+def get_parser():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(description='Anonymise Fiff data.')
 
-# make sure paths are in list
-if type(root_paths) != list:
+    parser.add_argument('--SearchPaths', type=str, nargs='+',
+                        help='Paths to search for fiff-files.')
 
-    root_paths = [root_paths]
+    parser.add_argument('--MinYear', help='Minimum possible year of birth '
+                        '(default 1930).', type=float, default=1900)
 
-bytes_thresh = 35  # threshold for difference in file sizes (bytes)
-yob_thresh = args.MinYear  # only consider years-of-birth above this
+    parser.add_argument('--Engine', help='native: scrub subject information '
+                        'in place; command: replace file by anonymised copy '
+                        'from --Command (default native).', default='native',
+                        choices=['native', 'command'])
+
+    parser.add_argument('--Command', help='With --Engine command: '
+                        'anonymisation command, applied to filename in its '
+                        'directory (default /neuro/bin/util/fiff_anonymize).',
+                        default='/neuro/bin/util/fiff_anonymize')
+
+    parser.add_argument('--NJobs', help='Number of files processed in '
+                        'parallel (default 4).', type=int, default=4)
+
+    parser.add_argument('--Manifest', help='SQLite file recording results '
+                        'per file; unchanged files that were anonymised or '
+                        'skipped before are not opened again (default '
+                        'Anonymise_Fiff-manifest.sqlite, "none": no '
+                        'manifest).', default='Anonymise_Fiff-manifest.sqlite')
+
+    parser.add_argument('--DryRun', help='Only report how many files would '
+                        'be opened and how many skipped.', action='store_true')
+
+    return parser
+
+
+def find_fiff_files(root_paths):
+    """Fiff-files in sub-directories of root_paths, with their identity.
+
+    Returns dict with (device, inode, size, modification time) per filename.
+    """
+    fiff_files = {}  # collect fiff-files in dict
+
+    stack = list(root_paths)
+    while stack != []:
+
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:  # e.g. no permission
+            continue
+
+        for entry in entries:
+
+            if entry.is_dir(follow_symlinks=False):
+
+                stack.append(entry.path)
 
-fiff_list = []  # collect fiff-files in list
-for root_path in root_paths:
-    for dirpath, dirnames, filenames in os.walk(root_path):
-        for filename in [ff for ff in filenames if ff.endswith('.fif')]:
-            fiff_list.append(os.path.join(dirpath, filename))
-            print(fiff_list[-1])
+            elif entry.name.endswith('.fif'):
 
-n_files = len(fiff_list)
+                try:
+                    st = entry.stat()
+                except OSError:  # e.g. broken link
+                    continue
 
-print("\n###\n%d fiff-files to consider.\n###" % n_files)
+                fiff_files[entry.path] = (st.st_dev, st.st_ino,
+                                          st.st_size, st.st_mtime_ns)
 
-# command to apply to filename
-cmd_string = '/neuro/bin/util/fiff_anonymize '
+    return fiff_files
 
-path_ori = os.getcwd()  # remember current directory
 
-# list of files for which number of bytes don't match
-didnt_work = []
+def open_manifest(fname):
+    """Open (or create) SQLite manifest of processed fiff-files."""
+    conn = sqlite3.connect(fname)
 
-print("Anonymising.")
-for filename in fiff_list:
+    conn.execute('CREATE TABLE IF NOT EXISTS files ('
+                 'path TEXT PRIMARY KEY, inode INTEGER, size INTEGER, '
+                 'mtime_ns INTEGER, state TEXT)')
 
+    # version 0 skipped split files by their name only, without probing
+    if conn.execute('PRAGMA user_version').fetchone()[0] < 1:
+
+        with conn:
+
+            conn.execute("DELETE FROM files WHERE state = 'skipped'")
+            conn.execute('PRAGMA user_version = 1')
+
+    return conn
+
+
+def files_to_probe(conn, fiff_files):
+    """Files that are new, modified, unreadable or failed in earlier runs."""
+    done = {}
+    if conn is not None:
+
+        for row in conn.execute('SELECT path, inode, size, mtime_ns, state '
+                                'FROM files'):
+
+            if row[4] in ('success', 'skipped'):
+
+                done[row[0]] = tuple(row[1:4])
+
+    return sorted(ff for ff in fiff_files
+                  if done.get(ff) != fiff_files[ff][1:])
+
+
+def split_part(filename):
+    """Name of first file of split recording, and part number (0: first).
+
+    Recognises raw.fif, raw-1.fif, raw-2.fif... (Maxfilter/MNE) and
+    ..._split-01_meg.fif, ..._split-02_meg.fif... (BIDS). Names alone don't
+    make a split recording (e.g. sub.fif and sub-01.fif), see
+    group_recordings.
+    """
     path, fname = os.path.split(filename)
 
-    anon_fname = fname.split('.')[0] + '_anon.fif'
+    match = re.match(r'^(.*)-(\d+)\.fif$', fname)
+    if match:
+        return os.path.join(path, match.group(1) + '.fif'), int(match.group(2))
 
-    # change to subject directory, to avoid problems with multiple "."
-    os.chdir(path)
+    match = re.match(r'^(.*_split-)(\d+)(_.*\.fif)$', fname)
+    if match:
+        return (os.path.join(path, match.group(1) + '01' + match.group(3)),
+                int(match.group(2)) - 1)
 
-    # Excute anonymisation command in linux
-    cmd = cmd_string + fname
-
-    try:  # try if it's measurement data at all
-        info = read_info(fname)
-    except:  # (RuntimeError, TypeError, NameError, ValueError):
-        continue  # try next file
-
-    if not (info['subject_info'] is None):
-        if ('birthday' in info['subject_info']):
-            yob = info['subject_info']['birthday'][0]  # year of birth
-            if yob < yob_thresh:  # if subject ridiculously old, next file
-                continue
-        else:
+    return filename, 0
+
+
+def group_recordings(fiff_list, fiff_files):
+    """Group files into recordings, which are anonymised together.
+
+    Returns list of recordings. Each recording is a list of its split files
+    (first file first), each given as list of filenames that are the same
+    file (same device and inode, e.g. hard links).
+    Files with names of the same split recording (see split_part) are only
+    grouped if each part refers to the next one in its fiff header,
+    starting from the first part.
+    """
+    # same device and inode: same file
+    links = {}
+    for filename in fiff_list:
+        links.setdefault(fiff_files[filename][:2], []).append(filename)
+
+    same_file = {ff: key for [key, names] in links.items() for ff in names}
+
+    # candidate split sets by name, in order of part number
+    sets = {}
+    for [key, names] in links.items():
+        first, part = split_part(names[0])
+        sets.setdefault(first, []).append((part, key))
+
+    recordings = []
+    for parts in sets.values():
+
+        keys = [key for [_, key] in sorted(parts)]
+
+        # chain of parts confirmed by the reference to the next file,
+        # starting from the first part
+        chain = [keys[0]]
+        while len(chain) < len(keys):
+
+            try:
+                fname_next = Fiff_Tags.read_next_file(links[chain[-1]][0])
+            except Exception:  # e.g. truncated file
+                fname_next = None
+
+            key_next = same_file.get(fname_next)
+
+            if key_next not in keys or key_next in chain:
+                break
+
+            chain.append(key_next)
+
+        recordings.append([links[kk] for kk in chain])
+
+        # parts not referred to are recordings of their own
+        recordings += [[links[kk]] for kk in keys if kk not in chain]
+
+    return sorted(recordings)
+
+
+def update_manifest(conn, fiff_list, results):
+    """Record results and current identity of files in manifest."""
+    rows = []
+    for [filename, result] in zip(fiff_list, results):
+
+        try:
+            st = os.stat(filename)  # anonymised files have been replaced
+        except OSError:
             continue
-    else:
-        continue
 
-    try:  # try anonymising
-        os.system(cmd)
-    except ValueError:
-        print("")
+        rows.append((filename, st.st_ino, st.st_size, st.st_mtime_ns,
+                     result))
+
+    with conn:
+
+        conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                         '(?, ?, ?, ?, ?)', rows)
+
+
+def needs_anonymising(filename, yob_thresh):
+    """Whether fiff-file contains realistic year of birth.
+
+    Only the subject information is read from the file. Returns None if it
+    is not a fiff-file.
+    """
+    subject_info = Fiff_Tags.read_subject_info(filename)
+
+    if subject_info is None:
+        return None
+
+    if 'birthday' not in subject_info:
+        return False
+
+    yob = subject_info['birthday'].year  # year of birth
+
+    # if subject ridiculously old, not a real birthday
+    return yob >= yob_thresh
+
+
+def write_journal(fname_journal, edits):
+    """Save original bytes (position, bytes) before changing a file."""
+    fname_tmp = fname_journal + '.tmp'
+
+    with open(fname_tmp, 'w') as fid:
+
+        json.dump([[pos, data.hex()] for [pos, data] in edits], fid)
+        fid.flush()
+        os.fsync(fid.fileno())
+
+    os.replace(fname_tmp, fname_journal)
+
+
+def rollback(filename):
+    """Restore original bytes of file from its journal, remove journal.
+
+    The file is only written if it has been changed, e.g. not if writing
+    the edits failed.
+    """
+    fname_journal = filename + journal_suffix
+
+    with open(fname_journal) as fid:
+
+        edits = [(pos, bytes.fromhex(data)) for [pos, data] in json.load(fid)]
+
+    if Fiff_Tags.read_edits(filename, edits) != edits:
+        Fiff_Tags.write_edits(filename, edits)
+
+    os.remove(fname_journal)
+
+
+def anonymise_native(filename):
+    """Scrub subject information of fiff-file in place.
+
+    Identifying subject tags become empty no-op tags of the same size.
+    The original bytes are kept in a journal until the file has been read
+    back successfully, and restored otherwise.
+    """
+    from mne.io import read_info
+
+    edits = Fiff_Tags.subject_scrub_edits(filename)
+
+    if not edits:  # None or nothing found
+        return 'failed'
+
+    write_journal(filename + journal_suffix,
+                  Fiff_Tags.read_edits(filename, edits))
+
+    try:
+        Fiff_Tags.write_edits(filename, edits)
+
+        subject_info = read_info(filename, verbose=False)['subject_info']
+
+        ok = not subject_info or not any(kk in subject_info
+                                         for kk in ident_keys)
+    except Exception as err:
+        print("Could not anonymise %s: %s" % (filename, err))
+        ok = False
+
+    if not ok:
+        try:
+            rollback(filename)
+        except Exception as err:
+            print("Could not roll back %s (original bytes in %s): %s" %
+                  (filename, filename + journal_suffix, err))
+        return 'failed'
+
+    os.remove(filename + journal_suffix)
+    print("Success with %s:" % filename)
+
+    return 'success'
+
+
+def _try_engine(func, filename, *args):
+    """Result of anonymisation engine, 'failed' if it raises an exception."""
+    try:
+        return func(filename, *args)
+    except Exception as err:  # e.g. no permission
+        print("Could not anonymise %s: %s" % (filename, err))
+        return 'failed'
+
+
+def _try_probe(filename, yob_thresh):
+    """Result of needs_anonymising, None if it raises an exception."""
+    try:
+        return needs_anonymising(filename, yob_thresh)
+    except Exception:  # e.g. truncated file
+        return None
+
+
+def anonymise_recording(recording, engine, command, yob_thresh):
+    """Anonymise all files of a recording (see group_recordings).
+
+    Only the first file is probed (the others if it cannot be read). If it
+    contains a realistic year of birth, all readable files are anonymised,
+    otherwise they are skipped.
+    Returns dict with 'skipped', 'unreadable', 'success' or 'failed' per
+    filename.
+    """
+    try:
+        for names in recording:
+            for filename in names:
+                if os.path.exists(filename + journal_suffix):
+                    print("Rolling back interrupted anonymisation of %s." %
+                          filename)
+                    rollback(filename)
+    except Exception as err:
+        print("Could not roll back %s: %s" % (filename, err))
+        return {ff: 'failed' for names in recording for ff in names}
+
+    # the parts of a split recording are linked by their headers, the first
+    # part decides for all of them
+    needed = [_try_probe(recording[0][0], yob_thresh)] * len(recording)
+
+    if needed[0] is None:  # no decision for the others, probe each of them
+        needed[1:] = [_try_probe(names[0], yob_thresh)
+                      for names in recording[1:]]
+
+    anonymise = any(needed)
+
+    results = {}
+    for [names, need] in zip(recording, needed):
+
+        if need is None:  # not measurement data at all
+            results.update((ff, 'unreadable') for ff in names)
+
+        elif not anonymise:
+            results.update((ff, 'skipped') for ff in names)
+
+        elif engine == 'native':
+            # changes file in place, i.e. for all its links
+            res = _try_engine(anonymise_native, names[0])
+            results.update((ff, res) for ff in names)
+
+        else:
+            # replaces file, other links still point to original
+            results.update((ff, _try_engine(anonymise_command, ff, command))
+                           for ff in names)
+
+    return results
+
+
+def anonymise_command(filename, command):
+    """Anonymise fiff-file with command and replace original.
+
+    The command is run in the directory of the file, to avoid problems with
+    multiple "." in paths.
+    """
+    path, fname = os.path.split(filename)
 
     # filename after applying anonymisation command
-    anon_fname = fname.split('.')[0] + '_anon.fif'
+    anon_fname = os.path.join(path, fname.split('.')[0] + '_anon.fif')
+
+    # Excute anonymisation command in linux
+    cmd = shlex.split(command) + [fname]
+
+    try:
+        subprocess.run(cmd, cwd=path or None, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.STDOUT)
+    except OSError as err:
+        print("Could not run %s: %s" % (command, err))
+        return 'failed'
 
     # check if everything worked, if yes copy anon to orignal filename
-    if os.path.exists(anon_fname):  # if an anonymised file exists
-        s1 = os.path.getsize(fname)
-        s2 = os.path.getsize(anon_fname)
-        diff = s1 - s2
-
-        if diff > bytes_thresh:  # compare file sizes
-            didnt_work.append(filename)  # if difference too big, don't remove
-        else:  # if file sizes ok
-            # keep a safe copy
-            keep_fname = fname.split('.')[0] + '_keep_zyx987654321.fif'
-            os.rename(fname, keep_fname)
-
-            os.rename(anon_fname, fname)  # rename anonymised file to old file
-
-            s3 = os.path.getsize(fname)
-            if s3 == s2:  # if copy successful
-                os.remove(keep_fname)  # remove safe copy
-                print("Success with %s:" % filename)
-            else:
-                didnt_work.append(filename)
-    else:
-        didnt_work.append(filename)
-
-# back to original path
-os.chdir(path_ori)
+    if not os.path.exists(anon_fname):  # if no anonymised file exists
+        return 'failed'
+
+    s1 = os.path.getsize(filename)
+    s2 = os.path.getsize(anon_fname)
+    diff = s1 - s2
+
+    if diff > bytes_thresh:  # compare file sizes
+        return 'failed'  # if difference too big, don't remove
+
+    # keep a safe copy
+    keep_fname = os.path.join(path, fname.split('.')[0] +
+                              '_keep_zyx987654321.fif')
+    os.rename(filename, keep_fname)
+
+    os.rename(anon_fname, filename)  # rename anonymised file to old file
+
+    s3 = os.path.getsize(filename)
+    if s3 != s2:  # if copy not successful
+        return 'failed'
+
+    os.remove(keep_fname)  # remove safe copy
+    print("Success with %s:" % filename)
+
+    return 'success'
+
+
+def main(argv_in=None):
+    """Anonymise fiff-files in search paths."""
+    print(__doc__)
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    # only display help message when no args are passed.
+    if argv_in == []:
+        exit(1)
+
+    args = get_parser().parse_args(argv_in)
+
+    # list of paths to search for fiff-files
+    root_paths = args.SearchPaths
+
+    # make sure paths are in list
+    if type(root_paths) != list:
+
+        root_paths = [root_paths]
+
+    yob_thresh = args.MinYear  # only consider years-of-birth above this
+
+    fiff_files = find_fiff_files(root_paths)
+
+    conn = None
+    if args.Manifest != 'none' and (not args.DryRun or
+                                    os.path.exists(args.Manifest)):
+
+        conn = open_manifest(args.Manifest)
+
+    fiff_list = files_to_probe(conn, fiff_files)
+
+    n_files = len(fiff_list)
+
+    recordings = group_recordings(fiff_list, fiff_files)
+
+    n_links = sum(len(names) - 1 for rec in recordings for names in rec)
+
+    print("\n###\n%d fiff-files found, %d to consider, %d skipped "
+          "(unchanged since earlier run).\n%d recordings to probe, "
+          "%d duplicate links.\n###" %
+          (len(fiff_files), n_files, len(fiff_files) - n_files,
+           len(recordings), n_links))
+
+    if args.DryRun:
+
+        for recording in recordings:
+            print(' + '.join(names[0] for names in recording))
+
+        return []
+
+    print("Anonymising.")
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(args.NJobs, 1)) as pool:
+
+        futures = {pool.submit(anonymise_recording, rec, args.Engine,
+                               args.Command, yob_thresh): rec
+                   for rec in recordings}
+
+        # results are recorded as they come in, an interrupted run keeps them
+        pending = []
+        for future in as_completed(futures):
+
+            try:
+                res = future.result()
+            except Exception as err:
+                print("Could not anonymise %s: %s" % (futures[future][0][0],
+                                                       err))
+                res = {ff: 'failed' for names in futures[future]
+                       for ff in names}
+
+            results.update(res)
+            pending += list(res)
+
+            if conn is not None and len(pending) >= manifest_batch:
+
+                update_manifest(conn, pending, [results[ff] for ff in pending])
+                pending = []
+
+    if conn is not None:
+
+        update_manifest(conn, pending, [results[ff] for ff in pending])
+        conn.close()
+
+    results = [results[ff] for ff in fiff_list]
+
+    # list of files for which anonymisation failed
+    didnt_work = [ff for [ff, rr] in zip(fiff_list, results)
+                  if rr == 'failed']
+
+    print("\n###\n%d anonymised, %d skipped, %d unreadable, %d failed.\n###" %
+          (results.count('success'), results.count('skipped'),
+           results.count('unreadable'), len(didnt_work)))
+
+    for filename in didnt_work:
+        print("Didn't work: %s" % filename)
+
+    return didnt_work
+
+
+if __name__ == '__main__':
+
+    main()
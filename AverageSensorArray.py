@@ -5,6 +5,15 @@ Find fiff-file with the most average sensor array position in a list of files.
 For example to be used for maxfilter -trans.
 A text file with the list of fiff-files needs to be specified:
 One line per file, each file with full path.
+By default, the most average file is the one whose sensor array origin is
+closest to the mean origin (translation only). With --Mode full, the file
+with the smallest mean distance to all other files is chosen (medoid),
+where distances combine translation and rotation (--RotWeight mm per degree).
+Only the device-to-head transform is read from the file headers, several
+files at a time (--NThreads).
+With --Catalog, headers are stored in a local SQLite database, and only
+headers of new or changed files are read on later runs. Files can also be
+selected by path prefix (--PathPrefix), e.g. all fiff-files of a project.
 For more help, type AverageSensorArray -h.
 An example text file can be found here:
 /imaging/local/software/mne_python/Utilities/AverageSensorArray/fiff_file_list.txt
@@ -13,83 +22,448 @@ E.g., run in command line: AverageSensorArray fiff_file_list.txt
 """
 # Olaf Hauk, Python 3, July 2019
 
-print(__doc__)
-
 from sys import argv, exit
 
+import os
 import argparse
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 from numpy import mean, sum
 
-import mne
+# mne is only imported if headers cannot be read from fiff tags, to start
+# quickly
+
+import Fiff_Tags
+
+
+def get_parser():
+    """Argument parser for AverageSensorArray."""
+    parser = argparse.ArgumentParser(description='Determine average MEG sensor array across fiff-files.')
+
+    parser.add_argument('--filelist', help='Text file with one fiff-file per line.')
+    parser.add_argument('--PathPrefix', help='Use all fiff-files whose path starts with this prefix '
+                        '(can be combined with --filelist).', nargs='+', default=[])
+    parser.add_argument('--Catalog', help='SQLite file with catalog of file headers (default: no catalog). '
+                        'Only headers of new or changed files are read.', default='')
+    parser.add_argument('--NoRefresh', help='With --Catalog: take files and headers from the catalog only, '
+                        'without checking files on disk.', action='store_true')
+    parser.add_argument('--NThreads', help='Number of files read in parallel (default 16).', type=int, default=16)
+    parser.add_argument('--ReadInfo', help='Read complete measurement info with MNE, instead of only '
+                        'the device-to-head transform.', action='store_true')
+
+    parser.add_argument('--Mode', help='translation: closest to mean origin (default); '
+                        'full: medoid of translation and rotation.', choices=['translation', 'full'],
+                        default='translation')
+    parser.add_argument('--RotWeight', help='Mode full: weight of rotation in mm per degree (default 1).', type=float, default=1.)
+    parser.add_argument('--ChunkSize', help='Mode full: number of files per chunk of the distance matrix '
+                        '(default 2000).', type=int, default=2000)
+    parser.add_argument('--ExactMax', help='Mode full: for more files than this, approximate medoid from random '
+                        'reference files (default 20000).', type=int, default=20000)
+    parser.add_argument('--NRef', help='Mode full, approximate: number of random reference files (default 1000).',
+                        type=int, default=1000)
+
+    return parser
+
+
+def read_dev_head_t(fname, read_full=False):
+    """Device-to-head transform (4x4) of fiff-file.
+
+    Only the transform is read from the file header, unless it cannot be
+    found there or read_full is True, in which case the measurement info is
+    read with MNE.
+    """
+    trans = None
+
+    if not read_full:
+
+        trans = Fiff_Tags.read_dev_head_t(fname)
+
+    if trans is None:
+
+        from mne.io import read_info
+
+        trans = read_info(fname)['dev_head_t']['trans']
+
+    return trans
+
+
+def read_transforms(filelist, n_threads=16, read_full=False):
+    """Device-to-head transforms for all files, read in parallel."""
+    # reading headers is I/O bound, threads are sufficient
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+
+        transmats = list(pool.map(lambda ff: read_dev_head_t(ff, read_full),
+                                  filelist))
+
+    return transmats
+
+
+###
+# FILES AND HEADER CATALOG
+###
+
+def find_fiff_files(prefix):
+    """All fiff-files below directories whose path starts with prefix."""
+    top = prefix if os.path.isdir(prefix) else os.path.dirname(prefix)
+
+    files = []
+    stack = [top]
+    while stack != []:
+
+        with os.scandir(stack.pop()) as entries:
+
+            for entry in entries:
+
+                if entry.is_dir(follow_symlinks=False):
+
+                    # only descend where prefix can still match
+                    if (entry.path.startswith(prefix) or
+                            prefix.startswith(entry.path + os.sep)):
+
+                        stack.append(entry.path)
+
+                elif entry.name.endswith('.fif') and \
+                        entry.path.startswith(prefix):
+
+                    files.append(entry.path)
+
+    return sorted(files)
+
+
+def open_catalog(fname):
+    """Open (or create) SQLite catalog of fiff-file headers."""
+    conn = sqlite3.connect(fname)
+
+    conn.execute('CREATE TABLE IF NOT EXISTS headers ('
+                 'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                 'dev_head_t BLOB, sfreq REAL, nchan INTEGER, n_meg INTEGER, '
+                 'n_eeg INTEGER)')
+
+    return conn
+
+
+def _read_header_full(fname):
+    """Header from MNE's measurement info if fast reading fails."""
+    header = Fiff_Tags.read_header(fname)
+
+    if header is None or header['dev_head_t'] is None:
+
+        import mne
+
+        info = mne.io.read_info(fname)
+
+        header = {'dev_head_t': info['dev_head_t']['trans'],
+                  'sfreq': info['sfreq'], 'nchan': info['nchan'],
+                  'n_meg': len(mne.pick_types(info, meg=True, eeg=False, exclude=[])),
+                  'n_eeg': len(mne.pick_types(info, meg=False, eeg=True, exclude=[]))}
+
+    return header
+
+
+def _stat(fname):
+    """Size and modification time of file."""
+    st = os.stat(fname)
+
+    return st.st_size, st.st_mtime_ns
+
+
+def catalog_transforms(conn, filelist, n_threads=16, refresh=True):
+    """Device-to-head transforms from catalog, reading only new or changed headers."""
+    rows = {}
+    for start in range(0, len(filelist), 500):
+
+        chunk = filelist[start:start + 500]
+        query = ('SELECT path, size, mtime_ns, dev_head_t FROM headers '
+                 'WHERE path IN (%s)' % ','.join('?' * len(chunk)))
+
+        for row in conn.execute(query, chunk):
+
+            rows[row[0]] = row[1:]
+
+    if refresh:
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+
+            stats = dict(zip(filelist, pool.map(_stat, filelist)))
+
+        todo = [ff for ff in filelist if ff not in rows or
+                rows[ff][0:2] != stats[ff]]
+
+    else:
+
+        todo = [ff for ff in filelist if ff not in rows]
+
+    print('Catalog: %d of %d headers new or changed.' % (len(todo),
+                                                        len(filelist)))
+
+    if todo != []:
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+
+            headers = list(pool.map(_read_header_full, todo))
+
+        new_rows = []
+        for [ff, hh] in zip(todo, headers):
+
+            size, mtime_ns = stats[ff] if refresh else _stat(ff)
+            blob = np.asarray(hh['dev_head_t'], dtype=np.float64).tobytes()
+
+            new_rows.append((ff, size, mtime_ns, blob, hh['sfreq'],
+                             hh['nchan'], hh['n_meg'], hh['n_eeg']))
+
+            rows[ff] = (size, mtime_ns, blob)
+
+        with conn:
+
+            conn.executemany('INSERT OR REPLACE INTO headers VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?)', new_rows)
+
+    return [np.frombuffer(rows[ff][2], dtype=np.float64).reshape(4, 4)
+            for ff in filelist]
+
+
+def catalog_files(conn, prefix):
+    """Files in catalog whose path starts with prefix."""
+    rows = conn.execute('SELECT path FROM headers WHERE substr(path, 1, ?) = ? '
+                        'ORDER BY path', (len(prefix), prefix))
+
+    return [row[0] for row in rows]
+
+
+###
+# MEDOID OF RIGID TRANSFORMS
+###
+
+def pairwise_distances(coors_a, rots_a, coors_b, rots_b, rot_weight=1.):
+    """Distances between rigid transforms (n_a, n_b).
+
+    coors: origins in mm (n, 3), rots: rotation matrices flattened (n, 9).
+    Distance is sqrt(translation**2 + (rot_weight * angle)**2), with angle the
+    rotation (degrees) between the two transforms.
+    """
+    d_trans = (np.sum(coors_a ** 2, axis=1)[:, np.newaxis] +
+               np.sum(coors_b ** 2, axis=1)[np.newaxis, :] -
+               2. * coors_a.dot(coors_b.T))
+
+    # trace(Ra^T Rb) = 1 + 2 cos(angle)
+    cos_ang = (rots_a.dot(rots_b.T) - 1.) / 2.
+    angle = np.degrees(np.arccos(np.clip(cos_ang, -1., 1.)))
+
+    return np.sqrt(np.maximum(d_trans, 0.) + (rot_weight * angle) ** 2)
+
+
+def distance_sums(coors, rots, rot_weight=1., chunk=2000, idx=None,
+                  ref=None):
+    """Sum of distances of transforms idx to transforms ref (default all).
+
+    The distance matrix is computed in chunks of rows, so that memory does
+    not grow quadratically with the number of files.
+    """
+    if idx is None:
+
+        idx = np.arange(len(coors))
+
+    if ref is None:
+
+        ref = np.arange(len(coors))
+
+    sums = np.zeros(len(idx))
+    for start in range(0, len(idx), chunk):
+
+        rows = idx[start:start + chunk]
+        sums[start:start + chunk] = pairwise_distances(
+            coors[rows], rots[rows], coors[ref], rots[ref],
+            rot_weight).sum(axis=1)
+
+    return sums
+
+
+def find_medoid(coors, rots, rot_weight=1., chunk=2000, exact_max=20000,
+                n_ref=1000, n_cand=100):
+    """Mean distance of every transform to all others, and index of medoid.
+
+    For more than exact_max transforms, mean distances are estimated from
+    n_ref random reference transforms, and computed exactly only for the
+    n_cand best candidates.
+    """
+    n = len(coors)
+
+    if n <= exact_max:
+
+        return distance_sums(coors, rots, rot_weight, chunk) / n, None
+
+    print('%d files: approximating medoid from %d reference files.' %
+          (n, n_ref))
+
+    rng = np.random.RandomState(0)
+    ref = rng.choice(n, min(n_ref, n), replace=False)
+
+    mean_dists = distance_sums(coors, rots, rot_weight, chunk,
+                               ref=ref) / len(ref)
+
+    # exact mean distances for best candidates
+    cand = np.argsort(mean_dists)[:n_cand]
+    mean_dists[cand] = distance_sums(coors, rots, rot_weight, chunk,
+                                     idx=cand) / n
+
+    return mean_dists, cand
+
+
+def print_medoid(filelist, transmats, args):
+    """Find and print file closest to all others in translation and rotation."""
+    coors = np.array([-1000. * tt[0:3, 3] for tt in transmats])
+    rots = np.array([tt[0:3, 0:3].ravel() for tt in transmats])
+
+    mean_dists, cand = find_medoid(coors, rots, args.RotWeight, args.ChunkSize,
+                                   args.ExactMax, args.NRef)
+
+    if cand is None:
+
+        min_idx = mean_dists.argmin()
+
+    else:
+
+        # only candidates have exact values
+        min_idx = cand[mean_dists[cand].argmin()]
+
+    max_idx = mean_dists.argmax()
+
+    # rotation of every file relative to medoid
+    angles = np.degrees(np.arccos(np.clip((rots.dot(rots[min_idx]) - 1.) / 2.,
+                                          -1., 1.)))
+
+    for [di, dd] in enumerate(mean_dists):
+
+        print('Subject %d: Mean dist %.1f (%.1f %.1f %.1f, rot %.1fdeg)\n' %
+              (di+1, dd, coors[di][0], coors[di][1], coors[di][2], angles[di]))
+
+    print('Rotation weight: %.2fmm per degree.\n' % args.RotWeight)
+
+    print('Most average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[min_idx][0], coors[min_idx][1], coors[min_idx][2]))
+
+    print('Least average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[max_idx][0], coors[max_idx][1], coors[max_idx][2]))
+
+    print('#########################################################################')
+    print('The MOST AVERAGE subject is #%d (mean dist %.1f): %s.' % (min_idx+1, mean_dists[min_idx], filelist[min_idx]))
+    print('#########################################################################')
+
+    print('For comparison, the least average subject is #%d (mean dist %.1f): %s.\n' % (max_idx+1, mean_dists[max_idx], filelist[max_idx]))
+
+
+def main(argv_in=None):
+
+    print(__doc__)
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == []:
+
+        exit()
+
+    args = get_parser().parse_args(argv_in)
+
+    if args.ReadInfo:
+
+        import mne
+
+        print('MNE %s.\n' % mne.__version__)
+
+        print(mne)
+
+    filelist = []
+
+    if args.filelist is not None:
+
+        fid = open(args.filelist)
+
+        filelist = fid.read().splitlines()
+
+        fid.close()
+
+    conn = None
+    if args.Catalog != '':
+
+        conn = open_catalog(args.Catalog)
+
+        # same file must have same path in catalog
+        filelist = [os.path.abspath(ff) for ff in filelist]
+
+    for prefix in args.PathPrefix:
+
+        if conn is not None and args.NoRefresh:
 
-print('MNE %s.\n' % mne.__version__)
+            filelist += catalog_files(conn, os.path.abspath(prefix))
 
-from mne.io import read_info
+        else:
 
-if not argv[1:]:
+            filelist += find_fiff_files(os.path.abspath(prefix))
 
-    exit()
+    if conn is None:
 
-print(mne)
+        transmats = read_transforms(filelist, args.NThreads, args.ReadInfo)
 
-parser = argparse.ArgumentParser(description='Determine average MEG sensor array across fiff-files.')
+    else:
 
-parser.add_argument('--filelist', help='Text file with one fiff-file per line.')
+        transmats = catalog_transforms(conn, filelist, args.NThreads,
+                                       refresh=not args.NoRefresh)
 
-args = parser.parse_args()
+        conn.close()
 
-fid = open(args.filelist)
+    if args.Mode == 'full':
 
-filelist = fid.read().splitlines()
+        print_medoid(filelist, transmats, args)
 
-fid.close()
+        return
 
-# list with origins per file
-coors = []
+    # list with origins per file
+    coors = []
 
-for file in filelist:
+    for [file, transmat] in zip(filelist, transmats):
 
-    print(file)
+        print(file)
 
-    info = read_info(file)
+        # 4th column is device coordinate origin in head coordinates.
+        # https://mail.nmr.mgh.harvard.edu/pipermail//mne_analysis/2008-September/000092.html
+        coor = -1000.*transmat[0:3,3] # mm and "-", compatible with "HPI fit" on screen during recording
+        print('%.1f %.1f %.1f\n' % (coor[0], coor[1], coor[2]))
 
-    # 4th column is device coordinate origin in head coordinates.
-    # https://mail.nmr.mgh.harvard.edu/pipermail//mne_analysis/2008-September/000092.html
-    transmat = info['dev_head_t']['trans']
+        coors.append(coor)
 
-    coor = -1000.*transmat[0:3,3] # mm and "-", compatible with "HPI fit" on screen during recording
-    print('%.1f %.1f %.1f\n' % (coor[0], coor[1], coor[2]))
+    # mean coordinate
+    coor_m = mean(coors, axis=0)
 
-    coors.append(coor)
+    # Euclidean distance from mean per subject
+    diffs = sum((coors - coor_m)**2, axis=1)**0.5
 
+    # Find minimum and maximum
+    min_idx, min_val = diffs.argmin(), diffs.min()
+    max_idx, max_val = diffs.argmax(), diffs.max()
 
-# mean coordinate
-coor_m = mean(coors, axis=0)
+    # Output indices starting with 1
 
-# Euclidean distance from mean per subject
-diffs = sum((coors - coor_m)**2, axis=1)**0.5
+    for [di,dd] in enumerate(diffs):
 
-# Find minimum and maximum
-min_idx, min_val = diffs.argmin(), diffs.min()
-max_idx, max_val = diffs.argmax(), diffs.max()
+        print('Subject %d: Dev %.1fmm (%.1f %.1f %.1f)\n' % (di+1, dd, coors[di][0], coors[di][1], coors[di][2]))
 
-# Output indices starting with 1
+    print('Average coordinate (mm): %.1f %.1f %.1f\n' % (coor_m[0], coor_m[1], coor_m[2]))
 
-for [di,dd] in enumerate(diffs):
+    print('Most average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[min_idx][0], coors[min_idx][1], coors[min_idx][2]))
 
-    print('Subject %d: Dev %.1fmm (%.1f %.1f %.1f)\n' % (di+1, dd, coors[di][0], coors[di][1], coors[di][2]))
+    print('Least average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[max_idx][0], coors[max_idx][1], coors[max_idx][2]))
 
-print('Average coordinate (mm): %.1f %.1f %.1f\n' % (coor_m[0], coor_m[1], coor_m[2]))
+    print('#########################################################################')
+    print('The MOST AVERAGE subject is #%d (dev %.1fmm): %s.' % (min_idx+1, min_val, filelist[min_idx]))
+    print('#########################################################################')
 
-print('Most average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[min_idx][0], coors[min_idx][1], coors[min_idx][2]))
+    print('For comparison, the least average subject is #%d (dev %.1fmm): %s.\n' % (max_idx+1, max_val, filelist[max_idx]))
 
-print('Least average subject coordinate (mm): %.1f %.1f %.1f\n' % (coors[max_idx][0], coors[max_idx][1], coors[max_idx][2]))
 
-print('#########################################################################')
-print('The MOST AVERAGE subject is #%d (dev %.1fmm): %s.' % (min_idx+1, min_val, filelist[min_idx]))
-print('#########################################################################')
+if __name__ == '__main__':
 
-print('For comparison, the least average subject is #%d (dev %.1fmm): %s.\n' % (max_idx+1, max_val, filelist[max_idx]))
+    main()
 
-# Done
\ No newline at end of file
+# Done
@@ -0,0 +1,57 @@
+#!/imaging/local/software/miniconda/envs/mne0.18/bin/python
+"""
+==================================================================================
+Single entry point for the EMEG utilities:
+EMEG.py <command> [options]
+
+Commands:
+compute-ica       Fiff_Compute_ICA.py
+ica-report        Fiff_ICA_Report.py
+apply-ica         Fiff_Apply_ICA.py
+head-positions    Fiff_HeadPositions.py
+average-sensors   AverageSensorArray.py
+anonymise         Anonymise_Fiff.py
+
+For the options of a command, type e.g. EMEG.py compute-ica -h.
+Only the module of the command is imported, and MNE-Python and matplotlib
+only when the command needs them, so that help messages and jobs that only
+read file headers start quickly.
+==================================================================================
+"""
+
+import importlib
+from sys import argv, exit
+
+# command: module (in this directory)
+COMMANDS = {'compute-ica': 'Fiff_Compute_ICA',
+            'ica-report': 'Fiff_ICA_Report',
+            'apply-ica': 'Fiff_Apply_ICA',
+            'head-positions': 'Fiff_HeadPositions',
+            'average-sensors': 'AverageSensorArray',
+            'anonymise': 'Anonymise_Fiff'}
+
+
+def main(argv_in=None):
+    """Run main() of the command's module with the remaining arguments."""
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == [] or argv_in[0] in ('-h', '--help'):
+
+        print(__doc__)
+        exit(0 if argv_in != [] else 1)
+
+    if argv_in[0] not in COMMANDS:
+
+        print(__doc__)
+        print('Unknown command: %s' % argv_in[0])
+        exit(2)
+
+    module = importlib.import_module(COMMANDS[argv_in[0]])
+
+    return module.main(argv_in[1:])
+
+
+if __name__ == '__main__':
+
+    main()
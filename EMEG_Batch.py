@@ -0,0 +1,152 @@
+"""
+==================================================================================
+Helper functions to run EMEG utilities over many files.
+Used by the batch modes of the scripts in this directory, e.g.
+Fiff_Compute_ICA.py --FileList files.txt --NJobs 8 --NThreads 2
+Failures for individual files are collected and summarised at the end,
+rather than aborting the whole batch.
+==================================================================================
+"""
+
+import os
+import glob
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# environment variables that control the number of BLAS/OpenMP threads
+THREAD_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+               'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def limit_threads(n_threads):
+    """Cap the number of BLAS/OpenMP threads in this process.
+
+    The environment variables only take effect for libraries that have not
+    been loaded yet, therefore this is called before workers are started.
+    If threadpoolctl is available, already loaded libraries are limited too.
+    """
+    for var in THREAD_VARS:
+
+        os.environ[var] = str(n_threads)
+
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+
+    threadpool_limits(n_threads)
+
+
+def get_filelist(filelist='', patterns=[]):
+    """Collect filenames from text file (one per line) and glob patterns."""
+    files = []
+
+    if filelist != '':
+
+        with open(filelist) as fid:
+
+            files += [ff.strip() for ff in fid.read().splitlines()
+                      if ff.strip() != '']
+
+    for pattern in patterns:
+
+        files += sorted(glob.glob(pattern))
+
+    return files
+
+
+def _run_task(func, item, args):
+    """Run one task and catch its exception."""
+    try:
+        return item, func(item, *args), None
+    except Exception:
+        return item, None, traceback.format_exc()
+
+
+def run_batch(func, items, args=(), n_jobs=1, n_threads=1, on_result=None):
+    """Run func(item, *args) for all items, in a process pool if n_jobs > 1.
+
+    func must be defined at module level, so that it can be sent to worker
+    processes. Workers are spawned (not forked) and have their number of
+    BLAS threads capped at n_threads, so that n_jobs workers do not
+    oversubscribe the cores.
+
+    on_result(item, result, error) is called in this process whenever a task
+    has finished, e.g. to record results before the whole batch is done.
+
+    Returns list of (item, result, error) in the order of items, where error
+    is None or the traceback of the exception raised for this item.
+    """
+    results = [None] * len(items)
+
+    if n_jobs == 1:
+
+        for [ii, item] in enumerate(items):
+
+            results[ii] = _run_task(func, item, args)
+
+            if on_result is not None:
+                on_result(*results[ii])
+
+        return results
+
+    # environment is inherited by spawned workers before they import numpy
+    env_ori = {var: os.environ.get(var) for var in THREAD_VARS}
+    for var in THREAD_VARS:
+
+        os.environ[var] = str(n_threads)
+
+    ctx = multiprocessing.get_context('spawn')
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_jobs, mp_context=ctx,
+                                 initializer=limit_threads,
+                                 initargs=(n_threads,)) as pool:
+
+            futures = {pool.submit(_run_task, func, item, args): ii
+                       for [ii, item] in enumerate(items)}
+
+            for [n_done, future] in enumerate(as_completed(futures), 1):
+
+                ii = futures[future]
+
+                try:
+                    results[ii] = future.result()
+                except Exception:  # e.g. worker killed by out-of-memory
+                    results[ii] = (items[ii], None, traceback.format_exc())
+
+                if on_result is not None:
+                    on_result(*results[ii])
+
+                print('###\nFinished %d of %d: %s' % (n_done, len(items),
+                                                      items[ii]))
+
+    finally:
+        # restore thread settings of this process
+        for [var, val] in env_ori.items():
+
+            if val is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = val
+
+    return results
+
+
+def print_summary(results, title='Batch'):
+    """Print number of successful and failed tasks, with errors."""
+    failed = [rr for rr in results if rr[2] is not None]
+
+    print('\n#########################################################################')
+    print('%s summary: %d of %d succeeded, %d failed.' %
+          (title, len(results) - len(failed), len(results), len(failed)))
+
+    for [item, _, error] in failed:
+
+        # last line of traceback is the exception message
+        print('FAILED: %s\n    %s' % (item, error.strip().splitlines()[-1]))
+
+    print('#########################################################################\n')
+
+    return failed
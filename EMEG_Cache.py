@@ -0,0 +1,124 @@
+"""
+==================================================================================
+Helper functions for the on-disk caches of the EMEG utilities.
+Cache entries are addressed by a hash of the input file's identity
+(path, size, modification time) and of all parameters that affect the result.
+Each entry consists of one or more files starting with its key.
+The least recently used entries are removed when the cache exceeds its limits.
+==================================================================================
+"""
+
+import os
+import json
+import hashlib
+
+
+def file_identity(fname):
+    """Identity of a file without reading its content."""
+    st = os.stat(fname)
+
+    return {'path': os.path.realpath(fname), 'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns}
+
+
+def file_sha1(fname, chunk=2 ** 20):
+    """SHA1 hash of file content (use for small files only)."""
+    sha = hashlib.sha1()
+
+    with open(fname, 'rb') as fid:
+
+        for data in iter(lambda: fid.read(chunk), b''):
+
+            sha.update(data)
+
+    return sha.hexdigest()
+
+
+def cache_key(*parts):
+    """Hash of JSON-serialisable parts (file identities, parameters)."""
+    txt = json.dumps(parts, sort_keys=True, default=str)
+
+    return hashlib.sha1(txt.encode('utf-8')).hexdigest()
+
+
+def cache_path(cache_dir, key, suffix):
+    """Filename of entry key with suffix (e.g. '-ica.fif') in cache_dir."""
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return os.path.join(cache_dir, key + suffix)
+
+
+def cache_get(cache_dir, key, suffix):
+    """Filename of existing entry, or None. Marks the entry as used."""
+    fname = os.path.join(cache_dir, key + suffix)
+
+    if not os.path.exists(fname):
+
+        return None
+
+    # modification time serves as time of last use for LRU eviction
+    os.utime(fname)
+
+    return fname
+
+
+def _entries(cache_dir):
+    """Size and time of last use per cache key."""
+    entries = {}
+
+    for entry in os.scandir(cache_dir):
+
+        if not entry.is_file():
+
+            continue
+
+        # keys are hex digests, suffixes start with '-' or '.'
+        key = entry.name[:40]
+        st = entry.stat()
+
+        size, used = entries.get(key, (0, 0))
+        entries[key] = (size + st.st_size, max(used, st.st_mtime))
+
+    return entries
+
+
+def cache_evict(cache_dir, max_gb=None, max_entries=None):
+    """Remove least recently used entries until cache is within limits."""
+    if not os.path.isdir(cache_dir):
+
+        return []
+
+    entries = _entries(cache_dir)
+
+    # oldest first
+    keys = sorted(entries, key=lambda kk: entries[kk][1])
+
+    total = sum(ee[0] for ee in entries.values())
+
+    max_bytes = None if max_gb is None else max_gb * 1e9
+
+    removed = []
+    for key in keys:
+
+        too_big = max_bytes is not None and total > max_bytes
+        too_many = (max_entries is not None and
+                    len(entries) - len(removed) > max_entries)
+
+        if not (too_big or too_many):
+
+            break
+
+        for entry in os.scandir(cache_dir):
+
+            if entry.name.startswith(key):
+
+                os.remove(entry.path)
+
+        total -= entries[key][0]
+        removed.append(key)
+
+    if removed != []:
+
+        print('Removed %d entries from cache %s.' % (len(removed), cache_dir))
+
+    return removed
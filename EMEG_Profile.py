@@ -0,0 +1,161 @@
+"""
+==================================================================================
+Optional profiling of processing stages of the EMEG utilities.
+Stages are marked in the code with
+    with EMEG_Profile.stage('fit'):
+        ica.fit(...)
+When profiling is enabled (e.g. Fiff_Compute_ICA.py --Profile prof.jsonl),
+wall time, CPU time and peak memory of every stage are appended as one JSON
+object per line to the profile file, which can be shared by many jobs.
+Peak memory is the process's maximum resident set size (RSS) at the end of
+the stage and its increase during the stage, and optionally the peak of
+Python memory allocations during the stage (tracemalloc, slower, Python 3.9
+or later, stages should not be nested).
+When profiling is disabled, stages do nothing.
+Tools record their stages within
+    with EMEG_Profile.profiling(args.Profile, ...):
+which disables profiling for an empty filename and restores the previous
+settings afterwards, so later calls in the same process are not recorded.
+==================================================================================
+"""
+
+import os
+import json
+import time
+import socket
+import contextlib
+import resource
+import tracemalloc
+
+# profile file and information added to every record, None: disabled
+_settings = {'fname': None, 'tracemalloc': False, 'context': {}}
+
+
+def _max_rss_mb():
+    """Maximum resident set size of this process so far (MB)."""
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def enable(fname, use_tracemalloc=False, **context):
+    """Append records of stages to fname, with context (e.g. file=...)."""
+    _settings['fname'] = fname
+    _settings['tracemalloc'] = use_tracemalloc
+    _settings['context'] = dict(context, host=socket.gethostname())
+
+    if use_tracemalloc and not tracemalloc.is_tracing():
+
+        tracemalloc.start()
+
+
+def disable():
+    """Stop recording stages."""
+    _settings['fname'] = None
+
+    if tracemalloc.is_tracing():
+
+        tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def profiling(fname, use_tracemalloc=False, **context):
+    """Record stages within the with-block to fname, none if fname is ''."""
+    previous = dict(_settings)
+    was_tracing = tracemalloc.is_tracing()
+
+    if fname == '':
+
+        disable()
+
+    else:
+
+        enable(fname, use_tracemalloc, **context)
+
+    try:
+        yield
+
+    finally:
+        _settings.update(previous)
+
+        if tracemalloc.is_tracing() and not was_tracing:
+
+            tracemalloc.stop()
+
+        elif was_tracing and not tracemalloc.is_tracing():
+
+            tracemalloc.start()
+
+
+def enabled():
+    """Whether stages are recorded."""
+    return _settings['fname'] is not None
+
+
+class _Stage:
+    """Records one stage when used as context manager."""
+
+    def __init__(self, name):
+
+        self.name = name
+
+    def __enter__(self):
+
+        self.rss = _max_rss_mb()
+
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+
+            tracemalloc.reset_peak()
+
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc):
+
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+
+        rss = _max_rss_mb()
+
+        record = dict(_settings['context'], stage=self.name, pid=os.getpid(),
+                      time=time.time(), wall_s=round(wall, 4),
+                      cpu_s=round(cpu, 4), max_rss_mb=round(rss, 1),
+                      rss_increase_mb=round(rss - self.rss, 1),
+                      failed=exc[0] is not None)
+
+        if tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak'):
+
+            record['tracemalloc_peak_mb'] = round(
+                tracemalloc.get_traced_memory()[1] / 1e6, 1)
+
+        # one short line per write, lines of parallel jobs don't mix
+        with open(_settings['fname'], 'a') as fid:
+
+            fid.write(json.dumps(record) + '\n')
+
+        return False
+
+
+class _NoStage:
+    """Does nothing when used as context manager."""
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        return False
+
+
+_no_stage = _NoStage()
+
+
+def stage(name):
+    """Context manager that records stage name if profiling is enabled."""
+    if _settings['fname'] is None:
+
+        return _no_stage
+
+    return _Stage(name)
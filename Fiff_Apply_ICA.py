@@ -4,6 +4,21 @@
 Apply pre-computed ICA to EEG/MEG data in fiff-format to remove eye-movement
 artefacts.
 Requires ICA decomposition from Fiff_Compute_ICA.py.
+ICA is applied as one precomputed matrix (cleaning operator), which is
+cached next to the ICA file (FileICA-op-<hash>.npz) for every set of
+components to be removed.
+Several sets of components can be removed from a single read of the
+raw data, e.g. --ICAcompsSet 0 1 --ICAcompsSet 0 1 5, which writes one
+output file per set (e.g. FileRawIn_ica-0-1_raw.fif, FileRawIn_ica-0-1-5_raw.fif).
+Many raw files can be processed in parallel with --FileList/--FileGlob.
+In this batch mode, a manifest records the inputs of every output file,
+and outputs whose raw file, ICA file and --ICAcomps did not change are
+skipped. The manifest is updated while files are processed.
+With --Stream, the raw data are memory-mapped to a temporary file and
+cleaned in blocks of --BlockSec seconds, so that memory use does not grow
+with the length of the recording.
+With --Profile, time and memory of processing stages (read, apply, write)
+are recorded.
 For more help, type Fiff_Apply_ICA.py -h.
 Based on MNE-Python.
 For a tutorial on ICA in MNE-Python, look here:
@@ -13,86 +28,533 @@ https://martinos.org/mne/stable/auto_tutorials/preprocessing/plot_artifacts_corr
 # Olaf Hauk, Python 3, July 2019, Feb 2020
 
 from sys import argv, exit
+import os
 import argparse
+import json
+import tempfile
 
-import mne
+import numpy as np
 
-print(__doc__)
+# mne is imported where needed, to start quickly
 
-print('MNE %s.\n' % mne.__version__)
+import EMEG_Batch
+import EMEG_Cache
+import EMEG_Profile
 
-if len(argv) == 1:
-    # display help message when no args are passed.
-    exit(1)
+# number of finished raw files after which the manifest is written (batch mode)
+manifest_batch = 10
 
 ###
 # PARSE INPUT ARGUMENTS
 ###
 
-parser = argparse.ArgumentParser(description='Apply ICA.')
 
-parser.add_argument('--FileRawIn', help='Input filename for raw data.')
-parser.add_argument('--FileICA', help='Output file for ICA decomposition (default FileRawIn-ica.fif).', default='')
-parser.add_argument('--FileRawOut', help='Output filename for raw data (default FileRawIn_ica_raw.fif).', default='')
-parser.add_argument('--ICAcomps', help='ICA components to remove (default: as specified in precomputed ICA).', nargs='+', type=int, default=[])
+def get_parser():
+    """Argument parser for Fiff_Apply_ICA."""
+    parser = argparse.ArgumentParser(description='Apply ICA.')
 
-args = parser.parse_args()
+    parser.add_argument('--FileRawIn', help='Input filename for raw data.')
+    parser.add_argument('--FileICA', help='Output file for ICA decomposition (default FileRawIn-ica.fif).', default='')
+    parser.add_argument('--FileRawOut', help='Output filename for raw data (default FileRawIn_ica_raw.fif).', default='')
+    parser.add_argument('--ICAcomps', help='ICA components to remove (default: as specified in precomputed ICA).', nargs='+', type=int, default=[])
+
+    parser.add_argument('--ICAcompsSet', help='Set of ICA components to remove, can be repeated to write several '
+                        'cleaned versions of the raw data from one read (replaces --ICAcomps). Output filenames '
+                        'get the components appended to FileRawOut.', nargs='+', type=int, action='append',
+                        default=[])
+
+    parser.add_argument('--Float32', help='Apply cleaning operator in single precision. The error relative to '
+                        'double precision is bounded by about n_channels * 6e-8 times the magnitude of the '
+                        'data (worst case, typically much smaller).', action='store_true')
+
+    parser.add_argument('--Stream', help='Clean data block by block from a memory-mapped temporary file, '
+                        'instead of holding the whole recording in memory.', action='store_true')
+    parser.add_argument('--BlockSec', help='Length of blocks in seconds to which ICA is applied (default 60).', type=float, default=60.)
+    parser.add_argument('--TmpDir', help='Stream mode: directory for temporary memory-mapped file '
+                        '(default: system temporary directory).', default='')
+
+    parser.add_argument('--FileList', help='Batch mode: text file with one raw file per line. '
+                        'Output filenames are derived from the raw filenames.', default='')
+    parser.add_argument('--FileGlob', help='Batch mode: glob pattern(s) for raw files (use quotes).', nargs='+', default=[])
+    parser.add_argument('--NJobs', help='Batch mode: number of files processed in parallel (default 1).', type=int, default=1)
+    parser.add_argument('--NThreads', help='Batch mode: number of BLAS threads per worker (default 1).', type=int, default=1)
+    parser.add_argument('--Manifest', help='Batch mode: file that records inputs and outputs per raw file '
+                        '(default Fiff_Apply_ICA-manifest.json in current directory).',
+                        default='Fiff_Apply_ICA-manifest.json')
+    parser.add_argument('--Force', help='Batch mode: rebuild outputs even if they are up to date.', action='store_true')
+
+    parser.add_argument('--Profile', help='Append time and memory per processing stage to this JSON-lines file '
+                        '(default: no profiling).', default='')
+    parser.add_argument('--ProfileTracemalloc', help='With --Profile: also record peak Python allocations (slower).',
+                        action='store_true')
+
+    return parser
 
-print(mne)
 
 ###
 # create filenames
 ###
 
-# get filename stem for case with and without suffix .fif
-filestem = args.FileRawIn.split('.fif')[0]
+def get_filenames(file_raw_in, file_ica='', file_raw_out=''):
+    """Input and output filenames for one raw file."""
+    # get filename stem for case with and without suffix .fif
+    filestem = file_raw_in.split('.fif')[0]
+
+    # raw-filenames to be subjected to ICA for this subject
+    if file_raw_in[-4:] != '.fif':
+
+        raw_fname_in = filestem + '.fif'
+
+    else:
+
+        raw_fname_in = file_raw_in
+
+    # save raw with ICA applied and artefacts removed
+    if file_raw_out == '':
 
-# raw-filenames to be subjected to ICA for this subject
-if args.FileRawIn[-4:] != '.fif':
+        raw_fname_out = filestem + '_ica_raw.fif'
 
-    raw_fname_in = filestem + '.fif'
+    else:
 
-else:
+        raw_fname_out = file_raw_out
 
-    raw_fname_in = args.FileRawIn
+    # file with ICA decomposition
+    if file_ica == '':
 
-# save raw with ICA applied and artefacts removed
-if args.FileRawOut == '':
+        ica_fname_in = filestem + '-ica.fif'
 
-    raw_fname_out = filestem + '_ica_raw.fif'
+    else:
 
-else:
+        ica_fname_in = file_ica
 
-    raw_fname_out = args.FileRawOut
+    return raw_fname_in, ica_fname_in, raw_fname_out
 
-# file with ICA decomposition
-if args.FileICA == '':
 
-    ica_fname_in = filestem + '-ica.fif'
+def get_variant_filename(raw_fname_out, comps):
+    """Output filename for one set of removed components."""
+    if raw_fname_out.endswith('_raw.fif'):
 
-else:
+        stem, suffix = raw_fname_out[:-len('_raw.fif')], '_raw.fif'
+
+    else:
+
+        stem, suffix = raw_fname_out.split('.fif')[0], '.fif'
+
+    comps_str = '-'.join(str(cc) for cc in comps) or 'none'
+
+    return stem + '-' + comps_str + suffix
+
+
+def get_output_filenames(file_raw_in, args, file_raw_out=''):
+    """Output filenames for all sets of removed components."""
+    raw_fname_out = get_filenames(file_raw_in, file_raw_out=file_raw_out)[2]
+
+    if args.ICAcompsSet == []:
+
+        return [raw_fname_out]
+
+    return [get_variant_filename(raw_fname_out, comps)
+            for comps in args.ICAcompsSet]
+
+
+###
+# CLEANING OPERATOR
+###
+
+def get_operator(ica, ica_fname_in=None):
+    """Cleaning operator of ICA for the components in ica.exclude.
+
+    ica.apply() is affine for every sample, i.e. data_clean = matrix * data
+    + offset for the ICA channels. Matrix and offset are obtained by applying
+    the ICA to unit vectors and to zeros, respectively.
+    If ica_fname_in is given, the operator is cached next to the ICA file.
+    Returns matrix (n_channels, n_channels) and offset (n_channels,).
+    """
+    import mne
+
+    exclude = sorted(int(x) for x in ica.exclude)
+
+    fname_op = None
+    if ica_fname_in is not None:
+
+        key = EMEG_Cache.cache_key(EMEG_Cache.file_identity(ica_fname_in),
+                                   exclude, mne.__version__)
+
+        fname_op = ica_fname_in.split('.fif')[0] + '-op-%s.npz' % key[:12]
+
+        if os.path.exists(fname_op):
+
+            print('Reading cleaning operator from %s' % fname_op)
+            op = np.load(fname_op)
+
+            if list(op['ch_names']) == list(ica.ch_names):
+
+                return op['matrix'], op['offset']
+
+    print('Computing cleaning operator.')
+
+    n_chan = len(ica.ch_names)
+
+    # unit vectors as samples, plus one sample of zeros
+    probe = np.concatenate((np.eye(n_chan), np.zeros((n_chan, 1))), axis=1)
+
+    info = ica.info.copy()
+    info['bads'] = []
+    probe_raw = mne.io.RawArray(probe, info, verbose=False)
+
+    ica.apply(probe_raw)
+
+    probe = probe_raw.get_data()
+
+    offset = probe[:, -1]
+    matrix = probe[:, :-1] - offset[:, np.newaxis]
+
+    if fname_op is not None:
+
+        try:
+            np.savez(fname_op, matrix=matrix, offset=offset,
+                     ch_names=np.array(ica.ch_names), exclude=exclude)
+            print('Cleaning operator saved to %s' % fname_op)
+        except OSError:
+            print('Could not save cleaning operator to %s' % fname_op)
+
+    return matrix, offset
+
+
+def apply_operator(raw, picks, matrix, offset, block, float32=False,
+                   data_in=None):
+    """Apply cleaning operator to channels picks of raw, block by block.
+
+    If data_in (n_picks, n_times) is specified, data are taken from data_in
+    instead of raw, e.g. to keep the original data for several operators.
+    """
+    if float32:
+
+        matrix = matrix.astype(np.float32)
+        offset = offset.astype(np.float32)
+
+    for start in range(0, raw.n_times, block):
+
+        stop = min(start + block, raw.n_times)
+
+        if data_in is None:
+
+            data = raw[picks, start:stop][0]
+
+        else:
+
+            data = np.array(data_in[:, start:stop])
+
+        if float32:
+
+            data = data.astype(np.float32)
+
+        # one matrix product per block
+        data = matrix.dot(data)
+        data += offset[:, np.newaxis]
+
+        raw[picks, start:stop] = data
 
-    ica_fname_in = args.FileICA
 
 ###
 # APPLY ICA
 ###
 
-print('Reading raw file %s' % raw_fname_in)
-raw = mne.io.read_raw_fif(raw_fname_in, preload=True)
+def apply_ica(file_raw_in, args=None, file_ica='', file_raw_out=''):
+    """Apply ICA to one raw file and save cleaned raw data.
+
+    args: namespace as returned by get_parser().parse_args(), default
+    values are used if None.
+    The raw data are read only once, also for several sets of components
+    in args.ICAcompsSet.
+    Returns list of output filenames.
+    """
+    if args is None:
+
+        args = get_parser().parse_args([])
+
+    # stages of this call only, --Profile of earlier calls does not persist
+    with EMEG_Profile.profiling(args.Profile, args.ProfileTracemalloc,
+                                script='Fiff_Apply_ICA',
+                                file=get_filenames(file_raw_in)[0]):
+
+        return _apply_ica(file_raw_in, args, file_ica, file_raw_out)
+
+
+def _apply_ica(file_raw_in, args, file_ica, file_raw_out):
+    """Body of apply_ica, within its profiling settings."""
+    import mne
+
+    raw_fname_in, ica_fname_in, _ = get_filenames(file_raw_in, file_ica,
+                                                  file_raw_out)
+
+    raw_fnames_out = get_output_filenames(file_raw_in, args, file_raw_out)
+
+    print('Reading ICA file %s' % ica_fname_in)
+    with EMEG_Profile.stage('read'):
+
+        ica = mne.preprocessing.read_ica(ica_fname_in)
+
+    if args.ICAcompsSet != []:
+
+        comps_sets = args.ICAcompsSet
+
+    # if ICA components to be removed specified on command line
+    elif args.ICAcomps != []:
+
+        comps_sets = [args.ICAcomps]
+
+    else:
+
+        comps_sets = [ica.exclude]
+
+    tmp_dir = args.TmpDir or tempfile.gettempdir()
+
+    fname_mmap, fname_orig = None, None
+    if args.Stream:
+
+        fid, fname_mmap = tempfile.mkstemp(suffix='.dat', prefix='ica_raw_',
+                                           dir=tmp_dir)
+        os.close(fid)
+
+        print('Reading raw file %s into memory-mapped file %s' %
+              (raw_fname_in, fname_mmap))
+
+    else:
+
+        print('Reading raw file %s' % raw_fname_in)
+
+    try:
+        with EMEG_Profile.stage('read'):
+
+            raw = mne.io.read_raw_fif(raw_fname_in, preload=fname_mmap if
+                                      args.Stream else True)
+
+        # same channels as used by ica.apply()
+        picks = mne.pick_types(raw.info, meg=False, include=ica.ch_names,
+                               exclude='bads', ref_meg=False)
+
+        if [raw.ch_names[pp] for pp in picks] != list(ica.ch_names):
+
+            raise ValueError('Channels in raw file %s do not match channels '
+                             'of ICA %s.' % (raw_fname_in, ica_fname_in))
+
+        # only one block of data is processed at any time
+        block = int(round(args.BlockSec * raw.info['sfreq']))
+
+        data_orig = None
+        if len(comps_sets) > 1:
+
+            # keep uncleaned data of ICA channels for all sets of components
+            if args.Stream:
+
+                fid, fname_orig = tempfile.mkstemp(suffix='.dat',
+                                                   prefix='ica_orig_',
+                                                   dir=tmp_dir)
+                os.close(fid)
+                data_orig = np.memmap(fname_orig, dtype=np.float64, mode='w+',
+                                      shape=(len(picks), raw.n_times))
+
+                for start in range(0, raw.n_times, block):
+
+                    data_orig[:, start:start + block] = \
+                        raw[picks, start:start + block][0]
+
+            else:
+
+                data_orig = raw[picks, :][0]
+
+        for [comps, raw_fname_out] in zip(comps_sets, raw_fnames_out):
+
+            ica.exclude = list(comps)
+
+            print('Applying ICA to raw file, removing components:')
+            print(' '.join(str(x) for x in ica.exclude))
+
+            with EMEG_Profile.stage('apply'):
+
+                matrix, offset = get_operator(ica, ica_fname_in)
+
+                apply_operator(raw, picks, matrix, offset, block,
+                               args.Float32, data_in=data_orig)
+
+            # data are written in buffers (and split files if necessary)
+            print('Saving raw file with ICA applied to %s' % raw_fname_out)
+            with EMEG_Profile.stage('write'):
+
+                raw.save(raw_fname_out, overwrite=True)
+
+    finally:
+        raw, data_orig = None, None
+
+        for fname in [fname_mmap, fname_orig]:
+
+            if fname is not None:
+
+                os.remove(fname)
+
+    return raw_fnames_out
+
+
+###
+# BATCH MODE
+###
+
+def _inputs_record(raw_fname_in, ica_fname_in, args):
+    """Everything an output file depends on."""
+    # raw files are too big to hash their content, use size and time instead
+    return {'raw': EMEG_Cache.file_identity(raw_fname_in),
+            'ica': EMEG_Cache.file_sha1(ica_fname_in),
+            'ICAcomps': args.ICAcomps, 'ICAcompsSet': args.ICAcompsSet,
+            'Float32': args.Float32}
+
+
+def _apply_ica_batch(file_raw_in, args):
+    """Batch task for one raw file, returns inputs and output identity."""
+    raw_fname_in, ica_fname_in, _ = get_filenames(file_raw_in)
+
+    # record inputs before processing, in case they change meanwhile
+    inputs = _inputs_record(raw_fname_in, ica_fname_in, args)
+
+    raw_fnames_out = apply_ica(file_raw_in, args)
+
+    return {'inputs': inputs,
+            'outputs': [EMEG_Cache.file_identity(fname)
+                        for fname in raw_fnames_out]}
+
+
+def _outputs_identity(raw_fnames_out):
+    """Identities of output files, None if any of them is missing."""
+    if not all(os.path.exists(fname) for fname in raw_fnames_out):
+
+        return None
+
+    return [EMEG_Cache.file_identity(fname) for fname in raw_fnames_out]
+
+
+def _write_manifest(manifest, fname):
+    """Write manifest to a temporary file, which then replaces fname."""
+    # replace manifest only when completely written
+    fname_tmp = fname + '.tmp'
+    with open(fname_tmp, 'w') as fid:
+
+        json.dump(manifest, fid, indent=1, sort_keys=True)
+
+    os.replace(fname_tmp, fname)
+
+
+def apply_ica_batch(files, args):
+    """Apply ICA to all raw files whose outputs are not up to date."""
+    manifest = {}
+    if os.path.exists(args.Manifest):
+
+        with open(args.Manifest) as fid:
+
+            manifest = json.load(fid)
+
+    todo, skipped = [], []
+    for file_raw_in in files:
+
+        raw_fname_in, ica_fname_in, _ = get_filenames(file_raw_in)
+        raw_fnames_out = get_output_filenames(file_raw_in, args)
+
+        entry = manifest.get(os.path.realpath(raw_fname_in))
+
+        try:
+            up_to_date = (not args.Force and entry is not None and
+                          entry['outputs'] == _outputs_identity(raw_fnames_out) and
+                          entry['inputs'] == _inputs_record(raw_fname_in,
+                                                            ica_fname_in, args))
+        except OSError:  # missing input, the task will report it
+            up_to_date = False
+
+        if up_to_date:
+
+            print('Up to date: %s' % ' '.join(raw_fnames_out))
+            skipped.append(file_raw_in)
+
+        else:
+
+            todo.append(file_raw_in)
+
+    print('###\nBatch mode: %d of %d outputs to build, %d workers.' %
+          (len(todo), len(files), args.NJobs))
+
+    if todo != []:
+
+        import mne
+
+        print('MNE %s.\n' % mne.__version__)
+
+    # results are recorded as they come in, an interrupted run keeps them
+    pending = []
+
+    def record(file_raw_in, result, error):
+
+        if result is not None:
+
+            raw_fname_in = get_filenames(file_raw_in)[0]
+            manifest[os.path.realpath(raw_fname_in)] = result
+            pending.append(file_raw_in)
+
+        if len(pending) >= manifest_batch:
+
+            _write_manifest(manifest, args.Manifest)
+            del pending[:]
+
+    results = EMEG_Batch.run_batch(_apply_ica_batch, todo, args=(args,),
+                                   n_jobs=args.NJobs, n_threads=args.NThreads,
+                                   on_result=record)
+
+    _write_manifest(manifest, args.Manifest)
+
+    failed = EMEG_Batch.print_summary(results, title='Fiff_Apply_ICA')
+
+    print('%d built, %d skipped (up to date), %d failed.\n' %
+          (len(results) - len(failed), len(skipped), len(failed)))
+
+    return failed
+
+
+def main(argv_in=None):
+
+    print(__doc__)
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == []:
+        # display help message when no args are passed.
+        exit(1)
+
+    args = get_parser().parse_args(argv_in)
+
+    files = EMEG_Batch.get_filelist(args.FileList, args.FileGlob)
+
+    if files == []:
+
+        import mne
+
+        print('MNE %s.\n' % mne.__version__)
+
+        print(mne)
+
+        apply_ica(args.FileRawIn, args, file_ica=args.FileICA,
+                  file_raw_out=args.FileRawOut)
+
+        return
+
+    if args.FileRawIn is not None:
+
+        files = [args.FileRawIn] + files
 
-print('Reading ICA file %s' % ica_fname_in)
-ica = mne.preprocessing.read_ica(ica_fname_in)
+    failed = apply_ica_batch(files, args)
 
-# if ICA components to be removed specified on command line
-if args.ICAcomps != []:
+    if failed != []:
 
-    ica.exclude = args.ICAcomps
+        exit(1)
 
-print('Applying ICA to raw file, removing components:')
-print(' '.join(str(x) for x in ica.exclude))
 
-ica.apply(raw)
+if __name__ == '__main__':
 
-print('Saving raw file with ICA applied to %s' % raw_fname_out)
-raw.save(raw_fname_out, overwrite=True)
+    main()
@@ -4,8 +4,27 @@
 Compute ICA decomposition for raw EEG/MEG data in fiff-format
 to remove eye- or heart-related artefacts.
 Components will be identified based on EOG or ECG channels, respectively.
-Results will be visualised in an HTML file.
+Results will be visualised in an HTML file (--Report full or lite), which
+can also be rendered later from the saved ICA and component scores (see
+Fiff_ICA_Report.py). Figures are rendered in --ReportJobs processes, which
+map the filtered data from the cache (with --CacheDir) instead of reading
+them again.
 By default, 1 component per channel (EOG and ECG) will be removed.
+Thresholds for EOG/ECG detection can be tuned with sweep mode
+(e.g. --EOGthreshSweep 2 2.5 3 3.5 4), which writes a table of the
+components selected for each setting.
+With --FitMaxSeconds, ICA is fitted on segments of the recording, and
+components are scored on blocks of the recording, which is not loaded as a
+whole (unless an ECG channel has to be derived from MEG channels).
+Several raw files can be processed in parallel with --FileList and/or
+--FileGlob (e.g. --FileGlob '/imaging/xy/meg/*/*_raw.fif' --NJobs 8).
+In batch mode, reports are rendered after all fits, in --NJobs processes
+(with --CacheDir, these map the data filtered for the fits).
+With --CacheDir, ICA fits and the high-pass filtered data are cached on
+disk, so that reruns with other ICA or EOG/ECG parameters neither read nor
+filter the raw data again.
+With --Profile, time and memory of processing stages (read, filter, fit,
+score, plot, write, report save) are recorded.
 For more help, type Fiff_Compute_ICA.py -h.
 Pre-requisite for Fiff_Apply_ICA.py.
 Based on MNE-Python.
@@ -15,411 +34,1499 @@ https://martinos.org/mne/stable/auto_tutorials/preprocessing/plot_artifacts_corr
 """
 # Olaf Hauk, Python 3, July 2019, Feb 2020
 
+from sys import argv, exit
+import os
+import csv
+import json
+import time
+import shutil
+import tempfile
+import resource
+import traceback
+import argparse
+
+import numpy as np
+
+# mne and matplotlib are imported where needed, to start quickly
+
+import EMEG_Batch
+import EMEG_Cache
+import EMEG_Profile
+
+# length of blocks for scoring with --FitMaxSeconds (s)
+score_block_seconds = 60.
+
 ###
 # PARSE INPUT ARGUMENTS
 ###
 
-from sys import argv, exit
-import argparse
 
-import numpy as np
+def get_parser():
+    """Argument parser for Fiff_Compute_ICA."""
+    parser = argparse.ArgumentParser(description='Compute ICA.')
+
+    parser.add_argument('--FileRaw', help='Input filename.')
+    parser.add_argument('--FileICA', help='Output file for ICA decomposition (default FileRaw-ica.fif).', default='')
+    parser.add_argument('--FileHTML', help='Output filename for HTML file with figures (default FileRaw_ica.html).', default='')
+    parser.add_argument('--EOG', help='EOG channel name(s) for correlations (e.g. EOG062, default none).', nargs='+', default=[])
+    parser.add_argument('--ECG', help='ECG channel name(s) for correlations (default none).', nargs='+', default=[])
+    parser.add_argument('--maxEOG', help='Maximum number of EOG components to remove (default 1).', type=int, default=1)
+    parser.add_argument('--maxECG', help='Maximum number of ECG components to remove (default 1, if --ECG not none).', type=int, default=1)
+
+    parser.add_argument('--ECGmeth', help='Method for ECG artefact detection (ctps|correlation).', default='ctps')
+    parser.add_argument('--EOGthresh', help='Threshold for z-score of EOG artefact detection.', type=float, default=3.)
+    parser.add_argument('--ECGthresh', help='Threshold for ECG artefact detection. Must accompany --ECGmeth.', type=float, default=0.25)
+
+    parser.add_argument('--ChanTypes', help='Which channel types to use (eeg|meg, default meg).', nargs='+', default=['meg'])
+    parser.add_argument('--RejEEG', help='Artefact threshold for EEG (uV, default 1e-3).', type=float, default=1e-3)
+    parser.add_argument('--RejGrad', help='Artefact threshold for Gradiometers (default 4e-10T/m).', type=float, default=4e-10)
+    parser.add_argument('--RejMag', help='Artefact threshold for Magnetometers (default 1e-11T).', type=float, default=1e-11)
+    parser.add_argument('--n_pca_comps', help='Number of components or explained fraction for pre-ICA PCA (default: 0.99).', type=str, default='0.99')
+    parser.add_argument('--method', help='Method for ICA decomposition (fastica|infomax|picard, default fastica).', type=str, default='fastica')
+
+    parser.add_argument('--EOGthreshSweep', help='Sweep mode: list of EOG thresholds to evaluate. '
+                        'No ICA or HTML file will be written, only a table of selected components.',
+                        nargs='+', type=float, default=[])
+    parser.add_argument('--ECGthreshSweep', help='Sweep mode: list of ECG thresholds to evaluate.', nargs='+', type=float, default=[])
+    parser.add_argument('--maxEOGSweep', help='Sweep mode: list of maximum numbers of EOG components.', nargs='+', type=int, default=[])
+    parser.add_argument('--maxECGSweep', help='Sweep mode: list of maximum numbers of ECG components.', nargs='+', type=int, default=[])
+    parser.add_argument('--FileSweep', help='Sweep mode: output CSV file (default FileRaw-ica-sweep.csv).', default='')
+
+    parser.add_argument('--FitMaxSeconds', help='Fit ICA on at most this many seconds of data, taken from evenly '
+                        'spaced segments across the recording (default 0: use all data). EOG/ECG '
+                        'components are still scored on the full recording, read block by block.', type=float, default=0.)
+    parser.add_argument('--FitSegSeconds', help='Length of segments for --FitMaxSeconds (default 10s).', type=float, default=10.)
+
+    parser.add_argument('--CacheDir', help='Directory for cached ICA fits and high-pass filtered data (default: '
+                        'no caching). A rerun with changed EOG/ECG detection parameters only will reuse the fit, '
+                        'a rerun with changed ICA parameters will reuse the filtered data.', default='')
+    parser.add_argument('--CacheMaxGB', help='Maximum size of cache in GB (default 50, filtered data take about '
+                        '8 bytes per channel and sample).', type=float, default=50.)
+    parser.add_argument('--CacheMaxEntries', help='Maximum number of cached fits and filtered data sets '
+                        '(default 500).', type=int, default=500)
+
+    parser.add_argument('--FileList', help='Batch mode: text file with one raw file per line. '
+                        'Output filenames are derived from the raw filenames.', default='')
+    parser.add_argument('--FileGlob', help='Batch mode: glob pattern(s) for raw files (use quotes).', nargs='+', default=[])
+    parser.add_argument('--NJobs', help='Batch mode: number of subjects processed in parallel (default 1).', type=int, default=1)
+    parser.add_argument('--NThreads', help='Batch mode: number of BLAS threads per worker (default 1).', type=int, default=1)
+
+    parser.add_argument('--Report', help='HTML report: none (only ICA and scores are saved), lite (component '
+                        'maps and scores as thumbnails) or full (default full). The report can be rendered later '
+                        'with Fiff_ICA_Report.py.', choices=['none', 'lite', 'full'], default='full')
+    parser.add_argument('--ReportJobs', help='Number of processes rendering report figures (default 1). Batch '
+                        'mode: reports are rendered after all fits in --NJobs processes.', type=int, default=1)
+
+    parser.add_argument('--Profile', help='Append time and memory per processing stage to this JSON-lines file '
+                        '(default: no profiling).', default='')
+    parser.add_argument('--ProfileTracemalloc', help='With --Profile: also record peak Python allocations (slower).',
+                        action='store_true')
+
+    return parser
+
+
+def get_filenames(file_raw, file_ica='', file_html=''):
+    """Input and output filenames for one raw file."""
+    # get filename stem for case with and without suffix .fif
+    filestem = file_raw.split('.fif')[0]
+
+    # raw data input filename
+    if file_raw[-4:] != '.fif':
+
+        raw_fname_in = file_raw + '.fif'
+
+    else:
 
-import matplotlib.pyplot as plt
+        raw_fname_in = file_raw
 
-import mne
-from mne.preprocessing import ICA, create_eog_epochs, create_ecg_epochs
-from mne.report import Report
+    # filename for ICA output
+    if file_ica == '':
 
-parser = argparse.ArgumentParser(description='Compute ICA.')
+        ica_fname_out = filestem + '-ica.fif'
 
-parser.add_argument('--FileRaw', help='Input filename.')
-parser.add_argument('--FileICA', help='Output file for ICA decomposition (default FileRaw-ica.fif).', default='')
-parser.add_argument('--FileHTML', help='Output filename for HTML file with figures (default FileRaw_ica.html).', default='')
-parser.add_argument('--EOG', help='EOG channel name(s) for correlations (e.g. EOG062, default none).', nargs='+', default=[])
-parser.add_argument('--ECG', help='ECG channel name(s) for correlations (default none).', nargs='+', default=[])
-parser.add_argument('--maxEOG', help='Maximum number of EOG components to remove (default 1).', type=int, default=1)
-parser.add_argument('--maxECG', help='Maximum number of ECG components to remove (default 1, if --ECG not none).', type=int, default=1)
+    else:
 
-parser.add_argument('--ECGmeth', help='Method for ECG artefact detection (ctps|correlation).', default='ctps')
-parser.add_argument('--EOGthresh', help='Threshold for z-score of EOG artefact detection.', type=float, default=3.)
-parser.add_argument('--ECGthresh', help='Threshold for ECG artefact detection. Must accompany --ECGmeth.', type=float, default=0.25)
+        ica_fname_out = file_ica
 
-parser.add_argument('--ChanTypes', help='Which channel types to use (eeg|meg, default meg).', nargs='+', default=['meg'])
-parser.add_argument('--RejEEG', help='Artefact threshold for EEG (uV, default 1e-3).', type=float, default=1e-3)
-parser.add_argument('--RejGrad', help='Artefact threshold for Gradiometers (default 4e-10T/m).', type=float, default=4e-10)
-parser.add_argument('--RejMag', help='Artefact threshold for Magnetometers (default 1e-11T).', type=float, default=1e-11)
-parser.add_argument('--n_pca_comps', help='Number of components or explained fraction for pre-ICA PCA (default: 0.99).', type=str, default='0.99')
-parser.add_argument('--method', help='Method for ICA decomposition (fastica|infomax|picard, default fastica).', type=str, default='fastica')
+    # filename for ICA output
+    if file_html == '':
 
-args = parser.parse_args()
+        fname_html = filestem + '-ica.html'
 
-print('MNE %s.\n' % mne.__version__)
+    else:
 
-if len(argv) == 1:
-    # display help message when no args are passed.
-    exit(1)
+        fname_html = file_html
 
-print(mne)
+    return raw_fname_in, ica_fname_out, fname_html
 
-###
-# ANALAYSIS PARAMETERS
-###
 
-# epoch length
-tmin, tmax = -0.2, 0.2
+def _cache_ica_fit(ica, args, fit_key):
+    """Save fitted ICA (without excluded components) to the fit cache."""
+    fname_cache = EMEG_Cache.cache_path(args.CacheDir, fit_key, '-ica.fif')
 
-if '.' in args.n_pca_comps:
-    # if float, select n_components by explained variance of PCA
-    n_components = float(args.n_pca_comps)
-    print('Number of PCA components by fraction of variance (%f)' %
-          n_components)
+    # write to temporary file first, parallel jobs may read the same entry
+    fname_tmp = fname_cache[:-len('-ica.fif')] + '-%d-ica.fif' % os.getpid()
 
-else:
+    print('Saving ICA fit to cache %s.' % fname_cache)
+    ica.save(fname_tmp)
+    os.replace(fname_tmp, fname_cache)
 
-    n_components = int(args.n_pca_comps)
-    print('Number of PCA components: %d.' % n_components)
+    EMEG_Cache.cache_evict(args.CacheDir, max_gb=args.CacheMaxGB,
+                           max_entries=args.CacheMaxEntries)
 
-method = args.method  # for comparison with EEGLAB try "extended-infomax" here
-print('\nUsing ICA method %s.' % method)
 
-decim = 3  # downsample data to save time
+def _find_outliers_grid(scores, thresholds, max_iter=2):
+    """Iterative z-score outlier detection for many thresholds at once.
 
-# same random state for each ICA (not sure if beneficial?)
-random_state = 23
+    Same procedure as used by ica.find_bads_eog() (and find_bads_ecg() with
+    method 'correlation'), vectorised across thresholds.
+    Returns boolean array (n_thresholds, n_components).
+    """
+    scores = np.asarray(scores, dtype=float)[np.newaxis, :]
+    thresholds = np.asarray(thresholds, dtype=float)[:, np.newaxis]
 
-# whether to plot on screen or only to html
-show = False
+    bad = np.zeros((thresholds.shape[0], scores.shape[1]), dtype=bool)
+    active = np.ones(thresholds.shape[0], dtype=bool)  # still iterating
 
-# get filename stem for case with and without suffix .fif
-filestem = args.FileRaw.split('.fif')[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
 
-# raw data input filename
-if args.FileRaw[-4:] != '.fif':
+        for _ in range(max_iter):
 
-    raw_fname_in = args.FileRaw + '.fif'
+            # z-scores among components not yet found to be bad
+            keep = ~bad
+            n_keep = keep.sum(axis=1, keepdims=True)
+            mean = (scores * keep).sum(axis=1, keepdims=True) / n_keep
+            std = np.sqrt((((scores - mean) ** 2) * keep).sum(
+                axis=1, keepdims=True) / n_keep)
+            zs = np.abs(scores - mean) / std
 
-else:
+            local_bad = (zs > thresholds) & keep & active[:, np.newaxis]
 
-    raw_fname_in = args.FileRaw
+            bad |= local_bad
+            active &= local_bad.any(axis=1)
 
-# filename for ICA output
-if args.FileICA == '':
+            if not active.any():
 
-    ica_fname_out = filestem + '-ica.fif'
+                break
 
-else:
+    return bad
 
-    ica_fname_out = args.FileICA
 
+def _select_components_grid(scores, bads, max_comps):
+    """Components with highest scores for all thresholds and maxima.
 
-# filename for ICA output
-if args.FileHTML == '':
+    scores: list of score arrays, one per channel
+    bads: list of boolean arrays (n_thresholds, n_components), one per channel
+    max_comps: list of maximum numbers of components to keep
+    Returns list (n_max) of lists (n_thresholds) of component indices.
+    """
+    n_comp = len(scores[0])
 
-    fname_html = filestem + '-ica.html'
+    # candidates across channels, sorted by absolute score (highest first)
+    all_scores = np.concatenate(scores)
+    all_comps = np.tile(np.arange(n_comp), len(scores))
+    all_bads = np.concatenate(bads, axis=1)
 
-else:
+    order = np.argsort(np.abs(all_scores))[::-1]
+    all_comps, all_bads = all_comps[order], all_bads[:, order]
 
-    fname_html = args.FileHTML
+    # rank of every detected candidate per threshold
+    rank = np.cumsum(all_bads, axis=1)
 
+    # (n_max, n_thresholds, n_candidates)
+    keep = all_bads & (rank <= np.asarray(max_comps)[:, None, None])
 
-###
-# START ICA
-###
+    return [[sorted(set(all_comps[kk].tolist())) for kk in keep_max]
+            for keep_max in keep]
+
+
+class SourceScorer(object):
+    """Score ICA components against EOG/ECG channels.
+
+    The source time courses are computed only once from the full raw data.
+    Scores for all channels are then obtained with a few matrix products,
+    restricted to the time windows of each channel's artefact epochs. As
+    ica.score_sources() for epochs, sources and channels are not filtered,
+    so that scores are the same as from ica.find_bads_eog/ecg(epochs).
+    """
+
+    def __init__(self, ica, raw):
+
+        self.ica = ica
+        self.raw = raw
+        self._sources = None
+
+    @property
+    def sources(self):
+        """ICA source time courses (n_components, n_times)."""
+        if self._sources is None:
+
+            print('Computing ICA source time courses.')
+            self._sources = self.ica.get_sources(self.raw).get_data()
+
+        return self._sources
+
+    def _epoch_samples(self, epochs):
+        """Sample indices (n_epochs, n_times) of epochs in the raw data."""
+        starts = epochs.events[:, 0] - self.raw.first_samp
+        offsets = int(round(epochs.tmin * self.raw.info['sfreq'])) + \
+            np.arange(len(epochs.times))
+
+        return starts[:, np.newaxis] + offsets[np.newaxis, :]
+
+    def correlate(self, ch_names, epochs_list):
+        """Pearson correlation of sources with channels within their epochs.
+
+        Samples of overlapping epochs count once per epoch, as in the
+        concatenated epochs. Returns array (n_channels, n_components).
+        """
+        sources = self.sources
+
+        targets = self.raw.get_data(picks=ch_names)
+
+        # how often each sample occurs in a channel's epochs
+        weights = np.zeros(targets.shape)
+        for [ii, epochs] in enumerate(epochs_list):
+
+            np.add.at(weights[ii], self._epoch_samples(epochs).ravel(), 1.)
+
+        # weighted sums for all channels and components at once
+        w_targets = weights * targets
+        sums = sources.dot(np.concatenate((weights, w_targets)).T)
+        s_x, s_xy = sums[:, :len(ch_names)], sums[:, len(ch_names):]
+        s_xx = (sources ** 2).dot(weights.T)
+        n = weights.sum(axis=1)
+        s_y = w_targets.sum(axis=1)
+        s_yy = (w_targets * targets).sum(axis=1)
+
+        cov = n * s_xy - s_x * s_y
+        var_x = n * s_xx - s_x ** 2
+        var_y = n * s_yy - s_y ** 2
+
+        return (cov / np.sqrt(var_x * var_y)).T
+
+    def ctps(self, epochs):
+        """Maximum phase-locking (ctps) of sources across epochs."""
+        from mne.preprocessing.ctps_ import ctps
+
+        samples = self._epoch_samples(epochs)
+
+        # components are independent, one at a time to limit memory
+        p_max = np.empty(len(self.sources))
+        for [cc, source] in enumerate(self.sources):
+
+            # (n_epochs, 1, n_times) from cached sources
+            _, p_vals, _ = ctps(source[samples][:, np.newaxis, :])
+            p_max[cc] = p_vals.max()
+
+        return p_max
+
+    def epochs(self, kind, ch_names, reject):
+        """EOG or ECG epochs for every channel (see _artefact_epochs)."""
+        return _artefact_epochs(self.raw, kind, ch_names, reject)
+
+    def scores(self, kind, ch_names, epochs_list, ecg_meth='ctps'):
+        """Scores for all EOG or ECG channels, list of arrays."""
+        if ch_names == []:
+
+            return []
+
+        if kind == 'EOG':
+
+            return list(self.correlate(ch_names, epochs_list))
+
+        if ecg_meth == 'ctps':
+
+            return [self.ctps(epochs) for epochs in epochs_list]
+
+        return list(self.correlate(ch_names, epochs_list))
+
+
+def _filtered_blocks(raw, ch_names, blocks, pad=5.):
+    """High-pass filtered blocks of raw data (not loaded).
+
+    blocks: list of (start, stop) samples. Only the channels ch_names are
+    read. Every block is filtered with some padding (s), which is removed
+    afterwards, so that it is the same as in the filtered recording.
+    Yields start sample and filtered raw data of each block.
+    """
+    n_pad = int(round(pad * raw.info['sfreq']))
+
+    for [start, stop] in blocks:
+
+        first = max(start - n_pad, 0)
+        last = min(stop + n_pad, raw.n_times)
+
+        block = raw.copy().crop(raw.times[first], raw.times[last - 1])
+        block.pick_channels(ch_names)
+
+        with EMEG_Profile.stage('read'):
+
+            block.load_data()
+
+        with EMEG_Profile.stage('filter'):
+
+            block.filter(1., None, fir_design='firwin', verbose=False)
+
+        # remove padding, time of cropped block starts at 0
+        block.crop(block.times[start - first], block.times[stop - first - 1])
+
+        yield start, block
+
+
+class BlockSourceScorer(SourceScorer):
+    """Score ICA components without loading the whole recording.
+
+    The raw data (not loaded) are read and filtered block by block. Only the
+    ICA source time courses and the EOG/ECG channels of the full recording
+    are kept in memory. Artefact epochs are rejected by the peak-to-peak
+    amplitudes of the filtered data in their time windows, which are read
+    again block by block. Scores are the same as from SourceScorer on the
+    loaded and filtered recording.
+    """
+
+    def __init__(self, ica, raw, ch_names, art_names, block_seconds=60.):
+
+        import mne
+
+        print('Computing ICA source time courses in blocks of %.0fs.' %
+              block_seconds)
+
+        self.ica = ica
+        self.raw_file = raw
+        self.ch_names = ch_names
+        self.n_block = int(round(block_seconds * raw.info['sfreq']))
+
+        blocks = [(start, min(start + self.n_block, raw.n_times))
+                  for start in range(0, raw.n_times, self.n_block)]
+
+        self._sources = np.empty((ica.n_components_, raw.n_times))
+        art_data = np.empty((len(art_names), raw.n_times))
+
+        for [start, block] in _filtered_blocks(raw, ch_names, blocks):
+
+            stop = start + block.n_times
+
+            self._sources[:, start:stop] = ica.get_sources(block).get_data()
+            art_data[:, start:stop] = block.get_data(picks=art_names)
+
+        # EOG/ECG channels, e.g. for finding events
+        info = mne.pick_info(raw.info, [raw.ch_names.index(ch)
+                                        for ch in art_names])
+        self.raw = mne.io.RawArray(art_data, info, first_samp=raw.first_samp)
+        self.raw.set_annotations(raw.annotations)
+
+    def _reject(self, epochs_list, reject):
+        """Drop epochs whose filtered data exceed reject (peak-to-peak)."""
+        import mne
+
+        raw = self.raw_file
+
+        # channels of types with thresholds, as Epochs without bad channels
+        by_type = mne.channel_indices_by_type(raw.info)
+        picks = {kind: [raw.ch_names[ii] for ii in by_type[kind]
+                        if raw.ch_names[ii] in self.ch_names and
+                        raw.ch_names[ii] not in raw.info['bads']]
+                 for kind in reject}
+        names = [ch for ch in self.ch_names
+                 if any(ch in pp for pp in picks.values())]
+
+        # first and last+1 sample of every epoch
+        windows = np.concatenate([self._epoch_samples(epochs)[:, [0, -1]] +
+                                  [0, 1] for epochs in epochs_list])
+
+        # minimum and maximum per epoch and channel
+        mins = np.full((len(windows), len(names)), np.inf)
+        maxs = np.full((len(windows), len(names)), -np.inf)
+
+        # only blocks that contain epochs are read
+        n = self.n_block
+        blocks = [(kk * n, min(kk * n + n, raw.n_times)) for kk in
+                  sorted(set(kk for [aa, bb] in windows
+                             for kk in range(aa // n, (bb - 1) // n + 1)))]
+
+        for [start, block] in _filtered_blocks(raw, names, blocks):
+
+            data = block.get_data(picks=names)
+            stop = start + data.shape[1]
+
+            for ww in np.where((windows[:, 0] < stop) &
+                               (windows[:, 1] > start))[0]:
+
+                seg = data[:, max(windows[ww, 0] - start, 0):
+                           windows[ww, 1] - start]
+
+                mins[ww] = np.minimum(mins[ww], seg.min(axis=1))
+                maxs[ww] = np.maximum(maxs[ww], seg.max(axis=1))
+
+        bad = np.zeros(len(windows), bool)
+        for [kind, thresh] in reject.items():
+
+            cols = [names.index(ch) for ch in picks[kind]]
+
+            bad |= (maxs[:, cols] - mins[:, cols] > thresh).any(axis=1)
+
+        first = 0
+        for epochs in epochs_list:
+
+            n_epochs = len(epochs.events)
+            epochs.drop(np.where(bad[first:first + n_epochs])[0],
+                        reason='REJECT')
+            first += n_epochs
+
+    def epochs(self, kind, ch_names, reject):
+        """EOG or ECG epochs for every channel, of EOG/ECG channels only."""
+        epochs_list = _artefact_epochs(self.raw, kind, ch_names, None)
+
+        if reject and epochs_list != []:
+
+            self._reject(epochs_list, reject)
 
-report = Report(subject=raw_fname_in, title='ICA:')
+        return epochs_list
 
-print('###\nReading raw file %s.' % raw_fname_in)
 
-# Read raw data
-raw = mne.io.read_raw_fif(raw_fname_in, preload=True)
+def _artefact_epochs(raw, kind, ch_names, reject):
+    """EOG or ECG epochs for every channel."""
+    from mne.preprocessing import create_eog_epochs, create_ecg_epochs
 
-# They say high-pass filtering helps
-print('High-pass filtering raw data at 1Hz.')
-raw.filter(1., None, fir_design='firwin')
+    epochs_list = []
+    for ch_name in ch_names:
 
-# which channel types to use
-to_pick = {'meg': False, 'eeg': False, 'eog': False, 'stim': False,
-           'exclude': 'bads'}
+        print('\n###\nFinding %s events for channel %s.\n' % (kind, ch_name))
 
-# pick channel types as specified
-print('Using channel types: ')
-for chtype in args.ChanTypes:
+        if kind == 'EOG':
 
-    print(chtype + ' ')
-    to_pick[chtype.lower()] = True
+            epochs_list.append(create_eog_epochs(raw, ch_name=ch_name,
+                                                 reject=reject))
 
-picks_meg_eeg_eog = mne.pick_types(raw.info, meg=to_pick['meg'],
-                                   eeg=to_pick['eeg'],
-                                   eog=True, ecg=True, stim=to_pick['stim'],
-                                   exclude=to_pick['exclude'])
+        else:
 
-# to remove non-physiological artefacts (parameters based on MNE example)
-reject = {}
-if to_pick['meg'] is True:
+            epochs_list.append(create_ecg_epochs(raw, ch_name=ch_name,
+                                                 reject=reject))
 
-    reject['mag'] = args.RejMag
-    reject['grad'] = args.RejGrad
-    print('Thresholds for MEG: Grad %.1e, Mag %.1e.' % (reject['grad'],
-          reject['mag']))
+    return epochs_list
 
-if to_pick['eeg'] is True:
 
-    reject['eeg'] = args.RejEEG
-    print('Threshold for EEG: %.1e.' % reject['eeg'])
+def _artefact_bads(kind, scores, threshs, ecg_meth='ctps'):
+    """Bad components of one channel, boolean (n_thresholds, n_components)."""
+    if kind == 'ECG' and ecg_meth == 'ctps':
 
-picks_meg = mne.pick_types(raw.info, meg=to_pick['meg'], eeg=to_pick['eeg'],
-                           eog=to_pick['eog'], stim=to_pick['stim'],
-                           exclude=to_pick['exclude'])
+        return scores[np.newaxis, :] >= np.asarray(threshs)[:, np.newaxis]
 
-# Compute ICA model ########################################################
+    return _find_outliers_grid(scores, threshs)
 
-print('###\nDefine the ICA object instance using %s. Number of PCA components\
-       based on: %s.' % (method, str(n_components)))
-ica = ICA(n_components=n_components, method=method, random_state=random_state)
 
-print('Fitting ICA.')
+def _bad_inds(scores, bads):
+    """Indices of bad components, highest absolute score first."""
+    inds = np.where(bads)[0]
 
-ica.fit(raw, picks=picks_meg, decim=decim, reject=reject)
-print(ica)
+    return [int(ii) for ii in inds[np.argsort(np.abs(scores[inds]))[::-1]]]
 
-print('Plotting ICA components.')
 
-# plot for specified channel types
-for ch_type in reject.keys():
+def _sweep_thresholds(scorer, args, reject, fname_sweep):
+    """Evaluate grid of EOG/ECG thresholds and maxima, write CSV table."""
+    eog_threshs = args.EOGthreshSweep or [args.EOGthresh]
+    ecg_threshs = args.ECGthreshSweep or [args.ECGthresh]
+    eog_maxs = args.maxEOGSweep or [args.maxEOG]
+    ecg_maxs = args.maxECGSweep or [args.maxECG]
 
-    fig_ic = ica.plot_components(ch_type=ch_type, show=show)
+    rows = []
+    for [kind, ch_names, threshs, maxs] in [['EOG', args.EOG, eog_threshs, eog_maxs],
+                                            ['ECG', args.ECG, ecg_threshs, ecg_maxs]]:
 
-    captions = [ch_type.upper() + ' Components' for i in fig_ic]
+        if ch_names == []:
 
-    report.add_figs_to_section(fig_ic, captions=captions,
-                               section='ICA Components', scale=1)
+            continue
+
+        # scores are computed only once per channel
+        epochs_list = scorer.epochs(kind, ch_names, reject)
+        scores = scorer.scores(kind, ch_names, epochs_list, args.ECGmeth)
+        bads = [_artefact_bads(kind, ss, threshs, args.ECGmeth)
+                for ss in scores]
+
+        selected = _select_components_grid(scores, bads, maxs)
+
+        for [mm, max_comps] in enumerate(maxs):
+
+            for [tt, thresh] in enumerate(threshs):
+
+                detected = ['%s:%s' % (ch_name, ' '.join(
+                            str(cc) for cc in np.where(ch_bads[tt])[0]))
+                            for [ch_name, ch_bads] in zip(ch_names, bads)]
+
+                rows.append([kind, thresh, max_comps,
+                             sum(int(bb[tt].sum()) for bb in bads),
+                             ';'.join(detected),
+                             ' '.join(str(cc) for cc in selected[mm][tt])])
+
+    header = ['Type', 'Threshold', 'Max', 'NDetected', 'Detected', 'Components']
+
+    print('\n###\nSelected components per setting:')
+    print('\t'.join(header))
+    for row in rows:
+
+        print('\t'.join(str(rr) for rr in row))
+
+    print('\nWriting sweep table to %s.' % fname_sweep)
+    with open(fname_sweep, 'w', newline='') as fid:
+
+        writer = csv.writer(fid)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+    return rows
+
+
+def _filtered_key(fname_raw, ch_names):
+    """Cache key of high-pass filtered channels ch_names of raw file."""
+    import mne
+
+    return EMEG_Cache.cache_key(
+        EMEG_Cache.file_identity(fname_raw), mne.__version__,
+        {'highpass': 1., 'fir_design': 'firwin', 'ch_names': list(ch_names)})
+
+
+def _cached_filtered(cache_dir, filt_key):
+    """Filenames of data and info of cached filtered data, or None."""
+    fname_info = EMEG_Cache.cache_get(cache_dir, filt_key, '-filt-info.fif')
+    fname_data = EMEG_Cache.cache_get(cache_dir, filt_key, '-filt.npy')
+
+    if fname_info is None or fname_data is None:
+
+        return None
+
+    return fname_data, fname_info
+
+
+def _cache_filtered(raw, filt_key, args):
+    """Save filtered data of raw (loaded) to the cache.
+
+    Returns False if the data could not be saved (e.g. disk full).
+    """
+    import mne
+
+    fname_data = EMEG_Cache.cache_path(args.CacheDir, filt_key, '-filt.npy')
+    fname_info = fname_data[:-len('-filt.npy')] + '-filt-info.fif'
+
+    # write to temporary files first, parallel jobs may read the same entry
+    fname_tmp = fname_data[:-len('-filt.npy')] + '-%d' % os.getpid()
+
+    print('Saving high-pass filtered data to cache %s.' % fname_data)
+    try:
+        np.save(fname_tmp + '-filt.npy', raw._data)
+        mne.io.write_info(fname_tmp + '-filt-info.fif', raw.info)
+
+        os.replace(fname_tmp + '-filt.npy', fname_data)
+        os.replace(fname_tmp + '-filt-info.fif', fname_info)
+    except OSError as e:
+        # e.g. disk full, the data in memory are still fine
+        print('Could not save filtered data to cache %s: %s' % (fname_data, e))
+
+        for fname in [fname_tmp + '-filt-info.fif', fname_tmp + '-filt.npy']:
+
+            if os.path.exists(fname):
+
+                os.remove(fname)
+
+        return False
+
+    EMEG_Cache.cache_evict(args.CacheDir, max_gb=args.CacheMaxGB,
+                           max_entries=args.CacheMaxEntries)
+
+    return True
+
+
+def _load_filtered(raw, ch_names, args):
+    """Load channels ch_names of raw and high-pass filter them.
+
+    Only these channels are read and filtered. With args.CacheDir, the
+    filtered data are cached as array on disk, which later runs map into
+    memory instead of reading and filtering again.
+    Returns raw with only the channels in ch_names.
+    """
+    import mne
+
+    # before loading, so that other channels are not read
+    raw.pick_channels(ch_names)
+
+    if args.CacheDir != '':
+
+        filt_key = _filtered_key(raw.filenames[0], raw.ch_names)
+
+        cached = _cached_filtered(args.CacheDir, filt_key)
+
+        if cached is not None:
+
+            print('Mapping cached high-pass filtered data from %s.' %
+                  cached[0])
+            with EMEG_Profile.stage('read'):
+
+                # copy-on-write: not read until used, cache file unchanged
+                data = np.load(cached[0], mmap_mode='c')
+
+                raw_filt = mne.io.RawArray(data, mne.io.read_info(cached[1]),
+                                           first_samp=raw.first_samp,
+                                           copy='auto')
+                raw_filt.set_annotations(raw.annotations)
+
+            return raw_filt
+
+    with EMEG_Profile.stage('read'):
+
+        raw.load_data()
+
+    # They say high-pass filtering helps
+    print('High-pass filtering raw data at 1Hz (%d channels).' %
+          len(raw.ch_names))
+    with EMEG_Profile.stage('filter'):
+
+        raw.filter(1., None, fir_design='firwin')
+
+    if args.CacheDir != '':
+
+        _cache_filtered(raw, filt_key, args)
+
+    return raw
+
+
+def _read_fit_segments(raw, picks, fit_seconds, seg_seconds):
+    """Read and high-pass filter evenly spaced segments for the ICA fit.
+
+    Only the channels in picks are read. Every segment is filtered with some
+    padding, which is removed afterwards, so that it is not affected by
+    filter edge effects. Returns concatenated segments, or None if the
+    budget covers the whole recording.
+    """
+    pad = 5.  # s, longer than high-pass filter at 1Hz
+
+    t_first = raw.times[0] + pad
+    t_last = raw.times[-1] - pad - seg_seconds
+
+    n_seg = int(np.ceil(fit_seconds / seg_seconds))
+
+    if n_seg * seg_seconds >= t_last - t_first:
+
+        print('Fit budget covers whole recording, using all data.')
+
+        return None
+
+    # spread segments evenly across recording
+    starts = np.linspace(t_first, t_last, n_seg)
+
+    print('###\nReading %d segments of %.1fs for ICA fit.' %
+          (n_seg, seg_seconds))
+
+    ch_names = [raw.ch_names[pp] for pp in picks]
+
+    segs = []
+    for t_start in starts:
+
+        seg = raw.copy().crop(t_start - pad, t_start + seg_seconds + pad)
+        seg.pick_channels(ch_names)
+
+        with EMEG_Profile.stage('read'):
+
+            seg.load_data()
+
+        with EMEG_Profile.stage('filter'):
+
+            seg.filter(1., None, fir_design='firwin', verbose=False)
+
+        # remove padding, time of cropped segment starts at 0
+        seg.crop(pad, pad + seg_seconds)
+
+        segs.append(seg)
+
+    from mne import concatenate_raws
+
+    return concatenate_raws(segs)
 
-# indices of ICA components to be removed across EOG and ECG
-ica_inds = []
 
 ###
-# EOG COMPONENTS
+# HTML REPORT
 ###
 
-# for all specified EOG channels
-eog_inds = []  # ICA components found to be bad for EOG
-eog_scores = []  # corresponding ICA scores
+def get_scores_filename(ica_fname):
+    """Filename for component scores of ICA file."""
+    return ica_fname.split('.fif')[0] + '-scores.json'
+
+
+def _channel_scores(kind, ch_name, scores, inds):
+    """Scores and bad components of one EOG or ECG channel."""
+    return {'kind': kind, 'ch_name': ch_name,
+            'scores': [float(x) for x in scores],
+            'inds': [int(x) for x in inds]}
+
+
+def save_scores(fname, raw_fname, ica_fname, reject, channels, exclude,
+                ch_names):
+    """Save everything needed to render the report later.
+
+    ch_names: channels read for ICA fit and EOG/ECG scoring.
+    """
+    info = {'raw': os.path.abspath(raw_fname), 'ica': os.path.abspath(ica_fname),
+            'reject': reject, 'channels': channels,
+            'exclude': [int(x) for x in exclude], 'ch_names': list(ch_names)}
+
+    with open(fname, 'w') as fid:
+
+        json.dump(info, fid, indent=1)
+
+
+def _report_tasks(info):
+    """Groups of report figures, in the order of the report."""
+    tasks = [('components', ch_type) for ch_type in info['reject']]
+
+    # figures only for channels with bad components
+    tasks += [('channel', ii) for [ii, chan] in enumerate(info['channels'])
+              if chan['inds'] != []]
+
+    return tasks
+
+
+# filtered raw data of the last report, shared by its figures in a process
+_report_raw = {}
+
+
+def _filtered_raw(info, args):
+    """Filtered raw data for report figures, loaded once per process.
+
+    Only the channels of ICA fit and EOG/ECG scoring are loaded, from the
+    cache in args.CacheDir if possible.
+    """
+    if info['raw'] not in _report_raw:
+
+        import mne
+
+        _report_raw.clear()
+
+        raw = mne.io.read_raw_fif(info['raw'], preload=False)
+
+        # all channels for scores saved without channel names
+        ch_names = info.get('ch_names', raw.ch_names)
+
+        _report_raw[info['raw']] = _load_filtered(raw, ch_names, args)
 
-for eog_ch in args.EOG:
+    return _report_raw[info['raw']]
 
-    print('\n###\nFinding components for EOG channel %s.\n' % eog_ch)
 
-    # get single EOG trials
-    eog_epochs = create_eog_epochs(raw, ch_name=eog_ch, reject=reject)
+def _render_figures(item, infos, fig_dir, mode, args):
+    """Render one group of report figures to PNG files.
 
-    eog_average = eog_epochs.average()  # average EOG epochs
+    item: index of report and task (see _report_tasks). Runs in a worker
+    process without display. Returns list of (section, caption, filename).
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
 
-    # find via correlation
-    inds, scores = ica.find_bads_eog(eog_epochs, ch_name=eog_ch,
-                                     threshold=args.EOGthresh)
+    import mne
 
-    if inds != []:  # if some bad components found
+    ii_report, task = item
+    info = infos[ii_report]
 
-        print('###\nEOG components and scores for channel %s:\n' % eog_ch)
-        for [ee, ss] in zip(inds, scores):
+    ica = mne.preprocessing.read_ica(info['ica'])
 
-            print('%d: %.2f\n' % (ee, ss))
+    # thumbnails for lite reports
+    dpi = 40 if mode == 'lite' else None
+
+    if task[0] == 'components':
+
+        ch_type = task[1]
+
+        figs = ica.plot_components(ch_type=ch_type, show=False)
+
+        if not isinstance(figs, list):
+
+            figs = [figs]
+
+        figures = [('ICA Components', ch_type.upper() + ' Components', fig)
+                   for fig in figs]
+
+    else:
+
+        chan = info['channels'][task[1]]
+        ch, inds = chan['ch_name'], chan['inds']
+        scores = np.array(chan['scores'])
+
+        # section names as in earlier reports
+        if chan['kind'] == 'EOG':
+            sec_scores, sec_raw = '%s ICA component scores', '%s raw ICA sources'
+        else:
+            sec_scores, sec_raw = '%s component scores', '%s raw sources'
 
         # look at r scores of components
-        fig_sc = ica.plot_scores(scores, exclude=inds, show=show)
+        figures = [(sec_scores % ch, '%s Scores' % ch,
+                    ica.plot_scores(scores, exclude=inds, show=False))]
+
+        if mode == 'full':
+
+            raw = _filtered_raw(info, args)
 
-        report.add_figs_to_section(fig_sc, captions='%s Scores' % eog_ch,
-                                   section='%s ICA component scores' % eog_ch,
-                                   scale=1)
-        # we can see that only one component is highly correlated and that this
-        # component es', scale=1)
+            epochs = _artefact_epochs(raw, chan['kind'], [ch],
+                                      info['reject'])[0]
 
-        print('Plotting raw ICA sources.')
-        fig_rc = ica.plot_sources(raw, exclude=inds, show=show)
+            average = epochs.average()
 
-        report.add_figs_to_section(fig_rc, captions='%s Sources' % eog_ch,
-                                   section='%s raw ICA sources' % eog_ch,
-                                   scale=1)
+            print('Plotting raw ICA sources.')
+            figures.append((sec_raw % ch, '%s Sources' % ch,
+                            ica.plot_sources(raw, exclude=inds, show=False)))
 
-        print('Plotting EOG average sources.')
-        # look at source time course
-        fig_so = ica.plot_sources(eog_average, exclude=inds, show=show)
+            print('Plotting %s average sources.' % chan['kind'])
+            # look at source time course
+            figures.append(('%s ICA Sources' % ch, '%s Sources' % ch,
+                            ica.plot_sources(average, exclude=inds,
+                                             show=False)))
 
-        report.add_figs_to_section(fig_so, captions='%s Sources' % eog_ch,
-                                   section='%s ICA Sources' % eog_ch, scale=1)
+            print('Plotting %s epochs properties.' % chan['kind'])
+            figures += [('%s ICA Properties' % ch, '%s Properties' % ch, fig)
+                        for fig in ica.plot_properties(
+                            epochs, picks=inds, psd_args={'fmax': 35.},
+                            image_args={'sigma': 1.}, show=False)]
 
-        print('Plotting EOG epochs properties.')
-        fig_pr = ica.plot_properties(eog_epochs, picks=inds,
-                                     psd_args={'fmax': 35.},
-                                     image_args={'sigma': 1.}, show=show)
+            # red -> before, black -> after
+            figures.append(('%s ICA Overlay' % ch, '%s Overlay' % ch,
+                            ica.plot_overlay(average, exclude=inds,
+                                             show=False)))
 
-        txt_str = '%s Properties' % eog_ch
-        captions = [txt_str for i in fig_pr]
+    fnames = []
+    for [section, caption, fig] in figures:
 
-        report.add_figs_to_section(fig_pr, captions=captions,
-                                   section='%s ICA Properties' % eog_ch,
-                                   scale=1)
+        fname = os.path.join(fig_dir, '%d-%s-%s-%d.png' % (
+            ii_report, task[0], task[1], len(fnames)))
+        fig.savefig(fname, dpi=dpi)
+        plt.close(fig)
 
-        print(ica.labels_)
+        fnames.append((section, caption, fname))
 
-        # Remove ICA components ###############################################
-        fig_ov = ica.plot_overlay(eog_average, exclude=inds, show=show)
-        # red -> before, black -> after.
+    return fnames
 
-        report.add_figs_to_section(fig_ov, captions='%s Overlay' % eog_ch,
-                                   section='%s ICA Overlay' % eog_ch,
-                                   scale=1)
 
-        plt.close('all')
+def _cache_report_raw(info, args):
+    """Make sure filtered raw data of report are in cache args.CacheDir."""
+    if info['raw'] in _report_raw:
 
-        eog_inds += inds  # keep bad ICA components
-        eog_scores += list(scores[inds])  # keep scores for bad ICA components
+        raw = _report_raw[info['raw']]
+        filt_key = _filtered_key(info['raw'], raw.ch_names)
+
+        if _cached_filtered(args.CacheDir, filt_key) is None:
+
+            _cache_filtered(raw, filt_key, args)
 
     else:
 
-        print('\n###\n!!!Nothing bad found for %s!!!\n###\n' % eog_ch)
+        # reads, filters and caches if not in cache yet
+        _filtered_raw(info, args)
 
-if (eog_inds != []) and (args.maxEOG > 0):  # if there are bad ECG components
 
-    # deal with case where there are more bad ICA components than specified
-    n_comps = np.min([args.maxEOG, len(eog_inds)])
+def render_reports(reports, mode='full', n_jobs=1, raw=None, args=None,
+                   open_browser=False):
+    """Render HTML reports from saved ICA and component scores.
 
-    print('\n###\nUsing %d out of %d detected ICA components for EOG.' %
-          (n_comps, len(eog_inds)))
+    reports: list of (scores filename, HTML filename). The groups of
+    figures of all reports are rendered in n_jobs processes.
+    Figures of raw data use raw (loaded and filtered, for a single report)
+    or read the channels of ICA fit and scoring. With args.CacheDir, these
+    are read and filtered once per raw file, and parallel workers map them
+    from the cache. Otherwise, every worker reads and filters the raw files
+    it needs (nothing is written to disk).
+    Returns list of (scores filename, HTML filename, error), where error is
+    None or the traceback of the exception raised for this report.
+    """
+    from mne.report import Report
 
-    for [c, s] in zip(eog_inds, eog_scores):
+    if args is None:
 
-        print('Component %d with score %f.' % (c, s))
+        args = get_parser().parse_args([])
 
-    # sort to find ICA components with highest scores
-    idx_sort = np.argsort(np.abs(eog_scores))
+    infos = []
+    for [fname_scores, _] in reports:
 
-    # only keep desired number of bad ICA components with highest scores
-    ica_inds += [eog_inds[idx] for idx in idx_sort[-n_comps:]]
+        with open(fname_scores) as fid:
 
+            infos.append(json.load(fid))
 
-###
-# ECG COMPONENTS
-###
+    items = [(ii, task) for [ii, info] in enumerate(infos)
+             for task in _report_tasks(info)]
 
-# for all specified EOG channels
+    print('Rendering %d %s report(s) with %d groups of figures.' %
+          (len(reports), mode, len(items)))
 
-ecg_inds = []  # ICA components found to be bad for ECG
-ecg_scores = []  # corresponding ICA scores
+    fig_dir = tempfile.mkdtemp(prefix='ica_report_')
 
-for ecg_ch in args.ECG:
+    try:
+        if raw is not None:
 
-    print('\n###\nFinding components for ECG channel %s.\n' % ecg_ch)
+            _report_raw.clear()
+            _report_raw[infos[0]['raw']] = raw
 
-    # get single ECG trials
-    ecg_epochs = create_ecg_epochs(raw, ch_name=ecg_ch, reject=reject)
+        if n_jobs > 1 and mode == 'full' and args.CacheDir != '':
 
-    ecg_average = ecg_epochs.average()  # average ECG epochs
+            # every raw file is read and filtered once, workers map it
+            for ii in sorted(set(ii for [ii, task] in items
+                                 if task[0] == 'channel')):
 
-    # find bad ICA ECG components
-    inds, scores = ica.find_bads_ecg(ecg_epochs, ch_name=ecg_ch,
-                                     method=args.ECGmeth,
-                                     threshold=args.ECGthresh)
+                _cache_report_raw(infos[ii], args)
 
-    if inds != []:  # if some bad components found
+            _report_raw.clear()
 
-        print('ECG components and scores:\n')
-        for [ee, ss] in zip(inds, scores):
+        with EMEG_Profile.stage('plot'):
 
-            print('%d: %.2f\n' % (ee, ss))
+            results = EMEG_Batch.run_batch(
+                _render_figures, items,
+                args=(infos, fig_dir, mode, args), n_jobs=n_jobs)
 
-        # look at r scores of components
-        fig_sc = ica.plot_scores(scores, exclude=inds, show=show)
+        EMEG_Batch.print_summary(results, title='Report figures')
+
+        done = []
+        for [ii, [fname_scores, fname_html]] in enumerate(reports):
+
+            try:
+                report = Report(subject=infos[ii]['raw'], title='ICA:')
+
+                for [item, fnames, _] in results:
+
+                    for [section, caption, fname] in fnames or []:
+
+                        if item[0] == ii:
+
+                            report.add_images_to_section(fname, caption,
+                                                         section=section)
+
+                print('Saving HTML report to {0}'.format(fname_html))
+                with EMEG_Profile.stage('report save'):
 
-        report.add_figs_to_section(fig_sc, captions='%s Scores' % ecg_ch,
-                                   section='%s component scores' % ecg_ch,
-                                   scale=1)
+                    report.save(fname_html, overwrite=True,
+                                open_browser=open_browser)
 
-        print('Plotting raw ICA sources.')
-        fig_rc = ica.plot_sources(raw, exclude=inds, show=show)
+                done.append((fname_scores, fname_html, None))
 
-        report.add_figs_to_section(fig_rc, captions='%s Sources' % ecg_ch,
-                                   section='%s raw sources' % ecg_ch, scale=1)
+            except Exception:
+                done.append((fname_scores, None, traceback.format_exc()))
 
-        print('Plotting ECG average sources.')
-        # look at source time course
-        fig_so = ica.plot_sources(ecg_average, exclude=inds, show=show)
+    finally:
+        _report_raw.clear()
+        shutil.rmtree(fig_dir)
 
-        report.add_figs_to_section(fig_so, captions='%s Sources' % ecg_ch,
-                                   section='%s ICA Sources' % ecg_ch, scale=1)
+    return done
 
-        print('Plotting ECG epochs properties.')
-        fig_pr = ica.plot_properties(ecg_epochs, picks=inds,
-                                     psd_args={'fmax': 35.},
-                                     image_args={'sigma': 1.}, show=show)
 
-        txt_str = '%s Properties' % ecg_ch
-        captions = [txt_str for i in fig_pr]
+def render_report(fname_scores, fname_html, mode='full', n_jobs=1, raw=None,
+                  args=None, open_browser=False):
+    """Render HTML report from saved ICA and component scores.
 
-        report.add_figs_to_section(fig_pr, captions=captions,
-                                   section='%s ICA Properties' % ecg_ch,
-                                   scale=1)
+    See render_reports. Returns HTML filename.
+    """
+    [[_, _, error]] = render_reports([(fname_scores, fname_html)], mode,
+                                     n_jobs, raw, args, open_browser)
 
-        print(ica.labels_)
+    if error is not None:
 
-        # Remove ICA components ###############################################
-        fig_ov = ica.plot_overlay(ecg_average, exclude=inds, show=show)
-        # red -> before, black -> after. Yes! We remove quite a lot!
+        raise RuntimeError('Could not render report %s:\n%s' % (fname_html,
+                                                                 error))
 
-        report.add_figs_to_section(fig_ov, captions='%s Overlay' % ecg_ch,
-                                   section='%s ICA Overlay' % ecg_ch, scale=1)
+    return fname_html
 
-        plt.close('all')
 
-        ecg_inds += inds  # keep bad ICA components
-        ecg_scores += list(scores[inds])  # keep bad ICA components
+def compute_ica(file_raw, args=None, file_ica='', file_html='',
+                open_browser=True):
+    """Fit ICA to one raw file, find EOG/ECG components, save ICA and report.
+
+    args: namespace as returned by get_parser().parse_args(), default
+    values are used if None.
+    Returns dict with output filenames and indices of components to remove.
+    """
+    if args is None:
+
+        args = get_parser().parse_args([])
+
+    # stages of this call only, --Profile of earlier calls does not persist
+    with EMEG_Profile.profiling(args.Profile, args.ProfileTracemalloc,
+                                script='Fiff_Compute_ICA',
+                                file=get_filenames(file_raw)[0]):
+
+        return _compute_ica(file_raw, args, file_ica, file_html, open_browser)
+
+
+def _compute_ica(file_raw, args, file_ica, file_html, open_browser):
+    """Body of compute_ica, within its profiling settings."""
+    import mne
+    from mne.preprocessing import ICA
+
+    ###
+    # ANALAYSIS PARAMETERS
+    ###
+
+    # epoch length
+    tmin, tmax = -0.2, 0.2
+
+    if '.' in args.n_pca_comps:
+        # if float, select n_components by explained variance of PCA
+        n_components = float(args.n_pca_comps)
+        print('Number of PCA components by fraction of variance (%f)' %
+              n_components)
 
     else:
 
-        print('\n###\n!!!Nothing bad found for %s!!!\n###\n' % ecg_ch)
+        n_components = int(args.n_pca_comps)
+        print('Number of PCA components: %d.' % n_components)
 
+    method = args.method  # for comparison with EEGLAB try "extended-infomax" here
+    print('\nUsing ICA method %s.' % method)
 
-if (ecg_inds != []) and (args.maxECG > 0):  # if there are bad ECG components
+    decim = 3  # downsample data to save time
 
-    # deal with case where there are more bad ICA components than specified
-    n_comps = np.min([args.maxECG, len(ecg_inds)])
+    # same random state for each ICA (not sure if beneficial?)
+    random_state = 23
 
-    print('\n###\nUsing %d out of %d detected ICA components for ECG.' %
-          (n_comps, len(ecg_inds)))
+    raw_fname_in, ica_fname_out, fname_html = get_filenames(file_raw, file_ica,
+                                                            file_html)
 
-    for [c, s] in zip(ecg_inds, ecg_scores):
+    ###
+    # START ICA
+    ###
 
-        print('Component %d with score %f.' % (c, s))
+    print('###\nReading raw file %s.' % raw_fname_in)
 
-    # sort to find ICA components with highest scores
-    idx_sort = np.argsort(np.abs(ecg_scores))
+    # Read raw data, only header for now
+    with EMEG_Profile.stage('read'):
 
-    # only keep desired number of bad ICA components with highest scores
-    ica_inds += [ecg_inds[idx] for idx in idx_sort[-n_comps:]]
+        raw = mne.io.read_raw_fif(raw_fname_in, preload=False)
 
-if ica_inds != []:
+    # which channel types to use
+    to_pick = {'meg': False, 'eeg': False, 'eog': False, 'stim': False,
+               'exclude': 'bads'}
 
-    print('\n###\nSpecifying %d components to be removed:' % len(ica_inds))
-    print(' '.join(str(x) for x in ica_inds))
-    print('You can use Fiff_Apply_ICA now.\n###')
+    # pick channel types as specified
+    print('Using channel types: ')
+    for chtype in args.ChanTypes:
 
-else:
+        print(chtype + ' ')
+        to_pick[chtype.lower()] = True
 
-    print('\n###\nNo bad ICA components found anywhere.')
+    picks_meg_eeg_eog = mne.pick_types(raw.info, meg=to_pick['meg'],
+                                       eeg=to_pick['eeg'],
+                                       eog=True, ecg=True, stim=to_pick['stim'],
+                                       exclude=to_pick['exclude'])
 
-# specify components to be removed
-ica.exclude = ica_inds
+    # to remove non-physiological artefacts (parameters based on MNE example)
+    reject = {}
+    if to_pick['meg'] is True:
 
-###
-# SAVE ICA
-###
+        reject['mag'] = args.RejMag
+        reject['grad'] = args.RejGrad
+        print('Thresholds for MEG: Grad %.1e, Mag %.1e.' % (reject['grad'],
+              reject['mag']))
+
+    if to_pick['eeg'] is True:
+
+        reject['eeg'] = args.RejEEG
+        print('Threshold for EEG: %.1e.' % reject['eeg'])
+
+    picks_meg = mne.pick_types(raw.info, meg=to_pick['meg'], eeg=to_pick['eeg'],
+                               eog=to_pick['eog'], stim=to_pick['stim'],
+                               exclude=to_pick['exclude'])
+
+    fit_names = [raw.ch_names[pp] for pp in picks_meg]
+
+    # channels for fit and EOG/ECG scoring, only these are read and filtered
+    load_names = [raw.ch_names[pp] for pp in picks_meg_eeg_eog]
+    load_names += [ch for ch in args.EOG + args.ECG
+                   if ch in raw.ch_names and ch not in load_names]
+
+    # Compute ICA model ########################################################
+
+    # everything that affects the ICA fit, but not the EOG/ECG scoring
+    fit_key = EMEG_Cache.cache_key(
+        EMEG_Cache.file_identity(raw_fname_in), mne.__version__,
+        {'highpass': 1., 'fir_design': 'firwin',
+         'picks': fit_names, 'reject': reject,
+         'n_components': n_components, 'method': method, 'decim': decim,
+         'random_state': random_state, 'fit_seconds': args.FitMaxSeconds,
+         'seg_seconds': args.FitSegSeconds})
+
+    ica = None
+    if args.CacheDir != '':
+
+        fname_cache = EMEG_Cache.cache_get(args.CacheDir, fit_key, '-ica.fif')
+
+        if fname_cache is not None:
+
+            print('###\nReading cached ICA fit from %s.' % fname_cache)
+            with EMEG_Profile.stage('read'):
+
+                ica = mne.preprocessing.read_ica(fname_cache)
+
+    fit_raw = None
+    if ica is None and args.FitMaxSeconds > 0.:
+
+        fit_raw = _read_fit_segments(raw, picks_meg, args.FitMaxSeconds,
+                                     args.FitSegSeconds)
+
+    if ica is None and fit_raw is None:
+
+        # full recording needed for fit
+        raw = _load_filtered(raw, load_names, args)
+        picks_meg = mne.pick_channels(raw.ch_names, fit_names)
+
+    if ica is None:
+
+        print('###\nDefine the ICA object instance using %s. Number of PCA components\
+           based on: %s.' % (method, str(n_components)))
+        ica = ICA(n_components=n_components, method=method, random_state=random_state)
+
+        print('Fitting ICA.')
+
+        t_fit = time.time()
+
+        if fit_raw is None:
+
+            with EMEG_Profile.stage('fit'):
+
+                ica.fit(raw, picks=picks_meg, decim=decim, reject=reject)
+
+        else:
+
+            # segments contain only the channels to fit
+            with EMEG_Profile.stage('fit'):
+
+                ica.fit(fit_raw, picks=np.arange(len(fit_raw.ch_names)),
+                        decim=decim, reject=reject)
+
+            t_fit = time.time() - t_fit
+
+            # fit time scales roughly linearly with number of samples
+            frac = fit_raw.n_times / float(raw.n_times)
+            print('Fit took %.1fs on %.1f%% of samples (estimated %.1fs for '
+                  'full recording).' % (t_fit, 100. * frac, t_fit / frac))
+            print('Data for fit: %.1fMB (full recording %.1fMB).' %
+                  (8e-6 * len(picks_meg) * fit_raw.n_times,
+                   8e-6 * len(picks_meg) * raw.n_times))
+
+            del fit_raw
+
+        if args.CacheDir != '':
+
+            _cache_ica_fit(ica, args, fit_key)
+
+    art_names = args.EOG + args.ECG
+
+    if raw.preload or art_names == []:
+
+        # nothing to load if nothing to score
+        scorer = SourceScorer(ica, raw)
+
+    elif args.FitMaxSeconds > 0. and all(ch in load_names for ch in art_names):
+
+        # within memory budget, only sources and EOG/ECG channels are kept
+        scorer = BlockSourceScorer(ica, raw, load_names, art_names,
+                                   min(score_block_seconds,
+                                       args.FitMaxSeconds))
+
+    else:
+
+        # full recording for EOG/ECG scoring (e.g. ECG from MEG channels)
+        raw = _load_filtered(raw, load_names, args)
+        scorer = SourceScorer(ica, raw)
+
+    print(ica)
+
+    if (args.EOGthreshSweep or args.ECGthreshSweep or args.maxEOGSweep or
+            args.maxECGSweep):
+
+        if args.FileSweep == '':
+
+            fname_sweep = ica_fname_out.split('.fif')[0] + '-sweep.csv'
+
+        else:
+
+            fname_sweep = args.FileSweep
+
+        with EMEG_Profile.stage('score'):
+
+            rows = _sweep_thresholds(scorer, args, reject, fname_sweep)
+
+        _print_peak_memory()
+
+        return {'sweep': fname_sweep, 'rows': rows}
+
+    # indices of ICA components to be removed across EOG and ECG
+    ica_inds = []
+
+    # scores and bad components per channel, for the report
+    channels = []
+
+    # ICA sources are computed once for scoring all EOG and ECG channels
+    ###
+    # EOG COMPONENTS
+    ###
+
+    # for all specified EOG channels
+    eog_inds = []  # ICA components found to be bad for EOG
+    eog_scores = []  # corresponding ICA scores
+
+    with EMEG_Profile.stage('score'):
+
+        # get single EOG trials for all channels
+        eog_epochs_all = scorer.epochs('EOG', args.EOG, reject)
+
+        # correlations of all components with all EOG channels
+        eog_scores_all = scorer.scores('EOG', args.EOG, eog_epochs_all)
+
+    for [ii, eog_ch] in enumerate(args.EOG):
+
+        print('\n###\nFinding components for EOG channel %s.\n' % eog_ch)
+
+        # find via correlation
+        scores = eog_scores_all[ii]
+        inds = _bad_inds(scores, _artefact_bads('EOG', scores,
+                                                [args.EOGthresh])[0])
+        ica.labels_['eog/%d/%s' % (ii, eog_ch)] = inds
+
+        channels.append(_channel_scores('EOG', eog_ch, scores, inds))
+
+        if inds != []:  # if some bad components found
+
+            print('###\nEOG components and scores for channel %s:\n' % eog_ch)
+            for [ee, ss] in zip(inds, scores[inds]):
+
+                print('%d: %.2f\n' % (ee, ss))
+
+            print(ica.labels_)
+
+            eog_inds += inds  # keep bad ICA components
+            eog_scores += list(scores[inds])  # keep scores for bad ICA components
+
+        else:
+
+            print('\n###\n!!!Nothing bad found for %s!!!\n###\n' % eog_ch)
+
+    if (eog_inds != []) and (args.maxEOG > 0):  # if there are bad ECG components
+
+        # deal with case where there are more bad ICA components than specified
+        n_comps = np.min([args.maxEOG, len(eog_inds)])
+
+        print('\n###\nUsing %d out of %d detected ICA components for EOG.' %
+              (n_comps, len(eog_inds)))
+
+        for [c, s] in zip(eog_inds, eog_scores):
+
+            print('Component %d with score %f.' % (c, s))
+
+        # sort to find ICA components with highest scores
+        idx_sort = np.argsort(np.abs(eog_scores))
+
+        # only keep desired number of bad ICA components with highest scores
+        ica_inds += [eog_inds[idx] for idx in idx_sort[-n_comps:]]
+
+
+    ###
+    # ECG COMPONENTS
+    ###
+
+    # for all specified EOG channels
+
+    ecg_inds = []  # ICA components found to be bad for ECG
+    ecg_scores = []  # corresponding ICA scores
+
+    with EMEG_Profile.stage('score'):
+
+        # get single ECG trials for all channels
+        ecg_epochs_all = scorer.epochs('ECG', args.ECG, reject)
+
+        # scores of all components for all ECG channels
+        ecg_scores_all = scorer.scores('ECG', args.ECG, ecg_epochs_all,
+                                       args.ECGmeth)
+
+    for [ii, ecg_ch] in enumerate(args.ECG):
+
+        print('\n###\nFinding components for ECG channel %s.\n' % ecg_ch)
+
+        # find bad ICA ECG components
+        scores = ecg_scores_all[ii]
+        inds = _bad_inds(scores, _artefact_bads('ECG', scores,
+                                                [args.ECGthresh],
+                                                args.ECGmeth)[0])
+        ica.labels_['ecg/%d/%s' % (ii, ecg_ch)] = inds
+
+        channels.append(_channel_scores('ECG', ecg_ch, scores, inds))
+
+        if inds != []:  # if some bad components found
+
+            print('ECG components and scores:\n')
+            for [ee, ss] in zip(inds, scores[inds]):
+
+                print('%d: %.2f\n' % (ee, ss))
+
+            print(ica.labels_)
+
+            ecg_inds += inds  # keep bad ICA components
+            ecg_scores += list(scores[inds])  # keep bad ICA components
+
+        else:
+
+            print('\n###\n!!!Nothing bad found for %s!!!\n###\n' % ecg_ch)
+
+
+    if (ecg_inds != []) and (args.maxECG > 0):  # if there are bad ECG components
+
+        # deal with case where there are more bad ICA components than specified
+        n_comps = np.min([args.maxECG, len(ecg_inds)])
+
+        print('\n###\nUsing %d out of %d detected ICA components for ECG.' %
+              (n_comps, len(ecg_inds)))
+
+        for [c, s] in zip(ecg_inds, ecg_scores):
+
+            print('Component %d with score %f.' % (c, s))
+
+        # sort to find ICA components with highest scores
+        idx_sort = np.argsort(np.abs(ecg_scores))
+
+        # only keep desired number of bad ICA components with highest scores
+        ica_inds += [ecg_inds[idx] for idx in idx_sort[-n_comps:]]
+
+    _print_peak_memory()
+
+    if ica_inds != []:
+
+        print('\n###\nSpecifying %d components to be removed:' % len(ica_inds))
+        print(' '.join(str(x) for x in ica_inds))
+        print('You can use Fiff_Apply_ICA now.\n###')
+
+    else:
+
+        print('\n###\nNo bad ICA components found anywhere.')
+
+    # specify components to be removed
+    ica.exclude = ica_inds
+
+    ###
+    # SAVE ICA
+    ###
+
+    # from now on the ICA will reject this component even if no exclude
+    # parameter is passed, and this information will be stored to disk
+    # on saving
+
+    print('\nSaving ICA to %s' % (ica_fname_out))
+    with EMEG_Profile.stage('write'):
+
+        # replaces ICA of earlier runs (not all MNE versions can overwrite)
+        fname_tmp = '%s-%d-ica.fif' % (os.path.splitext(ica_fname_out)[0],
+                                       os.getpid())
+        ica.save(fname_tmp)
+        os.replace(fname_tmp, ica_fname_out)
+
+    fname_scores = get_scores_filename(ica_fname_out)
+
+    print('Saving component scores to %s' % fname_scores)
+    save_scores(fname_scores, raw_fname_in, ica_fname_out, reject, channels,
+                ica_inds, raw.ch_names if raw.preload else load_names)
+
+    if args.Report == 'none':
+
+        fname_html = None
+
+    else:
+
+        # figures can use the filtered data in memory, if loaded
+        render_report(fname_scores, fname_html, args.Report, args.ReportJobs,
+                      raw=raw if raw.preload else None, args=args,
+                      open_browser=open_browser)
+
+    return {'ica': ica_fname_out, 'html': fname_html, 'scores': fname_scores,
+            'exclude': ica_inds}
+
+
+def _print_peak_memory():
+    """Print peak memory of this process so far (fit and scoring)."""
+    # kilobytes on Linux
+    print('Peak memory of fit and scoring: %.1fMB.' %
+          (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3))
+
+
+def _compute_ica_batch(file_raw, args):
+    """Batch task for one raw file, output filenames derived from file_raw."""
+    # don't open one browser tab per subject
+    return compute_ica(file_raw, args, open_browser=False)
+
+
+def main(argv_in=None):
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == []:
+        # display help message when no args are passed.
+        exit(1)
+
+    args = get_parser().parse_args(argv_in)
+
+    import mne
+
+    print('MNE %s.\n' % mne.__version__)
+
+    print(mne)
+
+    files = EMEG_Batch.get_filelist(args.FileList, args.FileGlob)
+
+    if files == []:
+
+        compute_ica(args.FileRaw, args, file_ica=args.FileICA,
+                    file_html=args.FileHTML)
+
+        return
+
+    ###
+    # BATCH MODE
+    ###
+
+    if args.FileRaw is not None:
+
+        files = [args.FileRaw] + files
+
+    print('###\nBatch mode: %d raw files, %d workers with %d thread(s) each.' %
+          (len(files), args.NJobs, args.NThreads))
+
+    # workers only render figures into the HTML report
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    # reports are rendered after all fits, fit workers don't wait for figures
+    mode = args.Report
+    args.Report = 'none'
+
+    results = EMEG_Batch.run_batch(_compute_ica_batch, files, args=(args,),
+                                   n_jobs=args.NJobs, n_threads=args.NThreads)
+
+    for [file_raw, result, _] in results:
+
+        if result is not None and 'exclude' in result:
+
+            print('%s: remove %s' % (file_raw, ' '.join(str(x) for x in
+                                                      result['exclude'])))
+
+    failed = EMEG_Batch.print_summary(results, title='Fiff_Compute_ICA')
+
+    reports = [(result['scores'], get_filenames(file_raw)[2])
+               for [file_raw, result, _] in results
+               if result is not None and 'scores' in result]
+
+    if mode != 'none' and reports != []:
+
+        print('###\nRendering %d reports in %d processes.' %
+              (len(reports), args.NJobs))
+
+        # with --CacheDir, report figures map the data filtered for the fits
+        failed += EMEG_Batch.print_summary(
+            render_reports(reports, mode, args.NJobs, args=args),
+            title='ICA reports')
+
+    if failed != []:
+
+        exit(1)
 
-# from now on the ICA will reject this component even if no exclude
-# parameter is passed, and this information will be stored to disk
-# on saving
 
-print('\nSaving ICA to %s' % (ica_fname_out))
-ica.save(ica_fname_out)
+if __name__ == '__main__':
 
-print('Saving HTML report to {0}'.format(fname_html))
-report.save(fname_html, overwrite=True, open_browser=True)
+    main()
@@ -3,6 +3,16 @@
 =========================================================================================
 Plot head positions (translation and rotation) from MEG raw data determined by Maxfilter.
 "pos"-files from Maxfilter (option -hp) are required as input.
+Many pos-files (--FilesPos) can be plotted to image files in --OutDir in
+parallel (--NJobs), without a display, optionally with a combined PDF or
+HTML overview (--Index). Figures are named after the pos-files, or after
+their paths if names occur in several directories.
+With --PosCache, parsed positions are cached in .npy-files next to the
+pos-files and read memory-mapped in later runs.
+Long recordings are reduced to --MaxPoints samples for plotting, keeping
+the minimum and maximum of each trace per time bucket.
+With --Summary, head motion metrics are computed for one or more pos-files
+(--FilesPos) and written to a CSV or JSON file, without plotting.
 For more help, type Fiff_HeadPositions -h.
 Based on MNE-Python.
 Look here for an example:
@@ -11,53 +21,484 @@ https://martinos.org/mne/stable/auto_examples/preprocessing/plot_head_positions.
 """
 # Olaf Hauk, Python 3, July 2019
 
-print(__doc__)
-
 ###
 # PARSE INPUT ARGUMENTS
 ###
 
 from sys import argv, exit
+import os
+import glob
+import csv
+import json
+import time
 import argparse
 
-from matplotlib import pyplot as plt
+import numpy as np
+
+# mne and matplotlib are imported where needed, to start quickly
+
+import EMEG_Batch
+
+
+def get_parser():
+    """Argument parser for Fiff_HeadPositions."""
+    parser = argparse.ArgumentParser(description='MEG head positions.')
+
+    parser.add_argument('--FileRaw', help='Input filename.')
+    parser.add_argument('--FileOut', help='Output filename for figure (default: do not save).\
+                                          If specified, figure will not be shown on screen.', default='')
+    parser.add_argument('--mode', help='traces|field (default: traces).', default='traces')
+
+    parser.add_argument('--FilesPos', help='Several pos-files (e.g. for --Summary).', nargs='+', default=[])
+    parser.add_argument('--Summary', help='Output file for head motion metrics (.csv or .json) of all pos-files, '
+                        'no figures will be produced.', default='')
+    parser.add_argument('--TransThresh', help='Thresholds for displacement from first position in mm '
+                        '(default 2 5).', nargs='+', type=float, default=[2., 5.])
+    parser.add_argument('--RotThresh', help='Thresholds for rotation from first position in degrees '
+                        '(default 2 5).', nargs='+', type=float, default=[2., 5.])
+    parser.add_argument('--PerSampleDir', help='With --Summary: directory for CSV files with displacement and '
+                        'rotation per sample (default: none).', default='')
+
+    parser.add_argument('--PosCache', help='Cache parsed positions in .npy-files next to the pos-files '
+                        '(updated when pos-file changes).', action='store_true')
+
+    parser.add_argument('--MaxPoints', help='Maximum number of samples plotted per trace; longer recordings '
+                        'keep min/max per time bucket (default 12000, 0: all).', type=int, default=12000)
+
+    parser.add_argument('--OutDir', help='Batch mode: directory for figures of --FilesPos (default: current).', default='.')
+    parser.add_argument('--Format', help='Batch mode: image format of figures (default png).', default='png')
+    parser.add_argument('--NJobs', help='Batch mode: number of figures rendered in parallel (default 1).', type=int, default=1)
+    parser.add_argument('--Index', help='Batch mode: combined overview of all figures, multi-page PDF (.pdf) '
+                        'or HTML page with thumbnails (.html). Requires --Format png.', default='')
+    parser.add_argument('--ThumbWidth', help='Width of thumbnails in HTML overview in pixels (default 400).', type=int, default=400)
+
+    return parser
+
+
+###
+# READ POSITIONS
+###
+
+def read_head_pos(fname, cache=False):
+    """Read Maxfilter pos-file, same result as mne.chpi.read_head_pos.
+
+    If cache is True, the positions are saved to a .npy-file next to the
+    pos-file, with size and modification time of the pos-file in its name.
+    Later calls read it memory-mapped, as long as the pos-file is unchanged.
+    Returns array (n_samples, 10).
+    """
+    fname_npy = None
+    if cache:
+
+        st = os.stat(fname)
+        fname_npy = '%s.%d_%d.npy' % (fname, st.st_size, st.st_mtime_ns)
+
+        if os.path.exists(fname_npy):
+
+            return np.load(fname_npy, mmap_mode='r')
+
+    # first line is header
+    pos = np.loadtxt(fname, skiprows=1, ndmin=1).ravel()
+
+    if pos.size % 10 != 0 or np.isnan(pos).any():
+
+        raise RuntimeError('positions could not be read properly from %s' %
+                           fname)
+
+    pos.shape = (-1, 10)
+
+    if fname_npy is not None:
+
+        # remove caches of previous versions of pos-file
+        for fname_old in glob.glob(glob.escape(fname) + '.*_*.npy'):
+
+            try:
+                os.remove(fname_old)
+            except OSError:  # e.g. removed by another process meanwhile
+                pass
+
+        try:
+            fname_tmp = fname_npy + '.%d.tmp' % os.getpid()
+            with open(fname_tmp, 'wb') as fid:
+
+                np.save(fid, pos)
+
+            os.replace(fname_tmp, fname_npy)
+        except OSError:
+            print('Could not write cache %s.' % fname_npy)
+
+    return pos
+
+
+def downsample_pos(pos, max_points=12000):
+    """Reduce positions to at most max_points samples for plotting.
+
+    Samples are split into max_points // 12 time buckets. Per bucket, the
+    samples with minimum and maximum of each rotation and translation
+    parameter are kept, so that peaks remain visible.
+    """
+    n_samp = pos.shape[0]
+
+    if max_points <= 0 or n_samp <= max_points:
+
+        return pos
+
+    n_buck = max(max_points // 12, 1)
+    len_buck = -(-n_samp // n_buck)  # ceil
+
+    # pad last bucket with last sample, to reshape into buckets
+    vals = pos[:, 1:7]
+    n_pad = len_buck * n_buck - n_samp
+    if n_pad > 0:
+        vals = np.concatenate((vals, np.repeat(vals[-1:], n_pad, axis=0)))
+
+    vals = vals.reshape(n_buck, len_buck, 6)
 
-import mne
+    offsets = len_buck * np.arange(n_buck)[:, np.newaxis]
 
-print('MNE %s.\n' % mne.__version__)
+    inds = np.concatenate((vals.argmin(axis=1) + offsets,
+                           vals.argmax(axis=1) + offsets), axis=1)
 
-if len(argv)==1:
-    # display help message when no args are passed.
-    exit(1)
+    inds = np.union1d(np.minimum(inds, n_samp - 1), [0, n_samp - 1])
 
-print(mne)
+    return pos[inds]
 
-parser = argparse.ArgumentParser(description='MEG head positions.')
 
-parser.add_argument('--FileRaw', help='Input filename.')
-parser.add_argument('--FileOut', help='Output filename for figure (default: do not save).\
-										If specified, figure will not be shown on screen.', default='')
-parser.add_argument('--mode', help='traces|field (default: traces).', default='traces')
+###
+# HEAD MOTION METRICS
+###
+
+def head_motion(pos):
+    """Displacement (mm) and rotation (deg) per sample of Maxfilter positions.
+
+    pos: array (n_samples, 10) as returned by mne.chpi.read_head_pos, columns
+    time, quaternion q1-q3, x, y, z (m), goodness of fit, error, velocity.
+    Returns dict with per-sample arrays.
+    """
+    times = pos[:, 0]
+    xyz = 1000. * pos[:, 4:7]  # mm
+
+    # unit quaternions, q0 from q1-q3
+    quats = np.empty((len(pos), 4))
+    quats[:, 1:] = pos[:, 1:4]
+    quats[:, 0] = np.sqrt(np.maximum(1. - np.sum(pos[:, 1:4] ** 2, axis=1), 0.))
+
+    # angle between rotations from dot product of quaternions
+    dots = np.clip(np.abs(quats.dot(quats[0])), 0., 1.)
+
+    return {'time': times,
+            'disp_first': np.linalg.norm(xyz - xyz[0], axis=1),
+            'disp_mean': np.linalg.norm(xyz - xyz.mean(axis=0), axis=1),
+            'rot_first': np.degrees(2. * np.arccos(dots)),
+            'step': np.r_[0., np.linalg.norm(np.diff(xyz, axis=0), axis=1)],
+            'xyz': xyz}
+
+
+def motion_summary(pos, trans_threshs=[2., 5.], rot_threshs=[2., 5.]):
+    """Summary metrics of head motion for one pos-file."""
+    motion = head_motion(pos)
+
+    times = motion['time']
+
+    # duration of every sample, for fraction of time above threshold
+    durs = np.diff(times)
+    durs = np.r_[durs, np.median(durs) if len(durs) > 0 else 1.]
+
+    summary = {'n_samples': len(times),
+               'duration_s': float(times[-1] - times[0]),
+               'max_disp_first_mm': float(motion['disp_first'].max()),
+               'mean_disp_first_mm': float(motion['disp_first'].mean()),
+               'max_disp_mean_mm': float(motion['disp_mean'].max()),
+               'mean_disp_mean_mm': float(motion['disp_mean'].mean()),
+               'max_rot_first_deg': float(motion['rot_first'].max()),
+               'mean_rot_first_deg': float(motion['rot_first'].mean()),
+               'path_length_mm': float(motion['step'].sum()),
+               # diagonal of box containing all positions
+               'max_excursion_mm': float(np.linalg.norm(np.ptp(motion['xyz'],
+                                                               axis=0))),
+               'mean_gof': float(pos[:, 7].mean())}
+
+    for thresh in trans_threshs:
+
+        summary['frac_disp_above_%gmm' % thresh] = float(
+            durs[motion['disp_first'] > thresh].sum() / durs.sum())
+
+    for thresh in rot_threshs:
+
+        summary['frac_rot_above_%gdeg' % thresh] = float(
+            durs[motion['rot_first'] > thresh].sum() / durs.sum())
+
+    return summary, motion
+
+
+def write_summary(files, args):
+    """Compute motion metrics for all pos-files, write CSV or JSON."""
+    if args.PerSampleDir != '':
+
+        names = output_names(files, '_motion.csv')
+
+    rows = []
+    for fname in files:
+
+        print('Reading positions from %s.' % fname)
+        pos = read_head_pos(fname, args.PosCache)
+
+        summary, motion = motion_summary(pos, args.TransThresh,
+                                         args.RotThresh)
+
+        rows.append(dict([('file', fname)] + list(summary.items())))
+
+        if args.PerSampleDir != '':
+
+            fname_out = os.path.join(args.PerSampleDir, names[fname])
+
+            np.savetxt(fname_out, np.c_[motion['time'], motion['disp_first'],
+                                        motion['disp_mean'],
+                                        motion['rot_first']],
+                       fmt='%.4f', delimiter=',', comments='',
+                       header='time,disp_first_mm,disp_mean_mm,rot_first_deg')
+
+    print('Writing head motion summary for %d files to %s.' % (len(rows),
+                                                              args.Summary))
+
+    if args.Summary.endswith('.json'):
+
+        with open(args.Summary, 'w') as fid:
+
+            json.dump(rows, fid, indent=1)
+
+    else:
+
+        with open(args.Summary, 'w', newline='') as fid:
+
+            writer = csv.DictWriter(fid, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return rows
 
-args = parser.parse_args()
 
 ###
 # PROCESS DATA
 ###
 
-if args.FileOut != '':
-	plt.ion()
+def plot_positions(args):
+    """Plot head positions of one pos-file, on screen or to file."""
+    from matplotlib import pyplot as plt
+
+    import mne
+
+    print('MNE %s.\n' % mne.__version__)
+
+    print(mne)
+
+    if args.FileOut != '':
+        plt.ion()
+
+    # Read head position from Maxfilter output
+    print('Reading positions from %s.' % args.FileRaw)
+    pos = read_head_pos(args.FileRaw, args.PosCache)
+
+    pos_plot = downsample_pos(pos, args.MaxPoints)
+
+    # Visualise head positions
+    print('Visualising %d of %d samples.' % (pos_plot.shape[0],
+                                             pos.shape[0]))
+    t0 = time.perf_counter()
+    fig = mne.viz.plot_head_positions(pos_plot, mode=args.mode)
+
+    # if filename for figure specified in command line
+    if args.FileOut != '':
+        print('Saving figure to %s.' % args.FileOut)
+
+        fig.savefig(args.FileOut)
+
+        print('Rendered in %.2f s, %.1f kB.' % (time.perf_counter() - t0,
+              os.path.getsize(args.FileOut) / 1e3))
+
+
+###
+# BATCH RENDERING
+###
+
+def output_names(files, suffix):
+    """Unique names of output files (without directory) for pos-files.
+
+    The name of the pos-file is used if it is unique, otherwise its path
+    relative to the common directory of all pos-files, with '_' instead of
+    directory separators. Raises ValueError if names still collide.
+    Returns dict with name per pos-file.
+    """
+    paths = {ff: os.path.abspath(ff) for ff in files}
+
+    names = {ff: os.path.basename(pp) + suffix for [ff, pp] in paths.items()}
+
+    if len(set(names.values())) < len(set(paths.values())):
+
+        # e.g. same name in subject directories
+        common = os.path.commonpath([os.path.dirname(pp)
+                                     for pp in paths.values()])
+
+        names = {ff: os.path.relpath(pp, common).replace(os.sep, '_') + suffix
+                 for [ff, pp] in paths.items()}
+
+    owners = {}
+    for [ff, name] in names.items():
+
+        owners.setdefault(name, set()).add(paths[ff])
+
+    collisions = sorted(name for [name, pp] in owners.items() if len(pp) > 1)
+
+    if collisions != []:
+
+        raise ValueError('Output names of different pos-files collide: %s' %
+                         ', '.join(collisions))
+
+    return names
+
+
+def render_positions(fname, args, names=None):
+    """Plot head positions of one pos-file to image file, without display.
+
+    names: output name per pos-file (see output_names), default name of
+    pos-file.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    import mne
+
+    pos = downsample_pos(read_head_pos(fname, args.PosCache), args.MaxPoints)
+
+    t0 = time.perf_counter()
+    fig = mne.viz.plot_head_positions(pos, mode=args.mode, show=False)
+    fig.suptitle(os.path.basename(fname))
+
+    if names is None:
+
+        names = output_names([fname], '.' + args.Format)
+
+    fname_out = os.path.join(args.OutDir, names[fname])
+
+    fig.savefig(fname_out)
+    plt.close(fig)
+
+    print('Rendered %s in %.2f s, %.1f kB.' % (fname_out,
+          time.perf_counter() - t0, os.path.getsize(fname_out) / 1e3))
+
+    return fname_out
+
+
+def write_index(fname_index, figures, thumb_width=400):
+    """Combine figures into multi-page PDF or HTML page with thumbnails."""
+    print('Writing overview of %d figures to %s.' % (len(figures),
+                                                     fname_index))
+
+    if fname_index.endswith('.pdf'):
+
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        with PdfPages(fname_index) as pdf:
+
+            for [fname, fname_fig] in figures:
+
+                img = plt.imread(fname_fig)
+
+                fig = plt.figure(figsize=(img.shape[1] / 100.,
+                                          img.shape[0] / 100.), dpi=100)
+                ax = fig.add_axes([0, 0, 1, 1])
+                ax.imshow(img)
+                ax.axis('off')
+
+                pdf.savefig(fig)
+                plt.close(fig)
+
+    else:
+
+        index_dir = os.path.dirname(os.path.abspath(fname_index))
+
+        lines = ['<html><head><title>Head positions</title></head><body>',
+                 '<h1>Head positions (%d files)</h1>' % len(figures)]
+
+        for [fname, fname_fig] in figures:
+
+            src = os.path.relpath(os.path.abspath(fname_fig), index_dir)
+
+            lines.append('<div style="display:inline-block;margin:4px">'
+                         '<a href="%s"><img src="%s" width="%d"></a><br>%s'
+                         '</div>' % (src, src, thumb_width, fname))
+
+        lines.append('</body></html>')
+
+        with open(fname_index, 'w') as fid:
+
+            fid.write('\n'.join(lines))
+
+
+def render_batch(files, args):
+    """Render figures for all pos-files in parallel."""
+    # before rendering, pos-files with the same name must not overwrite
+    # each other's figures
+    names = output_names(files, '.' + args.Format)
+
+    os.makedirs(args.OutDir, exist_ok=True)
+
+    print('###\nBatch mode: rendering %d pos-files, %d workers.' %
+          (len(files), args.NJobs))
+
+    results = EMEG_Batch.run_batch(render_positions, files,
+                                   args=(args, names), n_jobs=args.NJobs)
+
+    figures = [[fname, fname_fig] for [fname, fname_fig, _] in results
+               if fname_fig is not None]
+
+    if args.Index != '' and figures != []:
+
+        write_index(args.Index, figures, args.ThumbWidth)
+
+    return EMEG_Batch.print_summary(results, title='Fiff_HeadPositions')
+
+
+def main(argv_in=None):
+
+    print(__doc__)
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == []:
+        # display help message when no args are passed.
+        exit(1)
+
+    args = get_parser().parse_args(argv_in)
+
+    if args.Summary != '':
+
+        files = ([args.FileRaw] if args.FileRaw else []) + args.FilesPos
+
+        write_summary(files, args)
+
+        return
+
+    if args.FilesPos != []:
+
+        files = ([args.FileRaw] if args.FileRaw else []) + args.FilesPos
+
+        failed = render_batch(files, args)
+
+        if failed != []:
+
+            exit(1)
+
+        return
 
-# Read head position from Maxfilter output
-print('Reading positions from %s.' % args.FileRaw)
-pos = mne.chpi.read_head_pos(args.FileRaw) 
+    plot_positions(args)
 
-# Visualise head positions
-print('Visualising positions.')
-fig = mne.viz.plot_head_positions(pos, mode=args.mode)
 
-# if filename for figure specified in command line
-if args.FileOut != '':
-	print('Saving figure to %s.' % args.FileOut)
+if __name__ == '__main__':
 
-	fig.savefig(args.FileOut)
\ No newline at end of file
+    main()
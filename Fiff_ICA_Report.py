@@ -0,0 +1,108 @@
+#!/imaging/local/software/miniconda/envs/mne0.18/bin/python
+"""
+==================================================================================
+Render the HTML report of an ICA decomposition computed earlier with
+Fiff_Compute_ICA.py (e.g. with --Report none or --Report lite).
+Requires the ICA file and its component scores (FileICA-scores.json),
+which Fiff_Compute_ICA.py writes next to the ICA file.
+The raw data are read again only for full reports.
+Figures are rendered in --ReportJobs processes. With --CacheDir, every
+raw file is read and filtered once, and mapped from the cache by the
+processes that need it.
+Reports for several raw files can be rendered with --FileList and/or
+--FileGlob, with the figures of all reports in --ReportJobs processes.
+For more help, type Fiff_ICA_Report.py -h.
+Based on MNE-Python.
+==================================================================================
+"""
+
+from sys import argv, exit
+import argparse
+
+# mne and matplotlib are imported where needed, to start quickly
+
+import EMEG_Batch
+import EMEG_Profile
+import Fiff_Compute_ICA
+from Fiff_Compute_ICA import get_filenames, get_scores_filename, render_reports
+
+###
+# PARSE INPUT ARGUMENTS
+###
+
+
+def get_parser():
+    """Argument parser for Fiff_ICA_Report."""
+    parser = argparse.ArgumentParser(description='Render ICA report.')
+
+    parser.add_argument('--FileRaw', help='Raw filename used for Fiff_Compute_ICA.py.')
+    parser.add_argument('--FileICA', help='ICA decomposition (default FileRaw-ica.fif).', default='')
+    parser.add_argument('--FileHTML', help='Output filename for HTML file with figures (default FileRaw-ica.html).', default='')
+
+    parser.add_argument('--Report', help='lite (component maps and scores as thumbnails) or full (default full).',
+                        choices=['lite', 'full'], default='full')
+    parser.add_argument('--ReportJobs', help='Number of processes rendering report figures (default 1).', type=int,
+                        default=1)
+
+    parser.add_argument('--CacheDir', help='Cache of high-pass filtered data, as for Fiff_Compute_ICA.py '
+                        '(default: no caching, every process reads and filters the data it needs).', default='')
+
+    parser.add_argument('--FileList', help='Text file with one raw file per line. Other filenames are derived from '
+                        'the raw filenames.', default='')
+    parser.add_argument('--FileGlob', help='Glob pattern(s) for raw files (use quotes).', nargs='+', default=[])
+
+    parser.add_argument('--Profile', help='Append time and memory per processing stage to this JSON-lines file '
+                        '(default: no profiling).', default='')
+
+    return parser
+
+
+def main(argv_in=None):
+
+    if argv_in is None:
+        argv_in = argv[1:]
+
+    if argv_in == []:
+        # display help message when no args are passed.
+        print(__doc__)
+        exit(1)
+
+    args = get_parser().parse_args(argv_in)
+
+    files = EMEG_Batch.get_filelist(args.FileList, args.FileGlob)
+
+    if files == []:
+
+        _, ica_fname, fname_html = get_filenames(args.FileRaw, args.FileICA,
+                                                 args.FileHTML)
+        reports = [(get_scores_filename(ica_fname), fname_html)]
+
+    else:
+
+        if args.FileRaw is not None:
+
+            files = [args.FileRaw] + files
+
+        reports = [(get_scores_filename(get_filenames(ff)[1]),
+                    get_filenames(ff)[2]) for ff in files]
+
+    # cache settings as for Fiff_Compute_ICA.py
+    ica_args = Fiff_Compute_ICA.get_parser().parse_args(['--CacheDir',
+                                                         args.CacheDir])
+
+    with EMEG_Profile.profiling(args.Profile, script='Fiff_ICA_Report',
+                                file=args.FileRaw):
+
+        results = render_reports(reports, args.Report, args.ReportJobs,
+                                 args=ica_args, open_browser=len(reports) == 1)
+
+    failed = EMEG_Batch.print_summary(results, title='Fiff_ICA_Report')
+
+    if failed != []:
+
+        exit(1)
+
+
+if __name__ == '__main__':
+
+    main()
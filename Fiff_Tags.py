@@ -0,0 +1,561 @@
+"""
+==================================================================================
+Fast low-level access to tags in fiff-files.
+Reads only the tags that are needed (e.g. the device-to-head transform),
+instead of parsing the complete measurement info with mne.io.read_info.
+Tags are visited in the order of the file and reading stops as soon as the
+requested information has been found, i.e. usually within the first few
+hundred kB of the file.
+Used by AverageSensorArray.py (and its header catalog).
+Subject information can be probed and scrubbed in place for anonymisation
+(Anonymise_Fiff.py), by reading or changing a few bytes of the file.
+The next file of a split recording is read from its file reference.
+For the fiff format, see the MNE manual (Appendix "The FIF file format").
+==================================================================================
+"""
+
+import os
+import struct
+import datetime
+
+import numpy as np
+
+###
+# FIFF CONSTANTS
+###
+
+# tag kinds
+FIFF_FILE_ID = 100
+FIFF_DIR_POINTER = 101
+FIFF_DIR = 102
+FIFF_REF_ROLE = 115
+FIFF_REF_FILE_NAME = 118
+FIFF_BLOCK_START = 104
+FIFF_BLOCK_END = 105
+FIFF_NOP = 108
+FIFF_NCHAN = 200
+FIFF_SFREQ = 201
+FIFF_CH_INFO = 203
+FIFF_COORD_TRANS = 222
+FIFF_SUBJ_ID = 400
+FIFF_SUBJ_FIRST_NAME = 401
+FIFF_SUBJ_MIDDLE_NAME = 402
+FIFF_SUBJ_LAST_NAME = 403
+FIFF_SUBJ_BIRTH_DAY = 404
+FIFF_SUBJ_SEX = 405
+FIFF_SUBJ_HAND = 406
+FIFF_SUBJ_WEIGHT = 407
+FIFF_SUBJ_HEIGHT = 408
+FIFF_SUBJ_COMMENT = 409
+FIFF_SUBJ_HIS_ID = 410
+
+# block kinds
+FIFFB_MEAS = 100
+FIFFB_MEAS_INFO = 101
+FIFFB_RAW_DATA = 102
+FIFFB_SUBJECT = 106
+FIFFB_HPI_RESULT = 109
+FIFFB_REF = 118
+
+# tag data types
+FIFFT_INT = 3
+FIFFT_FLOAT = 4
+FIFFT_STRING = 10
+FIFFT_ID_STRUCT = 31
+FIFFT_COORD_TRANS_STRUCT = 35
+
+# channel kinds
+FIFFV_MEG_CH = 1
+FIFFV_EEG_CH = 2
+
+# coordinate frames
+FIFFV_COORD_DEVICE = 1
+FIFFV_COORD_HEAD = 4
+
+# roles of file references
+FIFFV_ROLE_NEXT_FILE = 2
+
+# next-pointer values
+FIFFV_NEXT_SEQ = 0
+FIFFV_NEXT_NONE = -1
+
+# kind, type, size, next (big-endian)
+TAG_HEADER = struct.Struct('>iiii')
+
+# subject tags that identify the subject (sex, handedness, weight and height
+# are kept)
+SUBJ_IDENT_KINDS = (FIFF_SUBJ_ID, FIFF_SUBJ_FIRST_NAME, FIFF_SUBJ_MIDDLE_NAME,
+                    FIFF_SUBJ_LAST_NAME, FIFF_SUBJ_BIRTH_DAY,
+                    FIFF_SUBJ_COMMENT, FIFF_SUBJ_HIS_ID)
+
+# names of subject tags in measurement info (as in MNE's subject_info)
+SUBJ_NAMES = {FIFF_SUBJ_ID: 'id', FIFF_SUBJ_FIRST_NAME: 'first_name',
+              FIFF_SUBJ_MIDDLE_NAME: 'middle_name',
+              FIFF_SUBJ_LAST_NAME: 'last_name',
+              FIFF_SUBJ_BIRTH_DAY: 'birthday', FIFF_SUBJ_COMMENT: 'comment',
+              FIFF_SUBJ_HIS_ID: 'his_id'}
+
+# julian day of 31 Dec 1 BC, i.e. julian day minus proleptic ordinal
+JULIAN_ORDINAL = 1721425
+
+# from, to, rot (3x3), move (3), invrot (3x3), invmove (3)
+COORD_TRANS = struct.Struct('>ii9f3f9f3f')
+
+
+###
+# READING TAGS
+###
+
+def is_fiff(fid):
+    """Whether file starts with a fiff file-ID tag. Leaves position at 0."""
+    fid.seek(0)
+    hdr = fid.read(TAG_HEADER.size)
+    fid.seek(0)
+
+    if len(hdr) < TAG_HEADER.size:
+
+        return False
+
+    kind, typ, size, _ = TAG_HEADER.unpack(hdr)
+
+    return kind == FIFF_FILE_ID and typ == FIFFT_ID_STRUCT and size == 20
+
+
+def iter_tags(fid):
+    """Visit tags in the order of the file, without reading their data.
+
+    Yields kind, type, size, position of data, and list of kinds of the
+    enclosing blocks (innermost last). Block start and end tags are
+    reported as part of the block they start or end.
+    The list of blocks is updated in place, copy it to keep it.
+    """
+    blocks = []
+    pos = 0
+
+    while True:
+
+        fid.seek(pos)
+        hdr = fid.read(TAG_HEADER.size)
+
+        if len(hdr) < TAG_HEADER.size:
+
+            return
+
+        kind, typ, size, nxt = TAG_HEADER.unpack(hdr)
+
+        if size < 0:  # corrupt file
+
+            return
+
+        data_pos = pos + TAG_HEADER.size
+
+        if kind == FIFF_BLOCK_START:
+
+            blocks.append(read_int(fid, data_pos))
+
+        yield kind, typ, size, data_pos, blocks
+
+        if kind == FIFF_BLOCK_END and blocks != []:
+
+            blocks.pop()
+
+        if nxt == FIFFV_NEXT_SEQ:
+
+            pos = data_pos + size
+
+        elif nxt > 0:
+
+            pos = nxt
+
+        else:
+
+            return
+
+
+def read_data(fid, pos, size):
+    """Raw bytes of tag data."""
+    fid.seek(pos)
+
+    return fid.read(size)
+
+
+def read_int(fid, pos):
+    """Single integer tag."""
+    return struct.unpack('>i', read_data(fid, pos, 4))[0]
+
+
+def read_float(fid, pos):
+    """Single float tag."""
+    return struct.unpack('>f', read_data(fid, pos, 4))[0]
+
+
+def read_coord_trans(fid, pos):
+    """Coordinate transformation tag as from, to, 4x4 matrix, inverse."""
+    vals = COORD_TRANS.unpack(read_data(fid, pos, COORD_TRANS.size))
+
+    trans = np.eye(4)
+    trans[:3, :3] = np.reshape(vals[2:11], (3, 3))
+    trans[:3, 3] = vals[11:14]
+
+    inv = np.eye(4)
+    inv[:3, :3] = np.reshape(vals[14:23], (3, 3))
+    inv[:3, 3] = vals[23:26]
+
+    return vals[0], vals[1], trans, inv
+
+
+###
+# HEADER INFORMATION
+###
+
+def _dev_head_t(fid, pos):
+    """Device-to-head transform from coordinate transformation tag, or None."""
+    frm, to, trans, inv = read_coord_trans(fid, pos)
+
+    if frm == FIFFV_COORD_DEVICE and to == FIFFV_COORD_HEAD:
+
+        return trans
+
+    if frm == FIFFV_COORD_HEAD and to == FIFFV_COORD_DEVICE:
+
+        return inv
+
+    return None
+
+
+def read_dev_head_t(fname):
+    """Device-to-head transform (4x4) from measurement info of fiff-file.
+
+    Only the tags up to the transform are read. Returns None if the file is
+    not a fiff-file or the transform was not found.
+    """
+    with open(fname, 'rb') as fid:
+
+        if not is_fiff(fid):
+
+            return None
+
+        for [kind, _, _, pos, blocks] in iter_tags(fid):
+
+            if blocks == [] or blocks[-1] != FIFFB_MEAS_INFO:
+
+                # transforms in other blocks (e.g. HPI results) don't count
+                continue
+
+            if kind == FIFF_COORD_TRANS:
+
+                trans = _dev_head_t(fid, pos)
+
+                if trans is not None:
+
+                    return trans
+
+            elif kind == FIFF_BLOCK_END:
+
+                # end of measurement info, nothing found
+                return None
+
+    return None
+
+
+def read_header(fname):
+    """Basic measurement info of fiff-file.
+
+    Returns dict with dev_head_t (None if not found), sfreq, nchan, n_meg and
+    n_eeg (numbers of MEG and EEG channels), or None if the file is not a
+    fiff-file. Only the measurement info block is read.
+    """
+    header = {'dev_head_t': None, 'sfreq': None, 'nchan': None, 'n_meg': 0,
+              'n_eeg': 0}
+
+    with open(fname, 'rb') as fid:
+
+        if not is_fiff(fid):
+
+            return None
+
+        for [kind, _, _, pos, blocks] in iter_tags(fid):
+
+            if blocks == [] or blocks[-1] != FIFFB_MEAS_INFO:
+
+                continue
+
+            if kind == FIFF_NCHAN:
+
+                header['nchan'] = read_int(fid, pos)
+
+            elif kind == FIFF_SFREQ:
+
+                header['sfreq'] = read_float(fid, pos)
+
+            elif kind == FIFF_CH_INFO:
+
+                # channel kind follows scan and logical channel numbers
+                ch_kind = read_int(fid, pos + 8)
+
+                header['n_meg'] += ch_kind == FIFFV_MEG_CH
+                header['n_eeg'] += ch_kind == FIFFV_EEG_CH
+
+            elif kind == FIFF_COORD_TRANS and header['dev_head_t'] is None:
+
+                header['dev_head_t'] = _dev_head_t(fid, pos)
+
+            elif kind == FIFF_BLOCK_END:
+
+                break
+
+    return header
+
+
+###
+# SUBJECT INFORMATION
+###
+
+def _subject_tag(fid, kind, size, pos):
+    """Value of identifying subject tag."""
+    if kind in (FIFF_SUBJ_ID, FIFF_SUBJ_BIRTH_DAY):
+
+        val = read_int(fid, pos)
+
+        if kind == FIFF_SUBJ_BIRTH_DAY:
+
+            val = datetime.date.fromordinal(val - JULIAN_ORDINAL)
+
+        return val
+
+    return read_data(fid, pos, size).decode('latin1').rstrip('\x00')
+
+
+def _read_dir(fid):
+    """Tag directory as list of (kind, type, size, data position), or None.
+
+    The position of the directory is read from the directory pointer, which
+    follows the file ID.
+    """
+    hdr = read_data(fid, 20 + TAG_HEADER.size, TAG_HEADER.size)
+
+    if len(hdr) < TAG_HEADER.size:
+
+        return None
+
+    kind, _, _, _ = TAG_HEADER.unpack(hdr)
+
+    if kind != FIFF_DIR_POINTER:
+
+        return None
+
+    dir_pos = read_int(fid, 20 + 2 * TAG_HEADER.size)
+
+    if dir_pos <= 0:
+
+        return None
+
+    kind, _, size, _ = TAG_HEADER.unpack(read_data(fid, dir_pos,
+                                                   TAG_HEADER.size))
+
+    if kind != FIFF_DIR:
+
+        return None
+
+    entries = read_data(fid, dir_pos + TAG_HEADER.size, size)
+
+    return [(kk, tt, ss, pp + TAG_HEADER.size) for [kk, tt, ss, pp] in
+            TAG_HEADER.iter_unpack(entries[:len(entries) -
+                                           len(entries) % TAG_HEADER.size])]
+
+
+def read_subject_info(fname):
+    """Identifying subject information from measurement info of fiff-file.
+
+    Returns dict with the identifying entries that are present (id, names,
+    birthday as date, comment, his_id), or None if the file is not a
+    fiff-file. Uses the tag directory if the file has one, otherwise tags
+    are visited until the end of the subject block.
+    """
+    subject_info = {}
+
+    with open(fname, 'rb') as fid:
+
+        if not is_fiff(fid):
+
+            return None
+
+        tag_dir = _read_dir(fid)
+
+        if tag_dir is not None:
+
+            # subject tags only occur in subject block
+            for [kind, _, size, pos] in tag_dir:
+
+                if kind in SUBJ_NAMES:
+
+                    subject_info[SUBJ_NAMES[kind]] = _subject_tag(fid, kind,
+                                                                  size, pos)
+
+            return subject_info
+
+        for [kind, _, size, pos, blocks] in iter_tags(fid):
+
+            if blocks[-2:] != [FIFFB_MEAS_INFO, FIFFB_SUBJECT]:
+
+                if blocks[-1:] == [FIFFB_MEAS_INFO] and \
+                        kind == FIFF_BLOCK_END:
+
+                    break  # no subject block
+
+                continue
+
+            if kind in SUBJ_NAMES:
+
+                subject_info[SUBJ_NAMES[kind]] = _subject_tag(fid, kind,
+                                                              size, pos)
+
+            elif kind == FIFF_BLOCK_END:
+
+                break
+
+    return subject_info
+
+
+###
+# SPLIT FILES
+###
+
+def read_next_file(fname):
+    """Name of the next file of a split recording, or None.
+
+    The name is taken from the reference to the next file, which is written
+    at the end of every part except the last. Returns the filename in the
+    directory of fname, or None if there is no next file or fname is not a
+    fiff-file.
+    """
+    with open(fname, 'rb') as fid:
+
+        if not is_fiff(fid):
+
+            return None
+
+        tag_dir = _read_dir(fid)
+
+        if tag_dir is not None:
+
+            # reference tags only occur in reference blocks
+            tags = [(kind, size, pos) for [kind, _, size, pos] in tag_dir]
+
+        else:
+
+            tags = ((kind, size, pos) for [kind, _, size, pos, blocks]
+                    in iter_tags(fid) if blocks[-1:] == [FIFFB_REF])
+
+        role = None
+        for [kind, size, pos] in tags:
+
+            if kind == FIFF_REF_ROLE:
+
+                role = read_int(fid, pos)
+
+            elif kind == FIFF_REF_FILE_NAME and role == FIFFV_ROLE_NEXT_FILE:
+
+                name = read_data(fid, pos, size).decode('latin1')
+
+                # parts are found next to each other, wherever they were written
+                return os.path.join(os.path.dirname(fname),
+                                    os.path.basename(name.rstrip('\x00')))
+
+    return None
+
+
+###
+# SCRUBBING SUBJECT INFORMATION
+###
+
+def subject_scrub_edits(fname, kinds=SUBJ_IDENT_KINDS):
+    """Byte edits that turn subject tags into empty no-op tags.
+
+    Tags of kinds in the subject block of the measurement info are changed
+    to FIFF_NOP and their data is zeroed, in the tag itself and in the tag
+    directory (if the file has one). Size and layout of the file stay the
+    same. Returns list of (position, new bytes), or None if the file is not
+    a fiff-file.
+    """
+    edits = []
+    tag_pos = []
+    dir_pos = None
+
+    with open(fname, 'rb') as fid:
+
+        if not is_fiff(fid):
+
+            return None
+
+        for [kind, _, size, pos, blocks] in iter_tags(fid):
+
+            if kind == FIFF_DIR_POINTER:
+
+                dir_pos = read_int(fid, pos)
+
+            elif kind in kinds and blocks[-2:] == [FIFFB_MEAS_INFO,
+                                                   FIFFB_SUBJECT]:
+
+                header_pos = pos - TAG_HEADER.size
+
+                edits.append((header_pos, struct.pack('>i', FIFF_NOP)))
+                edits.append((pos, bytes(size)))
+                tag_pos.append(header_pos)
+
+            elif kind == FIFF_BLOCK_END and blocks[-1:] == [FIFFB_MEAS_INFO]:
+
+                break
+
+        if dir_pos is not None and dir_pos > 0 and tag_pos != []:
+
+            edits += _dir_edits(fid, dir_pos, tag_pos)
+
+    return edits
+
+
+def _dir_edits(fid, dir_pos, tag_pos):
+    """Edits of tag directory that mark tags at tag_pos as no-op tags."""
+    kind, _, size, _ = TAG_HEADER.unpack(read_data(fid, dir_pos,
+                                                   TAG_HEADER.size))
+
+    if kind != FIFF_DIR:
+
+        return []
+
+    # directory entries have the same layout as tag headers, with the
+    # position of the tag instead of the next-pointer
+    data_pos = dir_pos + TAG_HEADER.size
+    entries = read_data(fid, data_pos, size)
+
+    edits = []
+    for ii in range(len(entries) // TAG_HEADER.size):
+
+        _, _, _, pos = TAG_HEADER.unpack_from(entries, ii * TAG_HEADER.size)
+
+        if pos in tag_pos:
+
+            edits.append((data_pos + ii * TAG_HEADER.size,
+                          struct.pack('>i', FIFF_NOP)))
+
+    return edits
+
+
+def read_edits(fname, edits):
+    """Current bytes at the positions of edits, e.g. for undoing them."""
+    with open(fname, 'rb') as fid:
+
+        return [(pos, read_data(fid, pos, len(data))) for [pos, data] in edits]
+
+
+def write_edits(fname, edits):
+    """Write bytes at positions in place, and flush them to disk."""
+    with open(fname, 'r+b') as fid:
+
+        for [pos, data] in edits:
+
+            fid.seek(pos)
+            fid.write(data)
+
+        fid.flush()
+        os.fsync(fid.fileno())
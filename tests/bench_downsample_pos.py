@@ -0,0 +1,61 @@
+"""
+Benchmark of plotting head positions (Fiff_HeadPositions.render_positions).
+Compares render time (best of 3) and size of figures for all samples
+(--MaxPoints 0) and for positions reduced with downsample_pos, for a
+synthetic pos-file of 4 hours (Maxfilter writes 10 positions per second),
+as png and pdf.
+Run as: python tests/bench_downsample_pos.py [hours]
+Not collected by pytest.
+"""
+import os
+import sys
+import tempfile
+
+import numpy as np
+import mne
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Fiff_HeadPositions  # noqa: E402
+from bench_read_head_pos import best_of  # noqa: E402
+
+
+def main(hours=4.):
+
+    n_samples = int(hours * 3600 * 10)
+
+    # slow drift with noise, as for a subject moving during the recording
+    rng = np.random.RandomState(0)
+    pos = np.cumsum(rng.randn(n_samples, 10), axis=0) * 1e-5
+    pos[:, 0] = np.arange(n_samples) / 10.
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        fname = os.path.join(tmp_dir, 'bench.pos')
+        mne.chpi.write_head_pos(fname, pos)
+
+        print('pos-file: %d rows, %.1f MB' % (n_samples, os.path.getsize(fname) / 1e6))
+
+        # positions are read from cache, times are for downsampling and plotting
+        Fiff_HeadPositions.read_head_pos(fname, cache=True)
+
+        for fmt in ['png', 'pdf']:
+
+            for max_points in [0, 48000, 12000, 3000]:
+
+                args = Fiff_HeadPositions.get_parser().parse_args(
+                    ['--MaxPoints', str(max_points), '--OutDir', tmp_dir,
+                     '--Format', fmt, '--PosCache'])
+
+                t_render = best_of(lambda: Fiff_HeadPositions.render_positions(
+                    fname, args))
+                fname_out = os.path.join(tmp_dir, Fiff_HeadPositions.output_names(
+                    [fname], '.' + fmt)[fname])
+
+                print('%s, MaxPoints %6d:   %.2f s, %8.1f kB' % (
+                    fmt, max_points, t_render, os.path.getsize(fname_out) / 1e3))
+
+
+if __name__ == '__main__':
+
+    main(*[float(aa) for aa in sys.argv[1:2]])
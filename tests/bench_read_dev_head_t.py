@@ -0,0 +1,79 @@
+"""
+Benchmark of reading device-to-head transforms (AverageSensorArray.py).
+Compares mne.io.read_info with the header-only Fiff_Tags.read_dev_head_t,
+one file at a time and with AverageSensorArray.read_transforms (threads),
+for a synthetic set of fiff-files with 306 MEG and 60 EEG channels.
+Run as: python tests/bench_read_dev_head_t.py [n_files]
+Not collected by pytest.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import mne
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import AverageSensorArray  # noqa: E402
+import Fiff_Tags  # noqa: E402
+
+
+def timed(func):
+    """Result of func and time it took."""
+    t0 = time.perf_counter()
+    result = func()
+
+    return result, time.perf_counter() - t0
+
+
+def write_files(path, n_files):
+    """Fiff-files with measurement info only, random head positions."""
+    rng = np.random.RandomState(0)
+
+    info = mne.create_info(['MEG%04d' % ii for ii in range(306)] +
+                           ['EEG%03d' % ii for ii in range(60)], 1000.,
+                           ['grad'] * 204 + ['mag'] * 102 + ['eeg'] * 60)
+
+    fnames = []
+    for ii in range(n_files):
+
+        trans = np.eye(4)
+        trans[:3, 3] = rng.uniform(-0.01, 0.01, 3) + [0., 0., 0.04]
+        info['dev_head_t'] = mne.transforms.Transform('meg', 'head', trans)
+
+        fname = os.path.join(path, 'sub%05d-info.fif' % ii)
+        mne.io.write_info(fname, info)
+        fnames.append(fname)
+
+    return fnames
+
+
+def main(n_files=2000):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        fnames, t_write = timed(lambda: write_files(tmp_dir, int(n_files)))
+        print('%d files written in %.1f s.' % (len(fnames), t_write))
+
+        ref, t_mne = timed(lambda: [
+            mne.io.read_info(ff, verbose=False)['dev_head_t']['trans']
+            for ff in fnames])
+        tags, t_tags = timed(lambda: [Fiff_Tags.read_dev_head_t(ff)
+                                      for ff in fnames])
+        threads, t_threads = timed(
+            lambda: AverageSensorArray.read_transforms(fnames))
+
+        assert all(np.array_equal(aa, bb) and np.array_equal(aa, cc)
+                   for [aa, bb, cc] in zip(ref, tags, threads))
+
+        print('mne.io.read_info:                  %.3f s' % t_mne)
+        print('Fiff_Tags.read_dev_head_t:         %.3f s' % t_tags)
+        print('read_transforms (16 threads):      %.3f s' % t_threads)
+        print('Identical transforms.')
+
+
+if __name__ == '__main__':
+
+    main(*[int(aa) for aa in sys.argv[1:2]])
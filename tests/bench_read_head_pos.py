@@ -0,0 +1,70 @@
+"""
+Benchmark of reading head positions (Fiff_HeadPositions.read_head_pos).
+Compares mne.chpi.read_head_pos with read_head_pos without cache, on the
+first run with cache, and on a cache hit, for a synthetic pos-file of
+4 hours (Maxfilter writes 10 positions per second).
+Run as: python tests/bench_read_head_pos.py [hours]
+Not collected by pytest.
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import mne
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Fiff_HeadPositions  # noqa: E402
+
+
+def best_of(func, n_repeats=3, setup=None):
+    """Best time of n_repeats calls of func, setup is called before each."""
+    times = []
+
+    for _ in range(n_repeats):
+
+        if setup is not None:
+            setup()
+
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    return min(times)
+
+
+def main(hours=4.):
+
+    n_samples = int(hours * 3600 * 10)
+
+    pos = np.random.RandomState(0).randn(n_samples, 10)
+    pos[:, 0] = np.arange(n_samples) / 10.
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        fname = os.path.join(tmp_dir, 'bench.pos')
+        mne.chpi.write_head_pos(fname, pos)
+
+        def clear_cache():
+            for ff in os.listdir(tmp_dir):
+                if ff.endswith('.npy'):
+                    os.remove(os.path.join(tmp_dir, ff))
+
+        print('pos-file: %d rows, %.1f MB' % (n_samples, os.path.getsize(fname) / 1e6))
+
+        print('mne.chpi.read_head_pos:     %.4f s' % best_of(
+            lambda: mne.chpi.read_head_pos(fname)))
+        print('read_head_pos, no cache:    %.4f s' % best_of(
+            lambda: Fiff_HeadPositions.read_head_pos(fname)))
+        print('read_head_pos, first run:   %.4f s' % best_of(
+            lambda: Fiff_HeadPositions.read_head_pos(fname, cache=True),
+            setup=clear_cache))
+        print('read_head_pos, cache hit:   %.4f s' % best_of(
+            lambda: Fiff_HeadPositions.read_head_pos(fname, cache=True)))
+
+
+if __name__ == '__main__':
+
+    main(*[float(aa) for aa in sys.argv[1:2]])
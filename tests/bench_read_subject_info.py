@@ -0,0 +1,115 @@
+"""
+Benchmark of probing subject information (Anonymise_Fiff.py).
+Compares mne.io.read_info with Fiff_Tags.read_subject_info on a synthetic
+tree of fiff-files with 306 MEG and 60 EEG channels (half of them with a
+tag directory, 3/4 with subject information) and of .fif files that are
+not fiff-files.
+Run as: python tests/bench_read_subject_info.py [n_files]
+Not collected by pytest.
+"""
+import os
+import sys
+import tempfile
+import time
+import datetime
+
+import numpy as np
+import mne
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(tests_dir))
+sys.path.insert(0, tests_dir)
+
+import Anonymise_Fiff  # noqa: E402
+import Fiff_Tags  # noqa: E402
+from test_fiff_tags import _add_directory, _ident  # noqa: E402
+
+
+def timed(func):
+    """Result of func and time it took."""
+    t0 = time.perf_counter()
+    result = func()
+
+    return result, time.perf_counter() - t0
+
+
+def write_tree(path, n_files):
+    """Fiff-files in subject directories, and non-fiff .fif files."""
+    info = mne.create_info(['MEG%04d' % ii for ii in range(306)] +
+                           ['EEG%03d' % ii for ii in range(60)], 1000.,
+                           ['grad'] * 204 + ['mag'] * 102 + ['eeg'] * 60)
+
+    rng = np.random.RandomState(0)
+
+    fiff, other = [], []
+    for ii in range(n_files):
+
+        sub_dir = os.path.join(path, 'sub%03d' % (ii // 10))
+        os.makedirs(sub_dir, exist_ok=True)
+
+        fname = os.path.join(sub_dir, 'run%d_raw.fif' % (ii % 10))
+
+        if ii % 4 != 0:
+
+            info['subject_info'] = {
+                'id': ii, 'first_name': 'Jane', 'last_name': 'Doe',
+                'birthday': datetime.date(1950 + ii % 50, 5, 6)}
+
+        else:
+
+            info['subject_info'] = None
+
+        mne.io.write_info(fname, info)
+
+        if ii % 2 == 0:
+
+            _add_directory(fname)
+
+        fiff.append(fname)
+
+    for ii in range(n_files // 8):
+
+        fname = os.path.join(os.path.dirname(fiff[8 * ii]),
+                             'notes%d.fif' % ii)
+        with open(fname, 'wb') as fid:
+            fid.write(rng.bytes(10000))
+
+        other.append(fname)
+
+    return fiff, other
+
+
+def main(n_files=400):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        [fiff, other], t_write = timed(lambda: write_tree(tmp_dir, n_files))
+        print('%d fiff-files and %d other files written in %.1f s.' %
+              (len(fiff), len(other), t_write))
+
+        found = Anonymise_Fiff.find_fiff_files([tmp_dir])
+        assert len(found) == len(fiff) + len(other)
+
+        ref, t_mne = timed(lambda: [
+            _ident(mne.io.read_info(ff, verbose=False)['subject_info'])
+            for ff in fiff])
+        probe, t_tags = timed(lambda: [Fiff_Tags.read_subject_info(ff)
+                                       for ff in fiff])
+        rejected, t_other = timed(lambda: [Fiff_Tags.read_subject_info(ff)
+                                           for ff in other])
+
+        assert probe == ref
+        assert rejected == [None] * len(other)
+
+        print('mne.io.read_info:          %.3f ms/file' %
+              (1e3 * t_mne / len(fiff)))
+        print('read_subject_info:         %.3f ms/file (%.0fx faster)' %
+              (1e3 * t_tags / len(fiff), t_mne / t_tags))
+        print('non-fiff rejection:        %.1f us/file' %
+              (1e6 * t_other / len(other)))
+        print('Identical subject information.')
+
+
+if __name__ == '__main__':
+
+    main(*[int(aa) for aa in sys.argv[1:2]])
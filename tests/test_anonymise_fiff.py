@@ -0,0 +1,231 @@
+"""Tests for Anonymise_Fiff.py on small synthetic fiff-files."""
+import datetime
+import os
+import shlex
+import sys
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+import Anonymise_Fiff  # noqa: E402
+import Fiff_Tags  # noqa: E402
+
+
+def _save_raw(fname, year, n_seconds=2., split_size='2GB'):
+    """Save raw file with subject information and birthday in year."""
+    info = mne.create_info(['MEG%03d' % ii for ii in range(40)], 1000., 'mag')
+    raw = mne.io.RawArray(np.zeros((40, int(n_seconds * 1000))), info,
+                          verbose=False)
+
+    # date in recent MNE versions, tuple in older ones
+    for birthday in (datetime.date(year, 5, 6), (year, 5, 6)):
+
+        try:
+            raw.info['subject_info'] = {'id': 7, 'first_name': 'Jane',
+                                        'birthday': birthday}
+            raw.save(str(fname), split_size=split_size, overwrite=True,
+                     verbose=False)
+        except (TypeError, ValueError):
+            continue
+
+        return
+
+    raise RuntimeError('Could not write birthday.')
+
+
+def _run(tmp_path):
+    """Anonymise files in tmp_path, return files that didn't work."""
+    return Anonymise_Fiff.main(['--SearchPaths', str(tmp_path / 'data'),
+                                '--Manifest', str(tmp_path / 'man.sqlite'),
+                                '--NJobs', '2'])
+
+
+def test_similar_names_are_probed_separately(tmp_path):
+    """sub-01.fif is not a split part of sub.fif without file reference."""
+    (tmp_path / 'data').mkdir()
+    _save_raw(tmp_path / 'data' / 'sub.fif', 1850)
+    _save_raw(tmp_path / 'data' / 'sub-01.fif', 1984)
+
+    files = Anonymise_Fiff.find_fiff_files([str(tmp_path / 'data')])
+    assert len(Anonymise_Fiff.group_recordings(sorted(files), files)) == 2
+
+    assert _run(tmp_path) == []
+
+    info = Fiff_Tags.read_subject_info(str(tmp_path / 'data' / 'sub-01.fif'))
+    assert info == {}
+
+    info = Fiff_Tags.read_subject_info(str(tmp_path / 'data' / 'sub.fif'))
+    assert info['birthday'].year == 1850
+
+
+def test_split_recording_is_anonymised_together(tmp_path):
+    """Parts linked by next-file references form one recording."""
+    (tmp_path / 'data').mkdir()
+    fname = tmp_path / 'data' / 'rec_raw.fif'
+    _save_raw(fname, 1984, n_seconds=80., split_size='10MB')
+
+    files = Anonymise_Fiff.find_fiff_files([str(tmp_path / 'data')])
+    assert len(files) > 1
+
+    recordings = Anonymise_Fiff.group_recordings(sorted(files), files)
+    assert len(recordings) == 1
+    assert recordings[0][0] == [str(fname)]
+
+    assert _run(tmp_path) == []
+
+    for filename in files:
+        assert Fiff_Tags.read_subject_info(filename) == {}
+
+
+def test_split_recording_is_probed_once(tmp_path, monkeypatch):
+    """Only the first part of a split recording is probed."""
+    (tmp_path / 'data').mkdir()
+    fname = tmp_path / 'data' / 'rec_raw.fif'
+    _save_raw(fname, 1984, n_seconds=80., split_size='10MB')
+
+    probed = []
+    needs_anonymising = Anonymise_Fiff.needs_anonymising
+    monkeypatch.setattr(Anonymise_Fiff, 'needs_anonymising',
+                        lambda filename, yob_thresh: probed.append(filename)
+                        or needs_anonymising(filename, yob_thresh))
+
+    assert _run(tmp_path) == []
+    assert probed == [str(fname)]
+
+
+def _fail(*args):
+    raise PermissionError('read-only')
+
+
+def test_write_failure_is_reported(tmp_path, monkeypatch):
+    """A file that cannot be written fails, and stays unchanged."""
+    (tmp_path / 'data').mkdir()
+    fname = str(tmp_path / 'data' / 'ro_raw.fif')
+    _save_raw(fname, 1984)
+    _save_raw(tmp_path / 'data' / 'ok_raw.fif', 1984)
+
+    with open(fname, 'rb') as fid:
+        original = fid.read()
+
+    write_edits = Fiff_Tags.write_edits
+    monkeypatch.setattr(Fiff_Tags, 'write_edits', lambda fname_edit, edits:
+                        _fail() if fname_edit == fname else
+                        write_edits(fname_edit, edits))
+
+    assert _run(tmp_path) == [fname]
+
+    with open(fname, 'rb') as fid:
+        assert fid.read() == original
+
+    # nothing changed, nothing to roll back in the next run
+    assert not (tmp_path / 'data' / ('ro_raw.fif' +
+                                     Anonymise_Fiff.journal_suffix)).exists()
+
+    info = Fiff_Tags.read_subject_info(str(tmp_path / 'data' / 'ok_raw.fif'))
+    assert info == {}
+
+
+def test_rollback_failure_is_reported(tmp_path, monkeypatch):
+    """An interrupted run that cannot be rolled back fails every run."""
+    (tmp_path / 'data').mkdir()
+    fname = str(tmp_path / 'data' / 'int_raw.fif')
+    _save_raw(fname, 1984)
+
+    # interrupted after changing the file
+    edits = Fiff_Tags.subject_scrub_edits(fname)
+    Anonymise_Fiff.write_journal(fname + Anonymise_Fiff.journal_suffix,
+                                 Fiff_Tags.read_edits(fname, edits))
+    Fiff_Tags.write_edits(fname, edits)
+
+    monkeypatch.setattr(Fiff_Tags, 'write_edits', _fail)
+
+    for _ in range(2):
+        assert _run(tmp_path) == [fname]
+
+    assert (tmp_path / 'data' / ('int_raw.fif' +
+                                 Anonymise_Fiff.journal_suffix)).exists()
+
+    monkeypatch.undo()
+
+    assert _run(tmp_path) == []
+    assert Fiff_Tags.read_subject_info(fname) == {}
+
+
+def test_manifest_is_kept_when_interrupted(tmp_path, monkeypatch):
+    """Results before an interruption are in the manifest."""
+    (tmp_path / 'data').mkdir()
+    for name in ['a_raw.fif', 'b_raw.fif', 'c_raw.fif']:
+        _save_raw(tmp_path / 'data' / name, 1984)
+
+    anonymise_recording = Anonymise_Fiff.anonymise_recording
+
+    def interrupt_at_c(recording, *args):
+        if recording[0][0].endswith('c_raw.fif'):
+            raise KeyboardInterrupt
+        return anonymise_recording(recording, *args)
+
+    monkeypatch.setattr(Anonymise_Fiff, 'manifest_batch', 1)
+    monkeypatch.setattr(Anonymise_Fiff, 'anonymise_recording', interrupt_at_c)
+
+    with pytest.raises(KeyboardInterrupt):
+        Anonymise_Fiff.main(['--SearchPaths', str(tmp_path / 'data'),
+                             '--Manifest', str(tmp_path / 'man.sqlite'),
+                             '--NJobs', '1'])
+
+    conn = Anonymise_Fiff.open_manifest(str(tmp_path / 'man.sqlite'))
+    states = dict(conn.execute('SELECT path, state FROM files'))
+    conn.close()
+
+    assert states == {str(tmp_path / 'data' / 'a_raw.fif'): 'success',
+                      str(tmp_path / 'data' / 'b_raw.fif'): 'success'}
+
+
+# stand-in for fiff_anonymise: writes <stem>_anon.fif in the current directory
+stand_in = """import os, shutil, sys
+sys.path.insert(0, %r)
+import Anonymise_Fiff
+[mode, fname] = sys.argv[1:]
+anon_fname = fname.split('.')[0] + '_anon.fif'
+if mode == 'ok':
+    shutil.copy(fname, anon_fname)
+    Anonymise_Fiff.anonymise_native(anon_fname)
+elif mode == 'short':
+    with open(fname, 'rb') as fid:
+        data = fid.read()
+    with open(anon_fname, 'wb') as fid:
+        fid.write(data[:-100])
+"""
+
+
+@pytest.mark.parametrize('mode', ['ok', 'none', 'short'])
+def test_command_engine(tmp_path, mode):
+    """Command output replaces the file only if it is there, of same size."""
+    (tmp_path / 'data').mkdir()
+    fname = str(tmp_path / 'data' / 'cmd_raw.fif')
+    _save_raw(fname, 1984)
+
+    with open(fname, 'rb') as fid:
+        original = fid.read()
+
+    script = tmp_path / 'stand_in.py'
+    script.write_text(stand_in % os.path.dirname(Anonymise_Fiff.__file__))
+
+    failed = Anonymise_Fiff.main([
+        '--SearchPaths', str(tmp_path / 'data'), '--Engine', 'command',
+        '--Command', ' '.join(shlex.quote(arg) for arg in
+                              [sys.executable, str(script), mode]),
+        '--Manifest', str(tmp_path / 'man.sqlite')])
+
+    if mode == 'ok':
+        assert failed == []
+        assert Fiff_Tags.read_subject_info(fname) == {}
+        assert sorted(os.listdir(str(tmp_path / 'data'))) == ['cmd_raw.fif']
+
+    else:
+        assert failed == [fname]
+        with open(fname, 'rb') as fid:
+            assert fid.read() == original
+        assert not os.path.exists(fname.replace('.fif',
+                                                '_keep_zyx987654321.fif'))
@@ -0,0 +1,133 @@
+"""Tests for Fiff_Apply_ICA.py on a small synthetic recording."""
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+import Fiff_Apply_ICA  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def raw_ica(tmp_path_factory):
+    """Raw file and ICA file with components to remove."""
+    path = tmp_path_factory.mktemp('apply')
+    rng = np.random.RandomState(0)
+
+    n_meg, sfreq, n_times = 10, 250., 20000
+    info = mne.create_info(['MEG%03d' % ii for ii in range(n_meg)] +
+                           ['EOG061'], sfreq, ['mag'] * n_meg + ['eog'])
+    sources = rng.laplace(size=(n_meg, n_times))
+    data = np.vstack([rng.randn(n_meg, n_meg).dot(sources) * 1e-13,
+                      sources[:1] * 1e-5])
+
+    raw = mne.io.RawArray(data, info, verbose=False)
+    raw_fname = str(path / 'sub_raw.fif')
+    raw.save(raw_fname, verbose=False)
+
+    ica = mne.preprocessing.ICA(n_components=6, method='infomax',
+                                random_state=23)
+    ica.fit(raw.copy().filter(1., None, verbose=False), picks='mag',
+            verbose=False)
+    ica.exclude = [0, 3]
+    ica_fname = str(path / 'sub_raw-ica.fif')
+    ica.save(ica_fname, verbose=False)
+
+    return raw_fname, ica_fname
+
+
+def _apply(raw_fname, argv, name):
+    """Apply ICA with command line options, return data of output files."""
+    args = Fiff_Apply_ICA.get_parser().parse_args(argv)
+    fnames = Fiff_Apply_ICA.apply_ica(
+        raw_fname, args, file_raw_out=raw_fname.replace('sub_raw', name))
+
+    return [mne.io.read_raw_fif(ff, verbose=False).get_data() for ff in fnames]
+
+
+def _reference(raw_fname, ica_fname, exclude):
+    """Data cleaned by ica.apply, saved and read back as the tool does."""
+    raw = mne.io.read_raw_fif(raw_fname, preload=True, verbose=False)
+    ica = mne.preprocessing.read_ica(ica_fname, verbose=False)
+
+    # exclude of ica.apply would be added to ica.exclude
+    ica.exclude = exclude
+    ica.apply(raw, verbose=False)
+
+    fname = raw_fname.replace('sub_raw', 'ref%s_raw' % len(exclude))
+    raw.save(fname, overwrite=True, verbose=False)
+
+    return mne.io.read_raw_fif(fname, verbose=False).get_data()
+
+
+def test_stream_identical_to_memory(raw_ica):
+    """Block-wise cleaning from memory-mapped file gives the same data."""
+    raw_fname, ica_fname = raw_ica
+
+    [memory] = _apply(raw_fname, [], 'mem_raw')
+    [stream] = _apply(raw_fname, ['--Stream', '--BlockSec', '7'], 'str_raw')
+
+    assert np.array_equal(stream, memory)
+    assert np.array_equal(memory, _reference(raw_fname, ica_fname, [0, 3]))
+
+
+def test_component_sets_identical_to_ica_apply(raw_ica):
+    """Every set of components gives the same data as ica.apply."""
+    raw_fname, ica_fname = raw_ica
+
+    variants = _apply(raw_fname, ['--Stream', '--ICAcompsSet', '0', '3',
+                                  '--ICAcompsSet', '1'], 'var_raw')
+
+    assert np.array_equal(variants[0],
+                          _reference(raw_fname, ica_fname, [0, 3]))
+    assert np.array_equal(variants[1], _reference(raw_fname, ica_fname, [1]))
+
+
+def test_profile_of_one_call_only(raw_ica, tmp_path):
+    """Calls without --Profile don't append to the profile of earlier calls."""
+    raw_fname, _ = raw_ica
+    fname_prof = str(tmp_path / 'prof.jsonl')
+
+    _apply(raw_fname, ['--Profile', fname_prof], 'prof_raw')
+
+    with open(fname_prof) as fid:
+        n_lines = len(fid.readlines())
+
+    assert n_lines > 0
+
+    _apply(raw_fname, [], 'noprof_raw')
+
+    with open(fname_prof) as fid:
+        assert len(fid.readlines()) == n_lines
+
+
+def test_manifest_is_kept_when_interrupted(raw_ica, tmp_path, monkeypatch):
+    """Outputs built before an interruption are in the manifest."""
+    raw_fname, ica_fname = raw_ica
+    for name in ['a', 'b', 'c']:
+        shutil.copy(raw_fname, str(tmp_path / ('%s_raw.fif' % name)))
+        shutil.copy(ica_fname, str(tmp_path / ('%s_raw-ica.fif' % name)))
+
+    apply_ica_batch = Fiff_Apply_ICA._apply_ica_batch
+
+    def interrupt_at_c(file_raw_in, args):
+        if file_raw_in.endswith('c_raw.fif'):
+            raise KeyboardInterrupt
+        return apply_ica_batch(file_raw_in, args)
+
+    monkeypatch.setattr(Fiff_Apply_ICA, 'manifest_batch', 1)
+    monkeypatch.setattr(Fiff_Apply_ICA, '_apply_ica_batch', interrupt_at_c)
+
+    fname_man = str(tmp_path / 'manifest.json')
+    with pytest.raises(KeyboardInterrupt):
+        Fiff_Apply_ICA.main(['--FileGlob', str(tmp_path / '?_raw.fif'),
+                             '--Manifest', fname_man])
+
+    with open(fname_man) as fid:
+        manifest = json.load(fid)
+
+    assert sorted(manifest) == [os.path.realpath(str(tmp_path / name))
+                                for name in ['a_raw.fif', 'b_raw.fif']]
@@ -0,0 +1,16 @@
+"""Tests for EMEG_Batch.py."""
+import os
+import re
+
+import EMEG_Batch
+
+
+def test_progress_counts_finished_tasks(capsys):
+    """Progress counts finished tasks, whatever the order they finish in."""
+    items = ['a/1.fif', 'b/2.fif', 'c/3.fif', 'd/4.fif']
+
+    results = EMEG_Batch.run_batch(os.path.basename, items, n_jobs=2)
+
+    assert [rr[1] for rr in results] == ['1.fif', '2.fif', '3.fif', '4.fif']
+    assert re.findall(r'Finished (\d) of 4', capsys.readouterr().out) == \
+        ['1', '2', '3', '4']
@@ -0,0 +1,212 @@
+"""Tests for Fiff_Compute_ICA.py on small synthetic data."""
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+import Fiff_Compute_ICA  # noqa: E402
+
+
+def _make_raw(n_seconds=60., sfreq=250., n_meg=12, seed=0):
+    """Raw data with blink and heartbeat sources, and EOG/ECG channels."""
+    rng = np.random.RandomState(seed)
+    n_times = int(n_seconds * sfreq)
+
+    blinks = np.zeros(n_times)
+    for t_blink in rng.uniform(1., n_seconds - 1., int(n_seconds / 3.)):
+        win = np.hanning(int(0.3 * sfreq))
+        ii = int(t_blink * sfreq)
+        blinks[ii:ii + len(win)] += win
+
+    beats = np.zeros(n_times)
+    for t_beat in np.arange(0.5, n_seconds - 1., 0.9):
+        win = np.hanning(int(0.05 * sfreq))
+        ii = int(t_beat * sfreq)
+        beats[ii:ii + len(win)] += win
+
+    sources = np.vstack([5. * blinks, 3. * beats,
+                         rng.randn(n_meg - 2, n_times)])
+    meg = rng.randn(n_meg, n_meg).dot(sources) * 1e-13
+
+    eog = blinks * 1e-4 + rng.randn(n_times) * 1e-6
+    ecg = beats * 1e-3 + rng.randn(n_times) * 1e-5
+
+    ch_names = ['MEG%03d' % ii for ii in range(n_meg)] + ['EOG061', 'EOG062',
+                                                          'ECG063']
+    info = mne.create_info(ch_names, sfreq,
+                           ['mag'] * n_meg + ['eog', 'eog', 'ecg'])
+    data = np.vstack([meg, eog, 0.5 * eog + rng.randn(n_times) * 1e-5, ecg])
+
+    return mne.io.RawArray(data, info, verbose=False)
+
+
+@pytest.fixture(scope='module')
+def fitted():
+    """Filtered raw data and ICA fitted to it."""
+    raw = _make_raw()
+    raw.filter(1., None, fir_design='firwin', verbose=False)
+
+    ica = mne.preprocessing.ICA(n_components=8, method='infomax',
+                                random_state=23)
+    ica.fit(raw, picks='mag', decim=3, verbose=False)
+
+    return raw, ica
+
+
+def test_eog_scores_as_find_bads_eog(fitted):
+    """Scores and components are the same as from ica.find_bads_eog."""
+    raw, ica = fitted
+    ch_names = ['EOG061', 'EOG062']
+    reject = {'mag': 1e-11}
+
+    epochs_list = Fiff_Compute_ICA._artefact_epochs(raw, 'EOG', ch_names,
+                                                    reject)
+    scores = Fiff_Compute_ICA.SourceScorer(ica, raw).scores('EOG', ch_names,
+                                                            epochs_list)
+
+    for [ch, epochs, score] in zip(ch_names, epochs_list, scores):
+
+        inds, ref = ica.find_bads_eog(epochs, ch_name=ch, threshold=3.,
+                                      verbose=False)
+
+        np.testing.assert_allclose(score, ref, atol=1e-10)
+
+        bads = Fiff_Compute_ICA._artefact_bads('EOG', score, [3.])[0]
+        assert Fiff_Compute_ICA._bad_inds(score, bads) == list(inds)
+
+
+@pytest.mark.parametrize('method, thresh', [('ctps', 0.25),
+                                            ('correlation', 3.)])
+def test_ecg_scores_as_find_bads_ecg(fitted, method, thresh):
+    """Scores and components are the same as from ica.find_bads_ecg."""
+    raw, ica = fitted
+
+    epochs_list = Fiff_Compute_ICA._artefact_epochs(raw, 'ECG', ['ECG063'],
+                                                    {'mag': 1e-11})
+    score = Fiff_Compute_ICA.SourceScorer(ica, raw).scores(
+        'ECG', ['ECG063'], epochs_list, method)[0]
+
+    inds, ref = ica.find_bads_ecg(epochs_list[0], ch_name='ECG063',
+                                  method=method, threshold=thresh,
+                                  verbose=False)
+
+    np.testing.assert_allclose(score, ref, atol=1e-10)
+
+    bads = Fiff_Compute_ICA._artefact_bads('ECG', score, [thresh], method)[0]
+    assert sorted(Fiff_Compute_ICA._bad_inds(score, bads)) == sorted(inds)
+
+
+def test_filtered_data_without_cache_space(tmp_path, monkeypatch):
+    """A cache that cannot be written leaves the filtered data intact."""
+    raw_fname = str(tmp_path / 'sub_raw.fif')
+    _make_raw(n_seconds=20.).save(raw_fname, verbose=False)
+
+    args = Fiff_Compute_ICA.get_parser().parse_args(
+        ['--CacheDir', str(tmp_path / 'cache')])
+
+    def disk_full(*args, **kwargs):
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(np, 'save', disk_full)
+
+    raw = Fiff_Compute_ICA._load_filtered(
+        mne.io.read_raw_fif(raw_fname, verbose=False), ['MEG000', 'MEG001'],
+        args)
+
+    ref = mne.io.read_raw_fif(raw_fname, preload=True, verbose=False)
+    ref.pick_channels(['MEG000', 'MEG001'])
+    ref.filter(1., None, fir_design='firwin', verbose=False)
+
+    np.testing.assert_array_equal(raw.get_data(), ref.get_data())
+    assert [ff for ff in (tmp_path / 'cache').iterdir()] == []
+
+
+def test_rerun_replaces_ica(tmp_path):
+    """A second run with other EOG threshold replaces the ICA file."""
+    raw_fname = str(tmp_path / 'sub_raw.fif')
+    _make_raw().save(raw_fname, verbose=False)
+
+    argv = ['--method', 'infomax', '--n_pca_comps', '8', '--Report', 'none',
+            '--CacheDir', str(tmp_path / 'cache')]
+
+    first = Fiff_Compute_ICA.compute_ica(
+        raw_fname, Fiff_Compute_ICA.get_parser().parse_args(argv))
+    second = Fiff_Compute_ICA.compute_ica(
+        raw_fname, Fiff_Compute_ICA.get_parser().parse_args(
+            argv + ['--EOGthresh', '2.5']))
+
+    assert second['ica'] == first['ica']
+    assert sorted(ff.name for ff in tmp_path.iterdir()) == [
+        'cache', 'sub_raw-ica-scores.json', 'sub_raw-ica.fif', 'sub_raw.fif']
+    assert mne.preprocessing.read_ica(second['ica']).exclude == \
+        second['exclude']
+
+
+@pytest.mark.parametrize('method', ['ctps', 'correlation'])
+def test_block_scores_as_loaded(tmp_path, method):
+    """Scoring block by block gives the same epochs and scores."""
+    raw = _make_raw()
+
+    # artefacts in MEG data that reject some epochs
+    data = raw.get_data()
+    for t_art in [5.1, 17.3, 31.7, 44.2]:
+        ii = int(t_art * raw.info['sfreq'])
+        data[3, ii:ii + 10] += 5e-11
+    raw = mne.io.RawArray(data, raw.info, verbose=False)
+
+    raw_fname = str(tmp_path / 'sub_raw.fif')
+    raw.save(raw_fname, verbose=False)
+
+    ch_names = raw.ch_names
+    reject = {'mag': 2e-11}
+
+    args = Fiff_Compute_ICA.get_parser().parse_args([])
+    loaded = Fiff_Compute_ICA._load_filtered(
+        mne.io.read_raw_fif(raw_fname, verbose=False), ch_names, args)
+
+    ica = mne.preprocessing.ICA(n_components=8, method='infomax',
+                                random_state=23)
+    ica.fit(loaded, picks='mag', decim=3, verbose=False)
+
+    scorer = Fiff_Compute_ICA.SourceScorer(ica, loaded)
+    block_scorer = Fiff_Compute_ICA.BlockSourceScorer(
+        ica, mne.io.read_raw_fif(raw_fname, verbose=False), ch_names,
+        ['EOG061', 'EOG062', 'ECG063'], block_seconds=7.)
+
+    np.testing.assert_allclose(block_scorer.sources, scorer.sources,
+                               rtol=0., atol=1e-8 * np.abs(
+                                   scorer.sources).max())
+
+    for [kind, chs] in [('EOG', ['EOG061', 'EOG062']), ('ECG', ['ECG063'])]:
+
+        epochs_list = scorer.epochs(kind, chs, reject)
+        block_list = block_scorer.epochs(kind, chs, reject)
+
+        for [epochs, block] in zip(epochs_list, block_list):
+            assert len(epochs.drop_log) == len(block.drop_log)
+            np.testing.assert_array_equal(block.events, epochs.events)
+
+        assert sum(len(ee) < len(ee.drop_log) for ee in epochs_list) > 0
+
+        np.testing.assert_allclose(
+            block_scorer.scores(kind, chs, block_list, method),
+            scorer.scores(kind, chs, epochs_list, method), atol=1e-6)
+
+
+def test_fit_budget_scores_in_blocks(tmp_path, monkeypatch):
+    """With --FitMaxSeconds, the recording is not loaded for scoring."""
+    raw_fname = str(tmp_path / 'sub_raw.fif')
+    _make_raw().save(raw_fname, verbose=False)
+
+    def no_loading(*args):
+        raise AssertionError('Recording loaded.')
+
+    monkeypatch.setattr(Fiff_Compute_ICA, '_load_filtered', no_loading)
+
+    result = Fiff_Compute_ICA.compute_ica(
+        raw_fname, Fiff_Compute_ICA.get_parser().parse_args(
+            ['--method', 'infomax', '--n_pca_comps', '8', '--Report', 'none',
+             '--FitMaxSeconds', '20', '--EOG', 'EOG061', 'EOG062', '--ECG',
+             'ECG063']))
+
+    assert result['exclude'] != []
@@ -0,0 +1,198 @@
+"""Tests for reading fiff headers with Fiff_Tags.py, compared with MNE."""
+import os
+import struct
+import datetime
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+import AverageSensorArray  # noqa: E402
+import Fiff_Tags  # noqa: E402
+
+
+def _make_info(seed=0):
+    """Measurement info with MEG and EEG channels and random head position."""
+    rng = np.random.RandomState(seed)
+
+    ch_types = ['grad'] * 20 + ['mag'] * 10 + ['eeg'] * 8 + ['eog', 'stim']
+    info = mne.create_info(['CH%03d' % ii for ii in range(len(ch_types))],
+                           1000., ch_types)
+
+    # small rotation about z and translation
+    ang = rng.uniform(-0.2, 0.2)
+    trans = np.eye(4)
+    trans[:2, :2] = [[np.cos(ang), -np.sin(ang)], [np.sin(ang), np.cos(ang)]]
+    trans[:3, 3] = rng.uniform(-0.01, 0.01, 3) + [0., 0., 0.04]
+
+    info['dev_head_t'] = mne.transforms.Transform('meg', 'head', trans)
+
+    return info
+
+
+@pytest.fixture
+def fiff_files(tmp_path):
+    """Info file and raw file, as measurement info only and with data."""
+    fname_info = str(tmp_path / 'sub-info.fif')
+    mne.io.write_info(fname_info, _make_info(0))
+
+    info = _make_info(1)
+    fname_raw = str(tmp_path / 'sub_raw.fif')
+    mne.io.RawArray(np.zeros((info['nchan'], 1000)), info,
+                    verbose=False).save(fname_raw, verbose=False)
+
+    return [fname_info, fname_raw]
+
+
+def test_dev_head_t_as_read_info(fiff_files):
+    """Same transform as in the measurement info read by MNE."""
+    for fname in fiff_files:
+
+        ref = mne.io.read_info(fname, verbose=False)['dev_head_t']['trans']
+
+        np.testing.assert_array_equal(Fiff_Tags.read_dev_head_t(fname), ref)
+        np.testing.assert_array_equal(
+            AverageSensorArray.read_dev_head_t(fname), ref)
+
+
+def test_header_as_read_info(fiff_files):
+    """Sampling rate and numbers of channels as in MNE's measurement info."""
+    for fname in fiff_files:
+
+        info = mne.io.read_info(fname, verbose=False)
+        header = Fiff_Tags.read_header(fname)
+
+        np.testing.assert_array_equal(header['dev_head_t'],
+                                      info['dev_head_t']['trans'])
+        assert header['sfreq'] == info['sfreq']
+        assert header['nchan'] == info['nchan']
+        assert header['n_meg'] == len(mne.pick_types(info, meg=True,
+                                                     exclude=[]))
+        assert header['n_eeg'] == len(mne.pick_types(info, meg=False,
+                                                     eeg=True, exclude=[]))
+
+
+def test_not_fiff(tmp_path):
+    """Files that are not fiff-files are recognised."""
+    fname = str(tmp_path / 'text.fif')
+    with open(fname, 'w') as fid:
+        fid.write('not a fiff-file\n')
+
+    assert Fiff_Tags.read_dev_head_t(fname) is None
+    assert Fiff_Tags.read_header(fname) is None
+
+
+def test_fallback_to_read_info(fiff_files, monkeypatch):
+    """Measurement info is read with MNE if the transform is not found."""
+    monkeypatch.setattr(Fiff_Tags, 'read_dev_head_t', lambda fname: None)
+    monkeypatch.setattr(Fiff_Tags, 'read_header', lambda fname: None)
+
+    for fname in fiff_files:
+
+        info = mne.io.read_info(fname, verbose=False)
+
+        np.testing.assert_array_equal(
+            AverageSensorArray.read_dev_head_t(fname),
+            info['dev_head_t']['trans'])
+
+        header = AverageSensorArray._read_header_full(fname)
+
+        np.testing.assert_array_equal(header['dev_head_t'],
+                                      info['dev_head_t']['trans'])
+        assert (header['nchan'], header['n_meg'], header['n_eeg']) == (40, 30,
+                                                                      8)
+
+
+def _save_subject_info(fname, subject_info):
+    """Save measurement info with subject information."""
+    info = _make_info()
+
+    # date in recent MNE versions, tuple in older ones
+    variants = [subject_info]
+    if 'birthday' in subject_info:
+        bday = subject_info['birthday']
+        variants.append(dict(subject_info,
+                             birthday=(bday.year, bday.month, bday.day)))
+
+    for variant in variants:
+
+        try:
+            info['subject_info'] = variant
+            mne.io.write_info(fname, info)
+        except (TypeError, ValueError):
+            continue
+
+        return
+
+    raise RuntimeError('Could not write subject info.')
+
+
+def _add_directory(fname):
+    """Append tag directory to fiff-file and point to it from its start."""
+    entries = []
+    with open(fname, 'rb') as fid:
+        for [kind, typ, size, pos, _] in Fiff_Tags.iter_tags(fid):
+            entries.append((kind, typ, size, pos - Fiff_Tags.TAG_HEADER.size))
+
+    dir_pos = os.path.getsize(fname)
+    entries.append((Fiff_Tags.FIFF_DIR, 32, 16 * (len(entries) + 1),
+                    dir_pos))
+
+    with open(fname, 'r+b') as fid:
+
+        # directory only reachable via pointer, as in files from acquisition
+        fid.seek(dir_pos)
+        fid.write(Fiff_Tags.TAG_HEADER.pack(Fiff_Tags.FIFF_DIR, 32,
+                                            16 * len(entries), -1))
+        fid.write(b''.join(Fiff_Tags.TAG_HEADER.pack(*ee) for ee in entries))
+
+        # data of directory pointer follows file ID and pointer tag header
+        fid.seek(20 + 2 * Fiff_Tags.TAG_HEADER.size)
+        fid.write(struct.pack('>i', dir_pos))
+
+
+def _ident(subject_info):
+    """Identifying entries of MNE's subject info, birthday as date."""
+    ident = {kk: vv for [kk, vv] in (subject_info or {}).items()
+             if kk in Fiff_Tags.SUBJ_NAMES.values()}
+
+    if isinstance(ident.get('birthday'), tuple):
+        ident['birthday'] = datetime.date(*ident['birthday'])
+
+    return ident
+
+
+@pytest.mark.parametrize('with_dir', [False, True])
+@pytest.mark.parametrize('subject_info', [
+    {'id': 7, 'his_id': 'AB123', 'first_name': 'Jane', 'middle_name': 'Q',
+     'last_name': 'Doe', 'birthday': datetime.date(1984, 5, 6), 'sex': 2,
+     'hand': 1},
+    {'sex': 1},
+    {}])
+def test_subject_info_as_read_info(tmp_path, subject_info, with_dir):
+    """Identifying subject information as read by MNE."""
+    fname = str(tmp_path / 'sub-info.fif')
+    _save_subject_info(fname, subject_info)
+
+    if with_dir:
+        _add_directory(fname)
+
+        with open(fname, 'rb') as fid:
+            assert Fiff_Tags._read_dir(fid) is not None
+
+    ref = _ident(mne.io.read_info(fname, verbose=False)['subject_info'])
+
+    assert Fiff_Tags.read_subject_info(fname) == ref
+
+
+def test_subject_info_not_fiff(tmp_path):
+    """No subject information for a .fif file that is not a fiff-file."""
+    fname = str(tmp_path / 'random.fif')
+    with open(fname, 'wb') as fid:
+        fid.write(np.random.RandomState(0).bytes(1000))
+
+    assert Fiff_Tags.read_subject_info(fname) is None
+
+    with pytest.raises(Exception):
+        mne.io.read_info(fname, verbose=False)
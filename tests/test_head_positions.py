@@ -0,0 +1,143 @@
+"""Tests for reading head positions in Fiff_HeadPositions.py."""
+import os
+
+import numpy as np
+import pytest
+
+mne = pytest.importorskip('mne')
+
+import Fiff_HeadPositions  # noqa: E402
+
+
+def _write_pos(fname, n_samples=500, seed=0):
+    """Write synthetic pos-file as Maxfilter does."""
+    rng = np.random.RandomState(seed)
+
+    pos = rng.randn(n_samples, 10)
+    pos[:, 0] = np.arange(n_samples) / 10.
+
+    mne.chpi.write_head_pos(str(fname), pos)
+
+
+def test_read_head_pos_as_mne(tmp_path):
+    """Same positions as mne.chpi.read_head_pos."""
+    fname = tmp_path / 'sub.pos'
+    _write_pos(fname)
+
+    pos = Fiff_HeadPositions.read_head_pos(str(fname))
+
+    np.testing.assert_array_equal(pos, mne.chpi.read_head_pos(str(fname)))
+
+
+def test_read_head_pos_cache(tmp_path):
+    """Cache is used while pos-file is unchanged, and replaced otherwise."""
+    fname = tmp_path / 'sub.pos'
+    _write_pos(fname)
+
+    pos = Fiff_HeadPositions.read_head_pos(str(fname), cache=True)
+
+    [fname_npy] = [ff for ff in os.listdir(str(tmp_path))
+                   if ff.endswith('.npy')]
+
+    cached = Fiff_HeadPositions.read_head_pos(str(fname), cache=True)
+
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, pos)
+
+    del cached
+
+    # changed pos-file, different size
+    _write_pos(fname, n_samples=300, seed=1)
+
+    pos = Fiff_HeadPositions.read_head_pos(str(fname), cache=True)
+
+    np.testing.assert_array_equal(pos, mne.chpi.read_head_pos(str(fname)))
+
+    npys = [ff for ff in os.listdir(str(tmp_path)) if ff.endswith('.npy')]
+    assert len(npys) == 1 and npys[0] != fname_npy
+
+
+def test_read_head_pos_stale_cache_gone(tmp_path, monkeypatch):
+    """Stale cache removed by another process meanwhile is not an error."""
+    fname = tmp_path / 'sub.pos'
+    _write_pos(fname)
+    Fiff_HeadPositions.read_head_pos(str(fname), cache=True)
+
+    _write_pos(fname, n_samples=300, seed=1)
+
+    def remove(fname_old):
+        raise FileNotFoundError(fname_old)
+
+    monkeypatch.setattr(os, 'remove', remove)
+
+    pos = Fiff_HeadPositions.read_head_pos(str(fname), cache=True)
+
+    np.testing.assert_array_equal(pos, mne.chpi.read_head_pos(str(fname)))
+    assert len([ff for ff in os.listdir(str(tmp_path))
+                if ff.endswith('.npy')]) == 2
+
+
+def test_read_head_pos_incomplete(tmp_path):
+    """Incomplete rows are an error, as in MNE."""
+    fname = tmp_path / 'bad.pos'
+    _write_pos(fname)
+
+    with open(str(fname), 'a') as fid:
+        fid.write('1.0 2.0 3.0\n')
+
+    with pytest.raises(Exception):
+        Fiff_HeadPositions.read_head_pos(str(fname))
+
+
+def test_output_names():
+    """Figures of pos-files with the same name don't overwrite each other."""
+    names = Fiff_HeadPositions.output_names(['/d/sub1.pos', '/d/sub2.pos'],
+                                            '.png')
+    assert names == {'/d/sub1.pos': 'sub1.pos.png',
+                     '/d/sub2.pos': 'sub2.pos.png'}
+
+    names = Fiff_HeadPositions.output_names(['/d/s1/meg/run.pos',
+                                             '/d/s2/meg/run.pos'], '.png')
+    assert sorted(names.values()) == ['s1_meg_run.pos.png',
+                                      's2_meg_run.pos.png']
+
+    with pytest.raises(ValueError, match='collide'):
+        Fiff_HeadPositions.output_names(['/d/a_b/c.pos', '/d/a/b_c.pos',
+                                         '/d/x/c.pos'], '.png')
+
+
+def test_render_batch_same_names(tmp_path):
+    """Pos-files with the same name in subject directories get own figures."""
+    files = []
+    for sub in ['s1', 's2']:
+        (tmp_path / sub).mkdir()
+        files.append(str(tmp_path / sub / 'run.pos'))
+        _write_pos(files[-1])
+
+    args = Fiff_HeadPositions.get_parser().parse_args(
+        ['--FilesPos'] + files + ['--OutDir', str(tmp_path / 'figs'),
+                                  '--Index', str(tmp_path / 'index.html')])
+
+    assert Fiff_HeadPositions.render_batch(files, args) == []
+
+    assert sorted(os.listdir(str(tmp_path / 'figs'))) == ['s1_run.pos.png',
+                                                          's2_run.pos.png']
+
+
+def test_per_sample_same_names(tmp_path):
+    """Per-sample motion of pos-files with the same name in own files."""
+    files = []
+    for sub in ['s1', 's2']:
+        (tmp_path / sub).mkdir()
+        files.append(str(tmp_path / sub / 'run.pos'))
+        _write_pos(files[-1])
+
+    (tmp_path / 'motion').mkdir()
+    args = Fiff_HeadPositions.get_parser().parse_args(
+        ['--FilesPos'] + files + ['--Summary', str(tmp_path / 'sum.csv'),
+                                  '--PerSampleDir', str(tmp_path / 'motion')])
+
+    Fiff_HeadPositions.write_summary(files, args)
+
+    assert sorted(os.listdir(str(tmp_path / 'motion'))) == [
+        's1_run.pos_motion.csv', 's2_run.pos_motion.csv']
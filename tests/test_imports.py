@@ -0,0 +1,26 @@
+"""Tools start quickly: importing them does not load mne or matplotlib."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+modules = ['Fiff_Compute_ICA', 'Fiff_Apply_ICA', 'Fiff_ICA_Report',
+           'Fiff_HeadPositions', 'AverageSensorArray', 'Anonymise_Fiff',
+           'EMEG', 'EMEG_Batch', 'EMEG_Cache', 'EMEG_Profile', 'Fiff_Tags']
+
+
+@pytest.mark.parametrize('module', modules)
+def test_import_is_light(module):
+    """Import in a new interpreter and check which heavy modules it loaded."""
+    code = ('import sys, %s; '
+            'print(" ".join(mm for mm in ("mne", "matplotlib") '
+            'if mm in sys.modules))' % module)
+
+    out = subprocess.run([sys.executable, '-c', code], cwd=repo_dir,
+                         stdout=subprocess.PIPE, check=True,
+                         universal_newlines=True).stdout
+
+    assert out.split() == [], '%s imports %s' % (module, out.strip())